@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+
+'''
+Measure how fast PySnooper can trace code.
+
+Each benchmark snoops a function, throws the output away and reports how many
+output lines per second the tracer produced. Run it from the repository root:
+
+    python misc/benchmark.py [name ...]
+
+'''
+
+
+import sys
+import timeit
+
+sys.path.insert(0, '.')
+import pysnooper
+
+
+class LineCounter(object):
+    def __init__(self):
+        self.n_lines = 0
+
+    def __call__(self, s):
+        self.n_lines += 1
+
+
+def benchmark_tight_loop(write):
+    @pysnooper.snoop(write, color=False)
+    def f():
+        total = 0
+        for i in range(2000):
+            total += i
+        return total
+
+    return f
+
+
+def benchmark_many_locals(write, n_locals=200):
+    # Data-munging and generated code often has lots of locals, which makes
+    # ordering them on every line expensive.
+    namespace = {}
+    exec('def f():\n' + ''.join(
+        '    x{i} = {i}\n'.format(i=i) for i in range(n_locals)
+    ) + '    return x0\n', namespace)
+    return pysnooper.snoop(write, color=False)(namespace['f'])
+
+
+def benchmark_huge_container(write):
+    @pysnooper.snoop(write, color=False)
+    def f():
+        items = list(range(10 ** 6))
+        for i in range(10):
+            items[i] = -i
+        return len(items)
+
+    return f
+
+
+def benchmark_recursion(write):
+    # Like `tests/samples/recursion.py`, but the calls return `None`, so each
+    # return has to be told apart from a call that ended by an exception.
+    @pysnooper.snoop(write, color=False)
+    def visit(depth, visited):
+        visited.append(depth)
+        if depth:
+            visit(depth - 1, visited)
+            visit(depth - 1, visited)
+
+    return lambda: visit(8, [])
+
+
+def benchmark_medium_containers(write):
+    # Containers too big to show in full, but small enough that a plain
+    # `repr` is cheaper than producing only the part that's shown.
+    @pysnooper.snoop(write, color=False)
+    def f():
+        small = list(range(40))
+        medium = list(range(500))
+        mapping = dict.fromkeys(range(1000), 'x')
+        for i in range(100):
+            small[i % 40] = i
+            medium[i] = i
+            mapping[i] = i
+        return len(small) + len(medium) + len(mapping)
+
+    return f
+
+
+benchmarks = {
+    'tight_loop': benchmark_tight_loop,
+    'many_locals': benchmark_many_locals,
+    'huge_container': benchmark_huge_container,
+    'medium_containers': benchmark_medium_containers,
+    'recursion': benchmark_recursion,
+}
+
+
+def run_benchmark(name, repeat=5):
+    line_counter = LineCounter()
+    function = benchmarks[name](line_counter)
+    function()
+    n_lines = line_counter.n_lines
+    best_time = min(timeit.repeat(function, number=1, repeat=repeat))
+    print('{name:<24} {lines_per_second:>12,.0f} lines/s'.format(
+        name=name, lines_per_second=n_lines / best_time
+    ))
+
+
+if __name__ == '__main__':
+    for name in (sys.argv[1:] or sorted(benchmarks)):
+        run_benchmark(name)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+
+'''
+Check that PySnooper's memory use stays flat over many snooped calls.
+
+Each call allocates a sizeable local and never gets its 'return' event, like
+when a debugger or coverage tool replaces the trace function mid-call. A
+tracer that kept such frames alive would grow by the size of the local on
+every call. Run it from the repository root:
+
+    python misc/memory_benchmark.py [n_calls]
+
+'''
+
+
+import resource
+import sys
+
+sys.path.insert(0, '.')
+import pysnooper
+
+
+def null_write(s):
+    pass
+
+
+tracer = pysnooper.snoop(null_write, color=False, relative_time=True)
+
+
+@tracer
+def f(i):
+    payload = [i] * 10000
+    sys.settrace(None)
+
+
+def main(n_calls=10 ** 6):
+    n_reports = 10
+    for i in range(n_calls):
+        f(i)
+        if (i + 1) % (n_calls // n_reports) == 0:
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            print('{n_calls:>12,} calls {max_rss:>10,} KB max RSS '
+                  '{n_frame_states:>6} frame states'.format(
+                      n_calls=i + 1, max_rss=max_rss,
+                      n_frame_states=len(tracer.frame_states)
+                  ))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -18,6 +18,7 @@ For more information, see https://github.com/cool-RR/PySnooper
 '''
 
 from .tracer import Tracer as snoop
+from .rate_limiting import RateLimiter
 from .variables import Attrs, Exploding, Indices, Keys
 import collections
 
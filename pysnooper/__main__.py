@@ -0,0 +1,45 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Turn a binary trace back into PySnooper's usual text output:
+
+    python -m pysnooper render trace.bin [--color] [--normalize]
+
+'''
+
+import argparse
+import sys
+
+from . import binary_format
+
+
+def render(args):
+    stdout = sys.stdout
+    with open(args.file, 'rb') as file:
+        for line in binary_format.render(binary_format.read_records(file),
+                                         color=args.color,
+                                         normalize=args.normalize):
+            stdout.write(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pysnooper')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    render_parser = subparsers.add_parser(
+        'render', help='Write a binary trace out as text.'
+    )
+    render_parser.add_argument('file', help='A trace written with '
+                                            "`format='binary'`.")
+    render_parser.add_argument('--color', action='store_true',
+                               help='Color the output.')
+    render_parser.add_argument('--normalize', action='store_true',
+                               help='Leave out timestamps, memory addresses '
+                                    'and directories, like `normalize=True`.')
+    args = parser.parse_args(argv)
+    if args.command == 'render':
+        render(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,470 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+A compact binary format for traces, and turning it back into text.
+
+With `snoop(format='binary')`, the records from `records.RecordFormatter` are
+written as length-prefixed binary records instead of lines of text. Source
+paths, source lines, variable names and reprs are written once and then
+referred to by number, and each timestamp is written as the difference from
+the previous one. `python -m pysnooper render` turns the trace back into the
+text that PySnooper would have written.
+
+Each record is its length as a varint, followed by a byte for its type, the
+thread and depth, and the fields of its kind. A stream starts with a header
+record, and the string table starts over at each header.
+'''
+
+import calendar
+import os
+import threading
+import time
+
+from . import utils
+from .records import RECORD_FIELDS, VAR_STAGES
+from .templates import TextTemplates
+
+MAGIC = b'PYSNOOPER'
+VERSION = 1
+
+HEADER, STRING, THREAD, RESET = range(4)
+# Record kinds, in the order of their type bytes after the ones above:
+RECORD_KINDS = ('source_path', 'var', 'event', 'call_ended_by_exception',
+                'return_value', 'exception', 'skipped_calls', 'elapsed_time',
+                'dropped_lines', 'custom_line', 'repeated_lines',
+                'suppressed_lines', 'output_limit_reached', 'rate_limited')
+FIRST_RECORD_TYPE = 4
+
+# How each field of each kind is encoded:
+FIELD_ENCODINGS = {
+    'source_path': ('string',),
+    'var': ('stage', 'string', 'string'),
+    'event': ('timestamp', 'string', 'string', 'int', 'string', 'string',
+              'string'),
+    'call_ended_by_exception': ('timestamp', 'string', 'int', 'string',
+                                'string', 'string'),
+    'return_value': ('string',),
+    'exception': ('string',),
+    'skipped_calls': ('int',),
+    'elapsed_time': ('int',),
+    'dropped_lines': ('int',),
+    'custom_line': ('string',),
+    'repeated_lines': ('string', 'int', 'vars'),
+    'suppressed_lines': ('int',),
+    'output_limit_reached': ('int',),
+    'rate_limited': ('int',),
+}
+assert set(FIELD_ENCODINGS) == set(RECORD_FIELDS) == set(RECORD_KINDS)
+KIND_TO_TYPE_AND_ENCODINGS = dict(
+    (kind, (FIRST_RECORD_TYPE + i, FIELD_ENCODINGS[kind]))
+    for i, kind in enumerate(RECORD_KINDS)
+)
+
+FLAG_RELATIVE_TIME = 1
+FLAG_NORMALIZE = 2
+
+# When the string table gets this big, we start it over, so tracing a long
+# running process doesn't keep every repr it ever showed in memory.
+MAX_TABLE_SIZE = 100000
+
+
+def encode_varint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+
+def unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def encode_string(s, out):
+    encoded = s.encode('utf-8', 'surrogatepass')
+    encode_varint(len(encoded), out)
+    out += encoded
+
+
+def get_utc_offset():
+    '''Seconds that local time is ahead of UTC right now.'''
+    now = int(time.time())
+    return calendar.timegm(time.localtime(now)) - now
+
+
+class BinarySink(object):
+    '''
+    Encode records and hand the bytes to `write`.
+
+    Encoding and writing happen under a lock, so a string is always defined
+    in the output before the first record that refers to it.
+
+    Tracers that write to the same destination share a sink, each passing its
+    own `header` to `write`. A header is written whenever the records switch
+    from one tracer's header to another's.
+    '''
+    def __init__(self, write, prefix='', relative_time=False,
+                 normalize=False):
+        self.inner_write = write
+        self.header = self.make_header(prefix, relative_time, normalize)
+        self.lock = threading.Lock()
+        self.table = None
+        self.written_header = None
+        self.last_timestamp = 0
+
+    @staticmethod
+    def make_header(prefix='', relative_time=False, normalize=False):
+        return (prefix, (FLAG_RELATIVE_TIME if relative_time else 0) |
+                        (FLAG_NORMALIZE if normalize else 0))
+
+    def write(self, record, header=None):
+        if header is None:
+            header = self.header
+        out = bytearray()
+        with self.lock:
+            if header != self.written_header:
+                self._encode_header(header, out)
+            elif len(self.table) >= MAX_TABLE_SIZE:
+                self._encode_record(RESET, bytearray(), out)
+                self.table = {}
+                self.last_timestamp = 0
+            self._encode(record, out)
+            self.inner_write(bytes(out))
+
+    def _encode_header(self, header, out):
+        prefix, flags = header
+        payload = bytearray(MAGIC)
+        encode_varint(VERSION, payload)
+        encode_varint(flags, payload)
+        encode_varint(zigzag(get_utc_offset()), payload)
+        encode_string(prefix, payload)
+        self._encode_record(HEADER, payload, out)
+        self.written_header = header
+        self.table = {}
+        self.last_timestamp = 0
+
+    def _encode_record(self, record_type, payload, out):
+        encode_varint(len(payload) + 1, out)
+        out.append(record_type)
+        out += payload
+
+    def _add_string(self, s, out):
+        string_id = self.table[s] = len(self.table) + 1
+        payload = bytearray()
+        encode_varint(string_id, payload)
+        payload += s.encode('utf-8', 'surrogatepass')
+        self._encode_record(STRING, payload, out)
+        return string_id
+
+    def _add_thread(self, thread, out):
+        ident, name = thread
+        name_id = self.table.get(name) or self._add_string(name, out)
+        thread_id = self.table[thread] = len(self.table) + 1
+        payload = bytearray()
+        encode_varint(thread_id, payload)
+        encode_varint(ident, payload)
+        encode_varint(name_id, payload)
+        self._encode_record(THREAD, payload, out)
+        return thread_id
+
+    def _encode(self, record, out):
+        # This runs for every line of the trace, so rather than encode each
+        # field as we go, we turn them all into numbers and then, in the
+        # common case where they're all small, write them as bytes at once.
+        kind = record[0]
+        record_type, encodings = KIND_TO_TYPE_AND_ENCODINGS[kind]
+        if kind == 'event':
+            numbers = self._get_event_numbers(record, out)
+        elif kind == 'var':
+            numbers = self._get_var_numbers(record, out)
+        else:
+            numbers = self._get_numbers(record, encodings, out)
+        if max(numbers) < 0x80:
+            out.append(len(numbers) + 1)
+            out.append(record_type)
+            out += bytearray(numbers)
+        else:
+            payload = bytearray()
+            for number in numbers:
+                encode_varint(number, payload)
+            self._encode_record(record_type, payload, out)
+
+    def _get_timestamp_number(self, timestamp):
+        # 0 for a normalized timestamp, otherwise the difference from the last
+        # one, plus one.
+        if timestamp is None:
+            return 0
+        number = zigzag(timestamp - self.last_timestamp) + 1
+        self.last_timestamp = timestamp
+        return number
+
+    # Events and variables make up most of a trace, so they get their own,
+    # unrolled versions of `_get_numbers`.
+
+    def _get_event_numbers(self, record, out):
+        (_, thread, depth, timestamp, thread_info, event, line_no,
+                               source_line, source_path, function_name) = record
+        get = self.table.get
+        return [
+            get(thread) or self._add_thread(thread, out),
+            depth,
+            self._get_timestamp_number(timestamp),
+            get(thread_info) or self._add_string(thread_info, out),
+            get(event) or self._add_string(event, out),
+            zigzag(line_no),
+            get(source_line) or self._add_string(source_line, out),
+            get(source_path) or self._add_string(source_path, out),
+            get(function_name) or self._add_string(function_name, out),
+        ]
+
+    def _get_var_numbers(self, record, out):
+        _, thread, depth, stage, name, value_repr = record
+        get = self.table.get
+        return [
+            get(thread) or self._add_thread(thread, out),
+            depth,
+            VAR_STAGES.index(stage),
+            get(name) or self._add_string(name, out),
+            get(value_repr) or self._add_string(value_repr, out),
+        ]
+
+    def _get_numbers(self, record, encodings, out):
+        thread = record[1]
+        numbers = [0 if thread is None else
+                   self.table.get(thread) or self._add_thread(thread, out),
+                   record[2]]
+        for encoding, value in zip(encodings, record[3:]):
+            if encoding == 'string':
+                numbers.append(self.table.get(value) or
+                               self._add_string(value, out))
+            elif encoding == 'int':
+                numbers.append(zigzag(value))
+            elif encoding == 'stage':
+                numbers.append(VAR_STAGES.index(value))
+            elif encoding == 'vars':
+                numbers.append(len(value))
+                for name, value_repr in value:
+                    numbers.append(self.table.get(name) or
+                                   self._add_string(name, out))
+                    numbers.append(self.table.get(value_repr) or
+                                   self._add_string(value_repr, out))
+            else:
+                assert encoding == 'timestamp'
+                numbers.append(self._get_timestamp_number(value))
+        return numbers
+
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read_varint(self):
+        result = shift = 0
+        while True:
+            byte = self.data[self.position]
+            self.position += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return result
+            shift += 7
+
+    def read_string(self):
+        length = self.read_varint()
+        start = self.position
+        self.position += length
+        return self.data[start:self.position].decode('utf-8', 'surrogatepass')
+
+    def read_rest(self):
+        return self.data[self.position:]
+
+
+def _read_varint_from_file(file):
+    result = shift = 0
+    while True:
+        byte = file.read(1)
+        if not byte:
+            if shift:
+                raise ValueError('The trace ends in the middle of a record.')
+            return None
+        byte = ord(byte)
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result
+        shift += 7
+
+
+def read_records(file):
+    '''
+    Yield the records in a binary trace read from `file`.
+
+    Every header in the trace comes out as a record of the form
+    `('header', None, 0, prefix, relative_time, normalize, utc_offset)`.
+    '''
+    table = {}
+    last_timestamp = 0
+    while True:
+        length = _read_varint_from_file(file)
+        if length is None:
+            return
+        data = bytearray(file.read(length))
+        if len(data) < length:
+            raise ValueError('The trace ends in the middle of a record.')
+        record_type = data[0]
+        reader = _Reader(data)
+        reader.position = 1
+        if record_type == HEADER:
+            if bytes(data[1:1 + len(MAGIC)]) != MAGIC:
+                raise ValueError("This isn't a PySnooper binary trace.")
+            reader.position += len(MAGIC)
+            version = reader.read_varint()
+            if version != VERSION:
+                raise ValueError('Unsupported trace version {}.'.format(
+                    version
+                ))
+            flags = reader.read_varint()
+            utc_offset = unzigzag(reader.read_varint())
+            prefix = reader.read_string()
+            table = {}
+            last_timestamp = 0
+            yield ('header', None, 0, prefix,
+                   bool(flags & FLAG_RELATIVE_TIME),
+                   bool(flags & FLAG_NORMALIZE), utc_offset)
+        elif record_type == STRING:
+            string_id = reader.read_varint()
+            table[string_id] = bytes(reader.read_rest()).decode(
+                'utf-8', 'surrogatepass'
+            )
+        elif record_type == THREAD:
+            thread_id = reader.read_varint()
+            ident = reader.read_varint()
+            table[thread_id] = (ident, table[reader.read_varint()])
+        elif record_type == RESET:
+            table = {}
+            last_timestamp = 0
+        else:
+            kind = RECORD_KINDS[record_type - FIRST_RECORD_TYPE]
+            thread_id = reader.read_varint()
+            thread = table[thread_id] if thread_id else None
+            record = [kind, thread, reader.read_varint()]
+            for encoding in FIELD_ENCODINGS[kind]:
+                if encoding == 'string':
+                    record.append(table[reader.read_varint()])
+                elif encoding == 'int':
+                    record.append(unzigzag(reader.read_varint()))
+                elif encoding == 'stage':
+                    record.append(VAR_STAGES[reader.read_varint()])
+                elif encoding == 'vars':
+                    record.append(tuple(
+                        (table[reader.read_varint()],
+                         table[reader.read_varint()])
+                        for _ in range(reader.read_varint())
+                    ))
+                else:
+                    value = reader.read_varint()
+                    if value:
+                        last_timestamp += unzigzag(value - 1)
+                        record.append(last_timestamp)
+                    else:
+                        record.append(None)
+            yield tuple(record)
+
+
+def render(records, color=False, normalize=False):
+    '''
+    Yield the lines of text that `Tracer` would have written for `records`.
+
+    With `normalize=True`, the text looks like `Tracer(normalize=True)` output,
+    even if the trace wasn't normalized when it was taken.
+    '''
+    templates = TextTemplates(color=color)
+    relative_time = False
+    format_time_of_day = utils.format_time_of_day
+    for record in records:
+        kind, thread, depth = record[:3]
+        indent = u' ' * 4 * depth
+        if kind == 'header':
+            prefix, relative_time, _, utc_offset = record[3:]
+            templates = TextTemplates(prefix, color=color)
+            format_time_of_day = utils.TimestampFormatter(
+                lambda seconds, utc_offset=utc_offset: time.strftime(
+                    '%H:%M:%S.', time.gmtime(seconds + utc_offset)
+                )
+            )
+        elif kind == 'source_path':
+            (source_path,) = record[3:]
+            if normalize:
+                source_path = os.path.basename(source_path)
+            yield templates.source_path(indent=indent, source_path=source_path)
+        elif kind == 'var':
+            stage, name, value_repr = record[3:]
+            if normalize:
+                value_repr = utils.normalize_repr(value_repr)
+            yield getattr(templates, stage + '_var')(
+                indent=indent, name=name, value_repr=value_repr
+            )
+        elif kind == 'event':
+            timestamp, thread_info, event, line_no, source_line = record[3:8]
+            if normalize or timestamp is None:
+                timestamp = u' ' * 15
+            elif relative_time:
+                timestamp = utils.format_duration(timestamp)
+            else:
+                timestamp = format_time_of_day(timestamp)
+            yield templates.event(
+                indent=indent, timestamp=timestamp, thread_info=thread_info,
+                event=event, line_no=line_no, source_line=source_line
+            )
+        elif kind == 'call_ended_by_exception':
+            yield templates.call_ended_by_exception(indent=indent)
+        elif kind == 'return_value':
+            (return_value_repr,) = record[3:]
+            if normalize:
+                return_value_repr = utils.normalize_repr(return_value_repr)
+            yield templates.return_value(indent=indent,
+                                         return_value_repr=return_value_repr)
+        elif kind == 'exception':
+            (exception,) = record[3:]
+            yield templates.exception(indent=indent, exception=exception)
+        elif kind == 'skipped_calls':
+            (n_skipped_calls,) = record[3:]
+            yield templates.skipped_calls(indent=indent,
+                                          n_skipped_calls=n_skipped_calls)
+        elif kind == 'elapsed_time':
+            (elapsed_time,) = record[3:]
+            yield templates.elapsed_time(
+                indent=indent,
+                elapsed_time_string=utils.format_duration(elapsed_time)
+            )
+        elif kind == 'repeated_lines':
+            line_nos, n_repeats, last_values = record[3:]
+            if normalize:
+                last_values = tuple(
+                    (name, utils.normalize_repr(value_repr))
+                    for name, value_repr in last_values
+                )
+            yield templates.repeated_lines(indent=indent, line_nos=line_nos,
+                                           n_repeats=n_repeats,
+                                           last_values=last_values)
+        elif kind == 'dropped_lines':
+            (n_dropped,) = record[3:]
+            yield templates.dropped_lines(n_dropped=n_dropped)
+        elif kind == 'rate_limited':
+            (n_dropped,) = record[3:]
+            yield templates.rate_limited(n_dropped=n_dropped)
+        elif kind == 'suppressed_lines':
+            (n_suppressed,) = record[3:]
+            yield templates.suppressed_lines(indent=indent,
+                                             n_suppressed=n_suppressed)
+        elif kind == 'output_limit_reached':
+            (max_lines_total,) = record[3:]
+            yield templates.output_limit_reached(
+                max_lines_total=max_lines_total
+            )
+        else:
+            assert kind == 'custom_line'
+            (s,) = record[3:]
+            yield templates.custom_line(s=s)
@@ -0,0 +1,270 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Truncated reprs of huge values, without building their full repr first.
+
+`repr` of a list with ten million items builds a string of hundreds of
+megabytes, only for us to show 100 characters of it. Here we produce the repr
+of builtin containers, strings and dataclasses in chunks, both from the start
+and from the end, and stop as soon as we have enough characters for the
+`head...tail` that `utils.truncate` would show.
+'''
+
+import inspect
+import itertools
+
+from . import pycompat
+
+try:
+    import dataclasses
+except ImportError: # Python < 3.7
+    dataclasses = None
+
+# Characters that cleaning (dropping newlines and memory addresses) could
+# remove near the point where we stopped producing the repr. We produce this
+# many extra characters so that the part we show is never affected.
+MARGIN = 32
+
+STRING_BLOCK_SIZE = 1024
+
+# Producing a repr in chunks has a fixed cost of about a full `repr` of a
+# string of a few thousand characters, or of a container whose repr is 10 to
+# 20 times as long as what we show, as measured with
+# `misc/benchmark.py medium_containers`. Below these sizes we just `repr`.
+MIN_STRING_LENGTH = 8 * STRING_BLOCK_SIZE
+MIN_REPR_LENGTH_PER_CHARACTER = 30
+# Short containers have all their entries looked at, to spot huge values:
+MAX_SCANNED_ENTRIES = 100
+# Guesses at repr lengths, for `_estimate_repr_length`. Any entry of a
+# container takes at least a character and a `, ` separator.
+ESTIMATED_ENTRY_LENGTH = 3
+ESTIMATED_OBJECT_REPR_LENGTH = 20
+
+container_types = (list, tuple, set, frozenset, dict)
+string_types = (pycompat.text_type, pycompat.binary_type)
+# Types whose repr is short, and cheap and safe to make:
+scalar_types = pycompat.integer_types + (float, complex, bool, type(None))
+
+_dataclass_repr_cache = {}
+
+
+def has_generated_dataclass_repr(cls):
+    '''Whether `cls` uses the `__repr__` that `dataclasses` generates.'''
+    try:
+        return _dataclass_repr_cache[cls]
+    except KeyError:
+        pass
+    result = False
+    if dataclasses is not None and dataclasses.is_dataclass(cls):
+        repr_function = inspect.unwrap(cls.__repr__)
+        result = getattr(repr_function, '__qualname__', '').endswith(
+            '__create_fn__.<locals>.__repr__'
+        )
+    _dataclass_repr_cache[cls] = result
+    return result
+
+
+def _estimate_repr_length(value):
+    '''A rough guess at the length of `value`'s repr, without making it.'''
+    value_type = type(value)
+    if value_type in string_types:
+        return len(value) + 2
+    elif value_type in container_types:
+        return ESTIMATED_ENTRY_LENGTH * len(value) + 2
+    elif value_type in scalar_types:
+        return len(repr(value))
+    else:
+        return ESTIMATED_OBJECT_REPR_LENGTH
+
+
+def is_bounded_repr_worthwhile(item, max_length):
+    '''
+    Whether `item`'s repr is long enough that producing just the part we show
+    is cheaper than `repr`.
+
+    Strings are judged by their length. A big container is judged by its
+    length and a couple of its entries, while a short one, that might hold a
+    huge string, is judged by all of its entries.
+    '''
+    item_type = type(item)
+    if item_type in string_types:
+        return len(item) > max(MIN_STRING_LENGTH, max_length)
+    min_repr_length = MIN_REPR_LENGTH_PER_CHARACTER * max_length
+    if item_type in container_types:
+        n_entries = len(item)
+        if n_entries > MAX_SCANNED_ENTRIES:
+            # Judge the entries by one or two of them, with their `, `.
+            if item_type is dict:
+                key, value = next(iter(item.items()))
+                entry_length = _estimate_repr_length(key) + \
+                                             _estimate_repr_length(value) + 4
+            elif item_type in (list, tuple):
+                entry_length = (_estimate_repr_length(item[0]) +
+                                _estimate_repr_length(item[-1])) // 2 + 2
+            else:
+                entry_length = _estimate_repr_length(next(iter(item))) + 2
+            return n_entries * entry_length > min_repr_length
+        elif item_type is dict:
+            values = itertools.chain.from_iterable(item.items())
+        else:
+            values = item
+    elif has_generated_dataclass_repr(item_type):
+        values = [getattr(item, field.name)
+                  for field in dataclasses.fields(item) if field.repr]
+    else:
+        return False
+    return sum(map(_estimate_repr_length, values)) > min_repr_length
+
+
+def _iter_string_repr_chunks(s, reverse):
+    if isinstance(s, pycompat.binary_type):
+        single_quote, double_quote = b"'", b'"'
+    else:
+        single_quote, double_quote = u"'", u'"'
+    # Like `b` for bytes on Python 3:
+    opening_prefix = repr(s[:0])[:-2]
+    # Python picks the quote character by looking at the whole string, so we
+    # add a character to each block that forces the same choice.
+    if single_quote in s and double_quote not in s:
+        quote, forcing_character = '"', single_quote
+    else:
+        quote, forcing_character = "'", double_quote
+    n_opening_characters = len(opening_prefix) + 1
+
+    starts = range(0, len(s), STRING_BLOCK_SIZE)
+    if reverse:
+        yield quote
+        starts = reversed(starts)
+    else:
+        yield opening_prefix + quote
+    for start in starts:
+        block = s[start:start + STRING_BLOCK_SIZE]
+        yield repr(block + forcing_character)[n_opening_characters:-2]
+    yield opening_prefix + quote if reverse else quote
+
+
+def _iter_repr_chunks(item, reverse, active_ids):
+    '''
+    Yield the repr of `item` in chunks, from the start or from the end.
+
+    When going in reverse, chunks come last one first, but each chunk reads
+    normally. Joining them the right way gives exactly `repr(item)`.
+    '''
+    item_type = type(item)
+    if item_type in string_types:
+        for chunk in _iter_string_repr_chunks(item, reverse):
+            yield chunk
+        return
+    elif item_type not in container_types and \
+                                     not has_generated_dataclass_repr(item_type):
+        yield repr(item)
+        return
+
+    item_id = id(item)
+    if item_id in active_ids:
+        # A container that contains itself, shown like `repr` does:
+        if item_type is list:
+            yield '[...]'
+        elif item_type is dict:
+            yield '{...}'
+        elif item_type is tuple:
+            yield '(...)'
+        else:
+            yield '...'
+        return
+
+    if item_type is list:
+        opening, closing, entries = '[', ']', item
+    elif item_type is tuple:
+        opening, entries = '(', item
+        closing = ',)' if len(item) == 1 else ')'
+    elif item_type is dict:
+        opening, closing, entries = '{', '}', item
+    elif item_type in (set, frozenset):
+        entries = item
+        if not item:
+            yield '{}()'.format(item_type.__name__)
+            return
+        elif item_type is set:
+            opening, closing = '{', '}'
+        else:
+            opening, closing = 'frozenset({', '})'
+    else:
+        opening = '{}('.format(item_type.__qualname__)
+        closing = ')'
+        entries = [field for field in dataclasses.fields(item) if field.repr]
+
+    if reverse:
+        try:
+            entries = reversed(entries)
+        except TypeError:
+            # Sets, and dicts before Python 3.8.
+            entries = reversed(list(entries))
+        opening, closing = closing, opening
+
+    active_ids.add(item_id)
+    yield opening
+    for i, entry in enumerate(entries):
+        if i:
+            yield ', '
+        if item_type is dict:
+            parts = (_iter_repr_chunks(entry, reverse, active_ids), (': ',),
+                     _iter_repr_chunks(item[entry], reverse, active_ids))
+        elif item_type in container_types:
+            parts = (_iter_repr_chunks(entry, reverse, active_ids),)
+        else:
+            parts = (('{}='.format(entry.name),),
+                     _iter_repr_chunks(getattr(item, entry.name), reverse,
+                                       active_ids))
+        if reverse:
+            parts = reversed(parts)
+        for part in parts:
+            for chunk in part:
+                yield chunk
+    yield closing
+    active_ids.discard(item_id)
+
+
+def _take(item, reverse, n_characters, clean):
+    '''
+    Produce at least `n_characters` cleaned characters of `item`'s repr.
+
+    Returns the cleaned characters, and whether that's the entire repr.
+    '''
+    chunks = _iter_repr_chunks(item, reverse, set())
+    collected = []
+    n_collected = 0
+    target = n_characters + MARGIN
+    while True:
+        for chunk in chunks:
+            collected.append(chunk)
+            n_collected += len(chunk)
+            if n_collected >= target:
+                break
+        else:
+            if reverse:
+                collected.reverse()
+            return clean(''.join(collected)), True
+        result = clean(''.join(reversed(collected) if reverse else collected))
+        if len(result) >= n_characters + MARGIN:
+            return result, False
+        # Cleaning removed a lot of characters, so we need more.
+        target += n_characters + MARGIN - len(result)
+
+
+def get_bounded_repr(item, max_length, clean):
+    '''
+    Get the cleaned repr of `item`, truncated to `max_length` characters.
+
+    This gives the same result as `truncate(clean(repr(item)), max_length)`,
+    but only looks at as much of `item` as needed for that.
+    '''
+    left = (max_length - 3) // 2
+    right = max_length - 3 - left
+    head, is_complete = _take(item, False, max_length, clean)
+    if is_complete:
+        if len(head) <= max_length:
+            return head
+        return u'{}...{}'.format(head[:left], head[-right:])
+    tail, _ = _take(item, True, right, clean)
+    return u'{}...{}'.format(head[:left], tail[-right:])
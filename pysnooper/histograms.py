@@ -0,0 +1,111 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Latency histograms, for `snoop(histogram=True)`.
+
+Instead of tracing each snooped call, the tracer only times it, and adds the
+duration to a histogram of the function. `Tracer.write_histograms` writes the
+number of calls and the median, 90th and 99th percentile and maximum durations
+of each function.
+'''
+
+import array
+import threading
+
+from . import pycompat, utils
+
+# Durations below `2 ** SUB_BUCKET_BITS` nanoseconds get a bucket each. Above
+# that, each power of two is split into `2 ** (SUB_BUCKET_BITS - 1)` buckets,
+# so a bucket is less than 1/128th as wide as the durations in it, and a
+# duration is off by less than 0.8% at worst, however long it is.
+SUB_BUCKET_BITS = 8
+N_LINEAR_BUCKETS = 2 ** SUB_BUCKET_BITS
+N_SUB_BUCKETS = 2 ** (SUB_BUCKET_BITS - 1)
+
+
+def get_bucket_index(duration):
+    if duration < N_LINEAR_BUCKETS:
+        return duration
+    shift = duration.bit_length() - SUB_BUCKET_BITS
+    return shift * N_SUB_BUCKETS + (duration >> shift)
+
+
+def get_bucket_bounds(index):
+    '''The lowest and highest durations that go in the bucket at `index`.'''
+    if index < N_LINEAR_BUCKETS:
+        return index, index
+    shift = (index - N_SUB_BUCKETS) // N_SUB_BUCKETS
+    sub_bucket = index - shift * N_SUB_BUCKETS
+    return sub_bucket << shift, ((sub_bucket + 1) << shift) - 1
+
+
+class LatencyHistogram(object):
+    '''
+    Counts of durations in nanoseconds, in log-sized buckets.
+
+    Memory grows only with the log of the longest duration, not with the
+    number of calls, like in HdrHistogram.
+    '''
+    def __init__(self, label, code):
+        self.label = label
+        # Held on to, so the id we're keyed by isn't reused:
+        self.code = code
+        self.counts = array.array('L', [0] * N_LINEAR_BUCKETS)
+        self.count = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def record(self, duration):
+        if duration < 0:
+            # Without `perf_counter`, on Python 2, the clock can go back.
+            duration = 0
+        index = (duration if duration < N_LINEAR_BUCKETS
+                 else get_bucket_index(duration))
+        with self.lock:
+            counts = self.counts
+            if index >= len(counts):
+                counts.extend([0] * (index + 1 - len(counts)))
+            counts[index] += 1
+            self.count += 1
+            if duration > self.max:
+                self.max = duration
+
+    def get_percentile(self, percentile):
+        '''
+        Get the duration that `percentile` percent of the calls took at most.
+
+        This is the highest duration in its bucket, or the maximum duration if
+        that's lower.
+        '''
+        if not self.count:
+            return 0
+        rank = max(1, -(-self.count * percentile // 100))
+        n_counted = 0
+        for index, count in enumerate(self.counts):
+            n_counted += count
+            if n_counted >= rank:
+                return min(get_bucket_bounds(index)[1], self.max)
+        return self.max
+
+    def format_summary(self):
+        return u'{}: {:,} calls, p50 {}, p90 {}, p99 {}, max {}'.format(
+            self.label, self.count,
+            *[utils.format_duration(duration // 1000) for duration in
+              (self.get_percentile(50), self.get_percentile(90),
+               self.get_percentile(99), self.max)]
+        )
+
+
+class Stopwatch(object):
+    '''Time a `with` block, and add its duration to a histogram.'''
+    __slots__ = ('histogram', 'start_time')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = pycompat.perf_counter_ns()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.histogram.record(pycompat.perf_counter_ns() - self.start_time)
@@ -0,0 +1,197 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Traces as JSON Lines, one object per event.
+
+With `snoop(format='jsonl')`, the records from `records.RecordFormatter` are
+gathered into one JSON object per event, with the variables that changed since
+the previous event of its frame, and the return value or exception that came
+with it:
+
+    {"event": "line", "timestamp": 1571234567123456, "thread": 140099,
+     "thread_name": "MainThread", "depth": 1, "file": "/my/code.py",
+     "function": "foo", "line": 7, "source": "    y = x + 1", "new_vars": {"x": "3"},
+     "modified_vars": {}, "return_value": null, "exception": null,
+     "ended_by_exception": false}
+
+(Each object takes up one line in the actual output.) Timestamps are integers
+of microseconds since the epoch, or since the start of the call with
+`relative_time=True`, or `null` with `normalize=True`. Elapsed times, skipped
+calls, dropped lines, lines written with `Tracer.write`, the summaries of
+compressed loops, lines suppressed by the line budgets and events dropped by
+the rate limit get objects of their own, with `"event"` set to
+`"elapsed_time"`, `"skipped_calls"`, `"dropped_lines"`, `"custom_line"`,
+`"repeated_lines"`, `"suppressed_lines"`, `"output_limit_reached"` and
+`"rate_limited"`.
+'''
+
+import json
+import threading
+
+# Already escaped and quoted, so the objects can be put together with plain
+# string formatting rather than by building a dict and dumping it:
+encode_string = json.encoder.encode_basestring
+
+# The fields we know as soon as we get the event. The rest are added when the
+# event is written out.
+EVENT_HEAD_TEMPLATE = (
+    u'{{"event": {event}, "timestamp": {timestamp}, "thread": {thread}, '
+    u'"thread_name": {thread_name}, "depth": {depth}, "file": {file}, '
+    u'"function": {function}, "line": {line_no}, "source": {source}, '
+    u'"new_vars": {{'
+).format
+
+OTHER_TEMPLATE = (
+    u'{{"event": "{kind}", "thread": {thread}, "thread_name": {thread_name}, '
+    u'"depth": {depth}, "{field}": {value}}}\n'
+).format
+
+REPEATED_LINES_TEMPLATE = (
+    u'{{"event": "repeated_lines", "thread": {thread}, '
+    u'"thread_name": {thread_name}, "depth": {depth}, "line_nos": {line_nos}, '
+    u'"n_repeats": {n_repeats}, "last_values": {{{last_values}}}}}\n'
+).format
+
+OTHER_FIELDS = {
+    'elapsed_time': 'elapsed_time',
+    'skipped_calls': 'n_skipped_calls',
+    'dropped_lines': 'n_dropped',
+    'custom_line': 'message',
+    'suppressed_lines': 'n_suppressed',
+    'output_limit_reached': 'max_lines_total',
+    'rate_limited': 'n_dropped',
+}
+
+NULL = u'null'
+
+
+def encode_timestamp(timestamp):
+    return NULL if timestamp is None else str(timestamp)
+
+
+def encode_vars(vars):
+    if not vars:
+        return u''
+    return u', '.join([u'{}: {}'.format(encode_string(name),
+                                        encode_string(value_repr))
+                       for name, value_repr in vars])
+
+
+class PendingEvent(object):
+    '''What we know so far about the next object to write for a thread.'''
+    __slots__ = ('new_vars', 'modified_vars', 'head', 'return_value',
+                 'exception', 'ended_by_exception')
+
+    def __init__(self):
+        self.new_vars = []
+        self.modified_vars = []
+        self.head = None
+        self.return_value = NULL
+        self.exception = NULL
+        self.ended_by_exception = u'false'
+
+
+class JsonLinesSink(object):
+    '''
+    Gather records into one JSON object per event, and hand them to `write`.
+
+    Variables are reported before the event they belong to, and return values
+    and exceptions after it, so each thread has a `PendingEvent` that is
+    written out once its event is complete.
+    '''
+    def __init__(self, write):
+        self.inner_write = write
+        self.lock = threading.Lock()
+        self.pending_events = {}
+
+    def write(self, record):
+        kind, thread = record[:2]
+        with self.lock:
+            if kind == 'var':
+                _, _, _, stage, name, value_repr = record
+                pending_event = self._get_pending_event(thread)
+                if stage == 'modified':
+                    pending_event.modified_vars.append((name, value_repr))
+                else:
+                    pending_event.new_vars.append((name, value_repr))
+            elif kind == 'event' or kind == 'call_ended_by_exception':
+                if kind == 'event':
+                    (_, _, depth, timestamp, _, event, line_no, source_line,
+                                          source_path, function_name) = record
+                else:
+                    (_, _, depth, timestamp, _, line_no, source_line,
+                                          source_path, function_name) = record
+                    event = 'return'
+                pending_event = self._get_pending_event(thread)
+                pending_event.head = EVENT_HEAD_TEMPLATE(
+                    event=encode_string(event),
+                    timestamp=encode_timestamp(timestamp),
+                    thread=thread[0], thread_name=encode_string(thread[1]),
+                    depth=depth, file=encode_string(source_path),
+                    function=encode_string(function_name),
+                    line_no=line_no, source=encode_string(source_line)
+                )
+                if kind == 'call_ended_by_exception':
+                    pending_event.ended_by_exception = u'true'
+                    self._write_pending_event(thread)
+                elif event != 'return' and event != 'exception':
+                    self._write_pending_event(thread)
+            elif kind == 'return_value' or kind == 'exception':
+                pending_event = self.pending_events.get(thread)
+                if pending_event is not None and \
+                                              pending_event.head is not None:
+                    setattr(pending_event, kind, encode_string(record[3]))
+                    self._write_pending_event(thread)
+            elif kind == 'source_path':
+                # Every event says which file it's in.
+                pass
+            elif kind == 'repeated_lines':
+                self._write_pending_event(thread)
+                _, _, depth, line_nos, n_repeats, last_values = record
+                self.inner_write(REPEATED_LINES_TEMPLATE(
+                    thread=thread[0], thread_name=encode_string(thread[1]),
+                    depth=depth, line_nos=encode_string(line_nos),
+                    n_repeats=n_repeats, last_values=encode_vars(last_values)
+                ))
+            else:
+                if thread is None:
+                    for pending_thread in tuple(self.pending_events):
+                        self._write_pending_event(pending_thread)
+                    thread_ident = thread_name = NULL
+                else:
+                    self._write_pending_event(thread)
+                    thread_ident, thread_name = thread
+                    thread_name = encode_string(thread_name)
+                value = record[3]
+                self.inner_write(OTHER_TEMPLATE(
+                    kind=kind, thread=thread_ident, thread_name=thread_name,
+                    depth=record[2], field=OTHER_FIELDS[kind],
+                    value=(encode_string(value) if kind == 'custom_line'
+                           else value)
+                ))
+
+    def _get_pending_event(self, thread):
+        pending_event = self.pending_events.get(thread)
+        if pending_event is not None and pending_event.head is not None:
+            # The event is complete, even though the return value or the
+            # exception that usually comes after it didn't make it here.
+            self._write_pending_event(thread)
+            pending_event = None
+        if pending_event is None:
+            pending_event = self.pending_events[thread] = PendingEvent()
+        return pending_event
+
+    def _write_pending_event(self, thread):
+        pending_event = self.pending_events.get(thread)
+        if pending_event is None or pending_event.head is None:
+            return
+        del self.pending_events[thread]
+        self.inner_write(u''.join((
+            pending_event.head, encode_vars(pending_event.new_vars),
+            u'}, "modified_vars": {',
+            encode_vars(pending_event.modified_vars),
+            u'}, "return_value": ', pending_event.return_value,
+            u', "exception": ', pending_event.exception,
+            u', "ended_by_exception": ', pending_event.ended_by_exception,
+            u'}\n'
+        )))
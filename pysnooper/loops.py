@@ -0,0 +1,123 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Loop compression, for `snoop(compress_loops=n)`.
+
+When a frame runs the same cycle of lines over and over, the tracer writes the
+first `n` iterations in full, leaves the rest out, and when the loop ends
+writes a single line saying how many more times the lines ran, and the values
+that the variables were left with.
+'''
+
+# Longer cycles than this, in lines, aren't spotted as loops:
+MAX_CYCLE_LENGTH = 100
+
+
+def format_line_nos(line_nos):
+    '''Format line numbers like `3-5, 8`.'''
+    ranges = []
+    for line_no in sorted(set(line_nos)):
+        if ranges and ranges[-1][1] == line_no - 1:
+            ranges[-1][1] = line_no
+        else:
+            ranges.append([line_no, line_no])
+    return u', '.join(
+        str(first) if first == last else u'{}-{}'.format(first, last)
+        for first, last in ranges
+    )
+
+
+class LoopDetector(object):
+    '''
+    Spot one frame running the same cycle of lines over and over.
+
+    Each line is checked against the line that ran a cycle length before it,
+    so a loop is spotted in constant time per line. Once the cycle has run
+    `n_shown_iterations` times, `add_line` says to leave out the lines that
+    follow it, until one of them doesn't.
+    '''
+    __slots__ = ('n_shown_iterations', 'line_nos', 'last_indexes',
+                 'n_lines', 'cycle_length', 'n_matching_lines', 'cycle',
+                 'position', 'n_repeats', 'frame', 'indent')
+
+    def __init__(self, n_shown_iterations):
+        self.n_shown_iterations = n_shown_iterations
+        self.reset()
+
+    def reset(self):
+        self.line_nos = []
+        # The index in `line_nos`, counting from the first line we got, of
+        # the last time each line ran:
+        self.last_indexes = {}
+        self.n_lines = 0
+        self.cycle_length = 0
+        self.n_matching_lines = 0
+        # The lines being left out, and where in them we are:
+        self.cycle = None
+        self.position = 0
+        self.n_repeats = 0
+        # Held on to only while lines are being left out, so the last values
+        # of the variables can be shown when the loop ends:
+        self.frame = None
+        self.indent = None
+
+    @property
+    def is_compressing(self):
+        return self.cycle is not None
+
+    def add_line(self, line_no):
+        '''
+        Count a line that ran, and return whether to leave it out.
+
+        When lines are being left out and `line_no` doesn't continue the
+        cycle, the loop has ended, and the caller should write its summary and
+        `reset` before adding the line again.
+        '''
+        cycle = self.cycle
+        if cycle is not None:
+            position = self.position
+            if line_no != cycle[position]:
+                return False
+            if not position:
+                self.n_repeats += 1
+            position += 1
+            self.position = 0 if position == len(cycle) else position
+            return True
+
+        line_nos = self.line_nos
+        cycle_length = self.cycle_length
+        n_needed_lines = cycle_length * (self.n_shown_iterations - 1) + 1
+        if cycle_length and line_nos[-cycle_length] == line_no:
+            self.n_matching_lines += 1
+        else:
+            # Try the cycle that ends with the last time this line ran. The
+            # lines before this one may have been following it already, when
+            # the cycle has a line that runs more than once in it.
+            last_index = self.last_indexes.get(line_no)
+            if last_index is not None and \
+                              self.n_lines - last_index <= MAX_CYCLE_LENGTH:
+                cycle_length = self.cycle_length = self.n_lines - last_index
+                n_needed_lines = \
+                          cycle_length * (self.n_shown_iterations - 1) + 1
+                n_matching_lines = 1
+                while n_matching_lines < n_needed_lines and \
+                      n_matching_lines + cycle_length <= len(line_nos) and \
+                      line_nos[-n_matching_lines] == \
+                                 line_nos[-n_matching_lines - cycle_length]:
+                    n_matching_lines += 1
+                self.n_matching_lines = n_matching_lines
+            else:
+                cycle_length = self.cycle_length = self.n_matching_lines = 0
+        if cycle_length and self.n_matching_lines >= n_needed_lines:
+            # The cycle has run in full `n_shown_iterations` times, and this
+            # line starts it again.
+            self.cycle = tuple(line_nos[-cycle_length:])
+            self.position = 1 % cycle_length
+            self.n_repeats = 1
+            return True
+        self.last_indexes[line_no] = self.n_lines
+        self.n_lines += 1
+        line_nos.append(line_no)
+        if len(line_nos) > 2 * MAX_CYCLE_LENGTH:
+            del line_nos[:-MAX_CYCLE_LENGTH]
+        return False
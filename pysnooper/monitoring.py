@@ -0,0 +1,223 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+`sys.monitoring` (PEP 669) backend for `Tracer`, available on Python 3.12+.
+
+Instead of a process-wide `sys.settrace` hook that is called for every line of
+every function, events are switched on only for the code objects that are
+being snooped, so the rest of the program runs at full speed. The events are
+translated to the same `(frame, event, arg)` calls that `Tracer.trace` gets
+from `sys.settrace`.
+'''
+
+import sys
+import threading
+
+monitoring = getattr(sys, 'monitoring', None)
+is_available = monitoring is not None
+
+if is_available:
+    _events = monitoring.events
+    # Events that can be switched on for a single code object:
+    LOCAL_EVENTS = (_events.PY_START | _events.PY_RESUME | _events.PY_RETURN |
+                    _events.PY_YIELD | _events.LINE | _events.JUMP)
+    # Events that can only be switched on for the whole process. They fire
+    # only when an exception is raised, so keeping them on costs nothing for
+    # code that runs normally.
+    GLOBAL_EVENTS = _events.RAISE | _events.PY_UNWIND | _events.PY_THROW
+    TOOL_IDS = (monitoring.DEBUGGER_ID, 3, 4)
+
+
+def get_instruction_lines(code):
+    '''Map the offset of each instruction in `code` to its line number.'''
+    instruction_lines = {}
+    for start, end, line_no in code.co_lines():
+        if line_no is not None:
+            for offset in range(start, end, 2):
+                instruction_lines[offset] = line_no
+    return instruction_lines
+
+
+class MonitoringDispatcher(object):
+    '''
+    Route `sys.monitoring` events to the tracers that are active.
+
+    There's a single dispatcher per process because a tool ID can only be
+    claimed once. The events of a code object are switched on while a tracer
+    that targets it is entered, on any thread, and switched off again when the
+    last one exits, so the code runs at full speed whenever it isn't snooped
+    on. Events for registered code are handed to the tracers that were entered
+    on the current thread.
+    '''
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tool_id = None
+        # How many entered tracers want the events of each code object:
+        self.code_counts = {}
+        # For each of those, the line of each of its instructions, by offset:
+        self.code_lines = {}
+        # Codes registered by tracers with `depth > 1` as they were called,
+        # kept until the last of those tracers exits:
+        self.deep_codes = set()
+        self.n_deep_tracers = 0
+        self.thread_local = threading.local()
+
+    def _claim_tool_id(self):
+        for tool_id in TOOL_IDS:
+            try:
+                monitoring.use_tool_id(tool_id, 'pysnooper')
+            except ValueError:
+                continue
+            break
+        else:
+            raise RuntimeError("Can't use `backend='monitoring'`, all "
+                               "`sys.monitoring` tool IDs are taken.")
+        callbacks = {
+            _events.PY_START: self._on_start,
+            _events.PY_RESUME: self._on_resume,
+            _events.PY_THROW: self._on_throw,
+            _events.LINE: self._on_line,
+            _events.JUMP: self._on_jump,
+            _events.PY_RETURN: self._on_return,
+            _events.PY_YIELD: self._on_return,
+            _events.PY_UNWIND: self._on_unwind,
+            _events.RAISE: self._on_raise,
+        }
+        for event, callback in callbacks.items():
+            monitoring.register_callback(tool_id, event, callback)
+        monitoring.set_events(tool_id, GLOBAL_EVENTS)
+        self.tool_id = tool_id
+
+    def _get_global_events(self):
+        if self.n_deep_tracers:
+            return GLOBAL_EVENTS | _events.PY_START
+        return GLOBAL_EVENTS
+
+    def add_code(self, code):
+        with self.lock:
+            n_tracers = self.code_counts.get(code, 0)
+            self.code_counts[code] = n_tracers + 1
+            if not n_tracers:
+                self.code_lines[code] = get_instruction_lines(code)
+                monitoring.set_local_events(self.tool_id, code, LOCAL_EVENTS)
+
+    def remove_code(self, code):
+        with self.lock:
+            n_tracers = self.code_counts.pop(code) - 1
+            if n_tracers:
+                self.code_counts[code] = n_tracers
+            else:
+                del self.code_lines[code]
+                monitoring.set_local_events(self.tool_id, code, 0)
+
+    def enter(self, tracer, frame):
+        codes = list(tracer.target_codes)
+        if id(frame) in tracer.target_frame_ids:
+            codes.append(frame.f_code)
+        with self.lock:
+            if self.tool_id is None:
+                self._claim_tool_id()
+            for code in codes:
+                self.add_code(code)
+            if tracer.depth > 1:
+                self.n_deep_tracers += 1
+                if self.n_deep_tracers == 1:
+                    monitoring.set_events(self.tool_id,
+                                          self._get_global_events())
+        tracers = self.thread_local.__dict__.setdefault('tracers', {})
+        tracers[tracer] = tracers.get(tracer, 0) + 1
+        # Tracers are entered and exited like a stack on each thread, so
+        # `exit` knows which codes this one registered:
+        self.thread_local.__dict__.setdefault('entered_codes',
+                                              []).append(codes)
+
+    def exit(self, tracer):
+        tracers = self.thread_local.tracers
+        tracers[tracer] -= 1
+        if not tracers[tracer]:
+            del tracers[tracer]
+        codes = self.thread_local.entered_codes.pop()
+        with self.lock:
+            for code in codes:
+                self.remove_code(code)
+            if tracer.depth > 1:
+                self.n_deep_tracers -= 1
+                if not self.n_deep_tracers:
+                    monitoring.set_events(self.tool_id,
+                                          self._get_global_events())
+                    for code in self.deep_codes:
+                        self.remove_code(code)
+                    self.deep_codes.clear()
+
+    def _dispatch(self, frame, event, arg):
+        tracers = self.thread_local.__dict__.get('tracers')
+        if not tracers:
+            return None
+        for tracer in tuple(tracers):
+            tracer.trace(frame, event, arg)
+
+    def _on_start(self, code, instruction_offset):
+        if code in self.code_counts:
+            return self._dispatch(sys._getframe(1), 'call', None)
+        # We only get here when a tracer with `depth > 1` switched `PY_START`
+        # on globally. If any tracer wants this frame, start monitoring its
+        # code too. We can't return `DISABLE` otherwise, because the same code
+        # might be called within the depth limit later.
+        tracers = self.thread_local.__dict__.get('tracers')
+        if not tracers:
+            return None
+        frame = sys._getframe(1)
+        for tracer in tuple(tracers):
+            if tracer.depth > 1 and \
+                               tracer.trace(frame, 'call', None) is not None:
+                with self.lock:
+                    if code not in self.deep_codes:
+                        self.deep_codes.add(code)
+                        self.add_code(code)
+
+    def _on_resume(self, code, instruction_offset):
+        if code not in self.code_counts:
+            return None
+        return self._dispatch(sys._getframe(1), 'call', None)
+
+    def _on_throw(self, code, instruction_offset, exception):
+        if code in self.code_counts:
+            self._dispatch(sys._getframe(1), 'call', None)
+
+    def _on_line(self, code, line_number):
+        if code not in self.code_counts:
+            return None
+        return self._dispatch(sys._getframe(1), 'line', None)
+
+    def _on_jump(self, code, instruction_offset, destination_offset):
+        # `LINE` only fires when the line changes, so a loop that fits on one
+        # line would show up as a single line. Like `sys.settrace`, we count a
+        # jump back to the start of the same line as the line running again.
+        if destination_offset > instruction_offset:
+            return monitoring.DISABLE
+        code_lines = self.code_lines.get(code)
+        if code_lines is None:
+            return None
+        line_no = code_lines.get(destination_offset)
+        if line_no is None or \
+                         line_no != code_lines.get(instruction_offset):
+            return None
+        return self._dispatch(sys._getframe(1), 'line', None)
+
+    def _on_return(self, code, instruction_offset, retval):
+        if code not in self.code_counts:
+            return None
+        return self._dispatch(sys._getframe(1), 'return', retval)
+
+    def _on_unwind(self, code, instruction_offset, exception):
+        if code in self.code_counts:
+            self._dispatch(sys._getframe(1), 'return', None)
+
+    def _on_raise(self, code, instruction_offset, exception):
+        if code in self.code_counts:
+            self._dispatch(sys._getframe(1), 'exception',
+                           (type(exception), exception,
+                            exception.__traceback__))
+
+
+dispatcher = MonitoringDispatcher() if is_available else None
@@ -0,0 +1,102 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Line profiling, for `snoop(profile=True)`.
+
+Instead of writing a line of output for each line that runs, the tracer counts
+the hits of each line and adds up the wall and CPU time spent on it, and
+`Tracer.write_profile` writes a table of it all, in the style of
+`line_profiler`.
+'''
+
+import array
+import dis
+
+
+def get_last_line_no(code):
+    line_nos = [line_no for _, line_no in dis.findlinestarts(code)
+                if line_no is not None]
+    return max(line_nos) if line_nos else code.co_firstlineno
+
+
+class CodeProfile(object):
+    '''
+    The hits and times of the lines of one code object.
+
+    These are kept in arrays indexed by the line's offset from the first line
+    of the code, so counting a hit doesn't allocate anything.
+    '''
+    def __init__(self, code, source_path, source):
+        self.code = code
+        self.source_path = source_path
+        self.source = source
+        self.first_line_no = code.co_firstlineno
+        n_lines = get_last_line_no(code) - self.first_line_no + 1
+        self.hits = array.array('L', [0] * n_lines)
+        self.wall_times = array.array('d', [0.0] * n_lines)
+        self.cpu_times = array.array('d', [0.0] * n_lines)
+
+    def _grow(self, n_lines):
+        n_new_lines = n_lines - len(self.hits)
+        self.hits.extend([0] * n_new_lines)
+        self.wall_times.extend([0.0] * n_new_lines)
+        self.cpu_times.extend([0.0] * n_new_lines)
+
+    def add_hit(self, line_no):
+        index = line_no - self.first_line_no
+        if index >= len(self.hits):
+            self._grow(index + 1)
+        self.hits[index] += 1
+
+    def add_time(self, line_no, wall_time, cpu_time):
+        index = line_no - self.first_line_no
+        if index >= len(self.hits):
+            self._grow(index + 1)
+        self.wall_times[index] += wall_time
+        self.cpu_times[index] += cpu_time
+
+
+# For the header, and for lines that never ran:
+TEXT_ROW_TEMPLATE = u'{:>6} {:>9} {:>12} {:>8} {:>8} {:>12}  {}'
+ROW_TEMPLATE = u'{:>6} {:>9} {:>12.1f} {:>8.1f} {:>8.1f} {:>12.1f}  {}'
+
+
+def iter_report_lines(code_profiles):
+    '''
+    Yield the lines of a `line_profiler` style table for `code_profiles`.
+
+    Times are in microseconds; the CPU time is the time the thread spent
+    running rather than waiting.
+    '''
+    yield u'Timer unit: 1e-06 s'
+    for code_profile in sorted(code_profiles,
+                               key=lambda code_profile: (
+                                   code_profile.source_path,
+                                   code_profile.first_line_no
+                               )):
+        total_wall_time = sum(code_profile.wall_times)
+        yield u''
+        yield u'Total time: {:g} s'.format(total_wall_time / 1e9)
+        yield u'File: {}'.format(code_profile.source_path)
+        yield u'Function: {} at line {}'.format(code_profile.code.co_name,
+                                                code_profile.first_line_no)
+        yield u''
+        header = TEXT_ROW_TEMPLATE.format(u'Line #', u'Hits', u'Time',
+                                          u'Per Hit', u'% Time', u'CPU Time',
+                                          u'Line Contents')
+        yield header
+        yield u'=' * len(header)
+        for index, hits in enumerate(code_profile.hits):
+            line_no = code_profile.first_line_no + index
+            source_line = code_profile.source[line_no - 1]
+            if hits or code_profile.wall_times[index]:
+                wall_time = code_profile.wall_times[index] / 1e3
+                yield ROW_TEMPLATE.format(
+                    line_no, hits, wall_time, wall_time / max(hits, 1),
+                    100 * code_profile.wall_times[index] /
+                                                     (total_wall_time or 1),
+                    code_profile.cpu_times[index] / 1e3, source_line
+                )
+            else:
+                yield TEXT_ROW_TEMPLATE.format(line_no, u'', u'', u'', u'', u'',
+                                               source_line)
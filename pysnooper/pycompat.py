@@ -6,6 +6,7 @@ import abc
 import os
 import inspect
 import sys
+import time
 import datetime as datetime_module
 
 PY3 = (sys.version_info[0] == 3)
@@ -58,10 +59,12 @@ if PY3:
     string_types = (str,)
     text_type = str
     binary_type = bytes
+    integer_types = (int,)
 else:
     string_types = (basestring,)
     text_type = unicode
     binary_type = str
+    integer_types = (int, long)
 
 
 try:
@@ -69,6 +72,11 @@ try:
 except ImportError: # Python 2.7
     import collections as collections_abc
 
+try:
+    from threading import get_ident as get_thread_ident
+except ImportError: # Python 2.7
+    from thread import get_ident as get_thread_ident
+
 if sys.version_info[:2] >= (3, 6):
     time_isoformat = datetime_module.time.isoformat
 else:
@@ -83,6 +91,28 @@ else:
         return result
 
 
+try:
+    time_ns = time.time_ns
+    perf_counter_ns = time.perf_counter_ns
+except AttributeError: # Python < 3.7
+    def time_ns():
+        return int(time.time() * 10 ** 9)
+
+    _perf_counter = getattr(time, 'perf_counter', time.time)
+
+    def perf_counter_ns():
+        return int(_perf_counter() * 10 ** 9)
+
+try:
+    thread_time_ns = time.thread_time_ns
+except AttributeError: # Python < 3.7, or no per-thread clock on this platform
+    _thread_time = getattr(time, 'thread_time', None) or \
+                          getattr(time, 'process_time', None) or time.clock
+
+    def thread_time_ns():
+        return int(_thread_time() * 10 ** 9)
+
+
 def timedelta_format(timedelta):
     time = (datetime_module.datetime.min + timedelta).time()
     return time_isoformat(time, timespec='microseconds')
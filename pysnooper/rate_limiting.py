@@ -0,0 +1,84 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+A ceiling on how fast snoop lines are written, for `snoop(rate_limit=...)`.
+
+Events past the ceiling are dropped whole, before anything about them is
+formatted, and every so often a line says how many were dropped. Tracers that
+are given the same `rate_limit` number share a ceiling for the whole process,
+and tracers that are given the same `RateLimiter` share its ceiling.
+'''
+
+import threading
+
+from . import pycompat
+
+
+class RateLimiter(object):
+    '''
+    A token bucket of `burst` tokens that refills at `rate` tokens a second.
+
+    Each event takes a token, and is dropped if there's none left. `burst`
+    defaults to a second's worth of tokens.
+
+    Rather than the number of tokens, we keep the time at which the bucket
+    will be full again, as in the generic cell rate algorithm, so taking a
+    token is a read of the clock, a comparison and an assignment. That's cheap
+    enough to do on every event without a lock. Threads that race each other
+    may let a few more events through, or count a few fewer drops, than they
+    should, which is fine for a limit like this.
+    '''
+    def __init__(self, rate, burst=None, report_interval=1):
+        if rate <= 0:
+            raise ValueError('The rate limit must be positive.')
+        if burst is None:
+            burst = max(rate, 1)
+        elif burst < 1:
+            raise ValueError('`burst` must be at least 1.')
+        self.rate = rate
+        self.burst = burst
+        # In nanoseconds, like `pycompat.perf_counter_ns`:
+        self.token_interval = 1e9 / rate
+        self.max_refill_time = self.token_interval * burst
+        self.report_interval = int(report_interval * 1e9)
+        self.full_time = 0
+        self.n_dropped = 0
+        self.n_reported = 0
+        self.next_report_time = 0
+
+    def try_acquire(self):
+        '''Take a token, and return whether there was one to take.'''
+        now = pycompat.perf_counter_ns()
+        full_time = max(self.full_time, now) + self.token_interval
+        if full_time - now > self.max_refill_time:
+            self.n_dropped += 1
+            return False
+        self.full_time = full_time
+        return True
+
+    def pop_n_dropped(self, force=False):
+        '''
+        Get the number of events dropped since the last report, if it's time
+        for another one, or 0 if it isn't.
+        '''
+        now = pycompat.perf_counter_ns()
+        if now < self.next_report_time and not force:
+            return 0
+        self.next_report_time = now + self.report_interval
+        n_dropped = self.n_dropped
+        n_unreported = n_dropped - self.n_reported
+        self.n_reported = n_dropped
+        return n_unreported
+
+
+shared_rate_limiters = {}
+shared_rate_limiters_lock = threading.Lock()
+
+
+def get_shared_rate_limiter(rate):
+    '''Get the process-wide rate limiter for `rate`, making it if needed.'''
+    with shared_rate_limiters_lock:
+        rate_limiter = shared_rate_limiters.get(rate)
+        if rate_limiter is None:
+            rate_limiter = shared_rate_limiters[rate] = RateLimiter(rate)
+        return rate_limiter
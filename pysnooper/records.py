@@ -0,0 +1,124 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Trace records, for output formats other than text.
+
+`RecordFormatter` stands in for `templates.TextTemplates`. Instead of a line of
+text, each of its methods returns a record: a tuple of
+
+    (kind, thread, depth, *values)
+
+where `thread` is an `(ident, name)` pair, or `None` for records that aren't
+about any thread. The records go through the same writers as lines of text,
+until a sink turns them into the actual output.
+'''
+
+import threading
+
+# The values that follow `(kind, thread, depth)` in each kind of record:
+RECORD_FIELDS = {
+    'source_path': ('source_path',),
+    'var': ('stage', 'name', 'value_repr'),
+    'event': ('timestamp', 'thread_info', 'event', 'line_no', 'source_line',
+              'source_path', 'function_name'),
+    'call_ended_by_exception': ('timestamp', 'thread_info', 'line_no',
+                                'source_line', 'source_path',
+                                'function_name'),
+    'return_value': ('return_value_repr',),
+    'exception': ('exception',),
+    'skipped_calls': ('n_skipped_calls',),
+    'elapsed_time': ('elapsed_time',),
+    'repeated_lines': ('line_nos', 'n_repeats', 'last_values'),
+    'dropped_lines': ('n_dropped',),
+    'rate_limited': ('n_dropped',),
+    'suppressed_lines': ('n_suppressed',),
+    'output_limit_reached': ('max_lines_total',),
+    'custom_line': ('s',),
+}
+
+VAR_STAGES = ('starting', 'new', 'modified')
+
+
+def get_thread():
+    current_thread = threading.current_thread()
+    return (current_thread.ident, current_thread.name)
+
+
+def get_depth(indent):
+    return len(indent) // 4
+
+
+def keep_microseconds(microseconds):
+    '''Records keep timestamps and durations as integers of microseconds.'''
+    return microseconds
+
+
+class RecordFormatter(object):
+    '''
+    Make records rather than lines of text.
+
+    Timestamps and elapsed times are given to us as integers of microseconds,
+    or `None` for normalized output.
+    '''
+    def source_path(self, indent, source_path):
+        return ('source_path', get_thread(), get_depth(indent), source_path)
+
+    def starting_var(self, indent, name, value_repr):
+        return ('var', get_thread(), get_depth(indent), 'starting', name,
+                value_repr)
+
+    def new_var(self, indent, name, value_repr):
+        return ('var', get_thread(), get_depth(indent), 'new', name,
+                value_repr)
+
+    def modified_var(self, indent, name, value_repr):
+        return ('var', get_thread(), get_depth(indent), 'modified', name,
+                value_repr)
+
+    def event(self, indent, timestamp, thread_info, event, line_no,
+              source_line, source_path, function_name):
+        return ('event', get_thread(), get_depth(indent), timestamp,
+                thread_info, event, line_no, source_line, source_path,
+                function_name)
+
+    def call_ended_by_exception(self, indent, timestamp, thread_info, event,
+                                line_no, source_line, source_path,
+                                function_name):
+        return ('call_ended_by_exception', get_thread(), get_depth(indent),
+                timestamp, thread_info, line_no, source_line, source_path,
+                function_name)
+
+    def return_value(self, indent, return_value_repr):
+        return ('return_value', get_thread(), get_depth(indent),
+                return_value_repr)
+
+    def exception(self, indent, exception):
+        return ('exception', get_thread(), get_depth(indent), exception)
+
+    def skipped_calls(self, indent, n_skipped_calls):
+        return ('skipped_calls', get_thread(), get_depth(indent),
+                n_skipped_calls)
+
+    def elapsed_time(self, indent, elapsed_time_string):
+        return ('elapsed_time', get_thread(), get_depth(indent),
+                elapsed_time_string)
+
+    def repeated_lines(self, indent, line_nos, n_repeats, last_values):
+        return ('repeated_lines', get_thread(), get_depth(indent), line_nos,
+                n_repeats, last_values)
+
+    def dropped_lines(self, n_dropped):
+        return ('dropped_lines', None, 0, n_dropped)
+
+    def rate_limited(self, n_dropped):
+        return ('rate_limited', None, 0, n_dropped)
+
+    def suppressed_lines(self, indent, n_suppressed):
+        return ('suppressed_lines', get_thread(), get_depth(indent),
+                n_suppressed)
+
+    def output_limit_reached(self, max_lines_total):
+        return ('output_limit_reached', None, 0, max_lines_total)
+
+    def custom_line(self, s):
+        return ('custom_line', get_thread(), 0, s)
@@ -0,0 +1,109 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Templates of the lines in PySnooper's text output.
+
+`Tracer` uses these to write its output, and `python -m pysnooper render`
+uses them to turn a binary trace back into the same text.
+'''
+
+COLORS = {
+    '_FOREGROUND_BLUE': '\x1b[34m',
+    '_FOREGROUND_CYAN': '\x1b[36m',
+    '_FOREGROUND_GREEN': '\x1b[32m',
+    '_FOREGROUND_MAGENTA': '\x1b[35m',
+    '_FOREGROUND_RED': '\x1b[31m',
+    '_FOREGROUND_RESET': '\x1b[39m',
+    '_FOREGROUND_YELLOW': '\x1b[33m',
+    '_STYLE_BRIGHT': '\x1b[1m',
+    '_STYLE_DIM': '\x1b[2m',
+    '_STYLE_NORMAL': '\x1b[22m',
+    '_STYLE_RESET_ALL': '\x1b[0m',
+}
+
+NO_COLORS = dict((name, '') for name in COLORS)
+
+
+class TextTemplates(object):
+    '''
+    The output line templates, with the prefix and the colors baked in.
+
+    This is done once rather than on every event, so each line only needs the
+    fields that actually change from line to line filled in. Each template is
+    a `str.format` method, so it ignores fields it doesn't show.
+    '''
+    def __init__(self, prefix='', color=False):
+        colors = COLORS if color else NO_COLORS
+        escaped_prefix = prefix.replace('{', '{{').replace('}', '}}')
+
+        def compile_template(template):
+            return (escaped_prefix + template.format(**colors) + u'\n').format
+
+        self.source_path = compile_template(
+            u'{_FOREGROUND_YELLOW}{_STYLE_DIM}{{indent}}Source path:... '
+            u'{_STYLE_NORMAL}{{source_path}}{_STYLE_RESET_ALL}'
+        )
+        self.starting_var, self.new_var, self.modified_var = [
+            compile_template(
+                u'{{indent}}{_FOREGROUND_GREEN}{_STYLE_DIM}' + stage_string +
+                u'{_STYLE_NORMAL}{{name}} = {{value_repr}}{_STYLE_RESET_ALL}'
+            ) for stage_string in (u'Starting var:.. ', u'New var:....... ',
+                                   u'Modified var:.. ')
+        ]
+        self.event = compile_template(
+            u'{{indent}}{_STYLE_DIM}{{timestamp}} {{thread_info}}{{event:9}} '
+            u'{{line_no:4}}{_STYLE_RESET_ALL} {{source_line}}'
+        )
+        self.call_ended_by_exception = compile_template(
+            u'{_FOREGROUND_RED}{{indent}}Call ended by exception'
+            u'{_STYLE_RESET_ALL}'
+        )
+        self.return_value = compile_template(
+            u'{{indent}}{_FOREGROUND_CYAN}{_STYLE_DIM}Return value:.. '
+            u'{_STYLE_NORMAL}{{return_value_repr}}{_STYLE_RESET_ALL}'
+        )
+        self.exception = compile_template(
+            u'{{indent}}{_FOREGROUND_RED}Exception:..... '
+            u'{_STYLE_BRIGHT}{{exception}}{_STYLE_RESET_ALL}'
+        )
+        self.skipped_calls = compile_template(
+            u'{{indent}}{_FOREGROUND_YELLOW}{_STYLE_DIM}Skipped by sampling: '
+            u'{_STYLE_NORMAL}{{n_skipped_calls}} calls{_STYLE_RESET_ALL}'
+        )
+        self.elapsed_time = compile_template(
+            u'{{indent}}{_FOREGROUND_YELLOW}{_STYLE_DIM}Elapsed time: '
+            u'{_STYLE_NORMAL}{{elapsed_time_string}}{_STYLE_RESET_ALL}'
+        )
+        repeated_lines = compile_template(
+            u'{{indent}}{_FOREGROUND_YELLOW}{_STYLE_DIM}Lines {{line_nos}} '
+            u'repeated {{n_repeats:,}} times{{last_values}}{_STYLE_RESET_ALL}'
+        )
+        last_values_prefix = u'; last values: {_STYLE_NORMAL}'.format(**colors)
+
+        def format_repeated_lines(indent, line_nos, n_repeats, last_values,
+                                  **kwargs):
+            return repeated_lines(
+                indent=indent, line_nos=line_nos, n_repeats=n_repeats,
+                last_values=(last_values_prefix + u', '.join(
+                    u'{} = {}'.format(name, value_repr)
+                    for name, value_repr in last_values
+                ) if last_values else u'')
+            )
+        self.repeated_lines = format_repeated_lines
+        self.dropped_lines = compile_template(
+            u'... {{n_dropped}} lines dropped'
+        )
+        self.rate_limited = compile_template(
+            u'{_FOREGROUND_YELLOW}{_STYLE_DIM}... {{n_dropped:,}} events '
+            u'dropped by rate_limit{_STYLE_RESET_ALL}'
+        )
+        self.suppressed_lines = compile_template(
+            u'{{indent}}{_FOREGROUND_YELLOW}{_STYLE_DIM}... '
+            u'{{n_suppressed:,}} lines suppressed{_STYLE_RESET_ALL}'
+        )
+        self.output_limit_reached = compile_template(
+            u'{_FOREGROUND_YELLOW}{_STYLE_DIM}... Reached '
+            u'max_lines_total={{max_lines_total:,}}, suppressing the rest of '
+            u'the output{_STYLE_RESET_ALL}'
+        )
+        self.custom_line = compile_template(u'{{s}}')
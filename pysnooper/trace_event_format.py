@@ -0,0 +1,257 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Traces in the Chrome trace_event format, for timeline viewers.
+
+With `snoop(format='trace_event')`, every snooped call becomes a complete
+(`"ph": "X"`) event with its start time and duration, so the trace can be
+opened in `chrome://tracing` or https://ui.perfetto.dev and calls made within
+`depth` show up nested under their callers. The args of each call are the
+variables it started with, the last value of each variable that changed during
+it, and its return value or exception. Exceptions, lines written with
+`Tracer.write` and the summaries of compressed loops are instant (`"ph": "i"`)
+events. A snooped `with` block is a complete event too, named after the
+function it's in.
+
+The output is in the JSON Array Format, which the viewers accept without the
+closing `]`, so events can be written as they happen, and more can be appended
+to the file later.
+'''
+
+import json
+import os
+import threading
+
+
+THREAD_STATES_MIN_SWEEP_SIZE = 100
+
+
+class OpenCall(object):
+    '''A snooped call on some thread that hasn't returned yet.'''
+    __slots__ = ('depth', 'start_time', 'name', 'file', 'line_no',
+                 'starting_vars', 'changed_vars', 'end_time',
+                 'ended_by_exception')
+
+    def __init__(self, depth, start_time, name, file, line_no, starting_vars):
+        self.depth = depth
+        self.start_time = start_time
+        self.name = name
+        self.file = file
+        self.line_no = line_no
+        self.starting_vars = starting_vars
+        self.changed_vars = {}
+        self.end_time = None
+        self.ended_by_exception = False
+
+
+class ThreadState(object):
+    __slots__ = ('open_calls', 'open_blocks', 'pending_vars', 'returned_call',
+                 'is_call_ended')
+
+    def __init__(self):
+        self.open_calls = []
+        # Snooped `with` blocks, that have lines but no call, by depth:
+        self.open_blocks = {}
+        self.pending_vars = {}
+        # A call that returned, and is waiting for its return value:
+        self.returned_call = None
+        # Whether the last event ended a call, so that an elapsed time that
+        # comes next is that call's, rather than a `with` block's:
+        self.is_call_ended = False
+
+
+class TraceEventSink(object):
+    '''
+    Turn records into trace events, and hand them to `write` as text.
+
+    Events are written when a call returns, so callees come before their
+    callers in the output. The viewers sort them by time anyway.
+
+    With `is_continued=True`, the output already has events in it, so the
+    array isn't opened again.
+    '''
+    def __init__(self, write, is_continued=False):
+        self.inner_write = write
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.thread_states = {}
+        self.thread_states_sweep_size = THREAD_STATES_MIN_SWEEP_SIZE
+        # For instant events, whose records don't have a time of their own:
+        self.last_time = 0
+        self.is_started = is_continued
+
+    def write(self, record):
+        kind, thread = record[:2]
+        with self.lock:
+            if kind == 'dropped_lines':
+                self._write_instant_event(
+                    '{} lines dropped'.format(record[3]), scope='p'
+                )
+                return
+            elif kind == 'rate_limited':
+                self._write_instant_event(
+                    '{:,} events dropped by rate_limit'.format(record[3]),
+                    scope='p'
+                )
+                return
+            elif kind == 'output_limit_reached':
+                self._write_instant_event(
+                    'Reached max_lines_total={:,}'.format(record[3]),
+                    scope='p'
+                )
+                return
+            thread_state = self.thread_states.get(thread)
+            if thread_state is None:
+                if len(self.thread_states) >= self.thread_states_sweep_size:
+                    self._sweep_thread_states()
+                thread_state = self.thread_states[thread] = ThreadState()
+                self._write_event(dict(name='thread_name', ph='M',
+                                       tid=thread[0],
+                                       args=dict(name=thread[1])))
+            if kind != 'return_value' and \
+                                     thread_state.returned_call is not None:
+                # Whatever came after the return, its return value didn't.
+                self._write_call(thread, thread_state.returned_call)
+                thread_state.returned_call = None
+
+            if kind == 'var':
+                _, _, _, _, name, value_repr = record
+                thread_state.pending_vars[name] = value_repr
+            elif kind == 'event':
+                (_, _, depth, timestamp, _, event, line_no, _, source_path,
+                                                        function_name) = record
+                self.last_time = timestamp
+                pending_vars = thread_state.pending_vars
+                thread_state.pending_vars = {}
+                thread_state.is_call_ended = False
+                if event == 'call':
+                    thread_state.open_calls.append(OpenCall(
+                        depth, timestamp, function_name, source_path, line_no,
+                        pending_vars
+                    ))
+                    return
+                open_call = self._find_open_call(thread_state, depth)
+                if open_call is None:
+                    # A line of a `with` block, that has no call of its own.
+                    open_call = thread_state.open_blocks.get(depth)
+                    if open_call is None:
+                        thread_state.open_blocks[depth] = OpenCall(
+                            depth, timestamp, function_name, source_path,
+                            line_no, pending_vars
+                        )
+                        return
+                open_call.changed_vars.update(pending_vars)
+                if event == 'return' and open_call in thread_state.open_calls:
+                    self._pop_open_call(thread_state, open_call)
+                    open_call.end_time = timestamp
+                    thread_state.returned_call = open_call
+                    thread_state.is_call_ended = True
+            elif kind == 'call_ended_by_exception':
+                depth, timestamp = record[2:4]
+                self.last_time = timestamp
+                open_call = self._find_open_call(thread_state, depth)
+                if open_call is not None:
+                    open_call.changed_vars.update(thread_state.pending_vars)
+                    self._pop_open_call(thread_state, open_call)
+                    open_call.end_time = timestamp
+                    open_call.ended_by_exception = True
+                    self._write_call(thread, open_call)
+                thread_state.pending_vars = {}
+                thread_state.is_call_ended = True
+            elif kind == 'elapsed_time':
+                # The elapsed time of the innermost `with` block, unless it's
+                # a snooped call's. Blocks that are nested in calls have their
+                # elapsed time one level deeper than their lines, so we don't
+                # go by depth.
+                open_block = None
+                if thread_state.is_call_ended:
+                    thread_state.is_call_ended = False
+                elif thread_state.open_blocks:
+                    open_block = thread_state.open_blocks.pop(
+                        max(thread_state.open_blocks)
+                    )
+                if open_block is not None:
+                    open_block.end_time = \
+                                        open_block.start_time + record[3]
+                    open_block.changed_vars.update(thread_state.pending_vars)
+                    thread_state.pending_vars = {}
+                    self._write_call(thread, open_block, is_block=True)
+            elif kind == 'return_value':
+                returned_call = thread_state.returned_call
+                if returned_call is not None:
+                    thread_state.returned_call = None
+                    self._write_call(thread, returned_call,
+                                     return_value=record[3])
+            elif kind == 'exception' or kind == 'custom_line':
+                self._write_instant_event(record[3], tid=thread[0])
+            elif kind == 'repeated_lines':
+                _, _, depth, line_nos, n_repeats, last_values = record
+                last_values = dict(last_values)
+                open_call = self._find_open_call(thread_state, depth)
+                if open_call is not None:
+                    open_call.changed_vars.update(last_values)
+                self._write_instant_event(
+                    'Lines {} repeated {:,} times'.format(line_nos, n_repeats),
+                    tid=thread[0], args=dict(last_values=last_values)
+                )
+            elif kind == 'suppressed_lines':
+                self._write_instant_event(
+                    '{:,} lines suppressed'.format(record[3]), tid=thread[0]
+                )
+            elif kind == 'skipped_calls':
+                self._write_instant_event(
+                    'Skipped by sampling: {} calls'.format(record[3]),
+                    tid=thread[0]
+                )
+
+    def _sweep_thread_states(self):
+        '''Forget the threads that ended, so thread churn doesn't add up.'''
+        # Idents are reused by new threads, so we go by the name too.
+        live_threads = set((thread.ident, thread.name)
+                           for thread in threading.enumerate())
+        for thread, thread_state in tuple(self.thread_states.items()):
+            if thread not in live_threads:
+                if thread_state.returned_call is not None:
+                    self._write_call(thread, thread_state.returned_call)
+                del self.thread_states[thread]
+        self.thread_states_sweep_size = max(THREAD_STATES_MIN_SWEEP_SIZE,
+                                            2 * len(self.thread_states))
+
+    def _find_open_call(self, thread_state, depth):
+        for open_call in reversed(thread_state.open_calls):
+            if open_call.depth == depth:
+                return open_call
+            elif open_call.depth < depth:
+                return None
+        return None
+
+    def _pop_open_call(self, thread_state, open_call):
+        # Calls deeper than this one whose return we missed, like because
+        # their lines were dropped, end here too.
+        while thread_state.open_calls.pop() is not open_call:
+            pass
+
+    def _write_call(self, thread, open_call, return_value=None,
+                    is_block=False):
+        args = dict(starting_vars=open_call.starting_vars,
+                    changed_vars=open_call.changed_vars,
+                    file=open_call.file, line=open_call.line_no)
+        if open_call.ended_by_exception:
+            args['ended_by_exception'] = True
+        elif not is_block:
+            args['return_value'] = return_value
+        self._write_event(dict(
+            name=open_call.name, cat='pysnooper', ph='X', tid=thread[0],
+            ts=open_call.start_time,
+            dur=open_call.end_time - open_call.start_time, args=args
+        ))
+
+    def _write_instant_event(self, name, scope='t', **fields):
+        self._write_event(dict(name=name, ph='i', s=scope, ts=self.last_time,
+                               **fields))
+
+    def _write_event(self, event):
+        event['pid'] = self.pid
+        separator = u',\n' if self.is_started else u'[\n'
+        self.is_started = True
+        self.inner_write(separator + json.dumps(event, ensure_ascii=False))
@@ -1,27 +1,49 @@
 # Copyright 2019 Ram Rachum and collaborators.
 # This program is distributed under the MIT license.
 
+import array
+import codecs
 import functools
 import inspect
 import opcode
+import operator
 import os
 import sys
 import re
 import collections
-import datetime as datetime_module
 import itertools
 import threading
+import tokenize
 import traceback
+import atexit
+import signal
+import time
+import weakref
+import random
 
 from .variables import CommonVariable, Exploding, BaseVariable
-from . import utils, pycompat
+from . import (utils, pycompat, monitoring, templates, records,
+               binary_format, jsonl_format, trace_event_format, profiling,
+               histograms, loops, rate_limiting)
 if pycompat.PY2:
     from io import open
 
+try:
+    import mmap
+except ImportError: # Some platforms, like IronPython
+    mmap = None
+
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError: # Python 2
+    SourceFileLoader = None
+
 
 ipython_filename_pattern = re.compile('^<ipython-input-([0-9]+)-.*>$')
 ansible_filename_pattern = re.compile(r'^(.+\.zip)[/|\\](ansible[/|\\]modules[/|\\].+\.py)$')
 ipykernel_filename_pattern = re.compile(r'^/var/folders/.*/ipykernel_[0-9]+/[0-9]+.py$')
+IS_WORDCODE = sys.version_info[:2] >= (3, 6)
+YIELD_OPCODES = {'YIELD_VALUE', 'YIELD_FROM', 'INSTRUMENTED_YIELD_VALUE'}
 RETURN_OPCODES = {
     'RETURN_GENERATOR', 'RETURN_VALUE', 'RETURN_CONST',
     'INSTRUMENTED_RETURN_GENERATOR', 'INSTRUMENTED_RETURN_VALUE',
@@ -29,6 +51,91 @@ RETURN_OPCODES = {
 }
 
 
+class CodeCache(dict):
+    '''
+    Things we work out from code objects, kept while the code objects live.
+
+    Entries are keyed by the `id` of their code object, so a lookup is a
+    plain dict access. A weakref to the code object drops its entry when the
+    code object is garbage collected, so code that's compiled over and over,
+    like with `exec`, doesn't pile up in here, and an `id` is never reused
+    while it's in here.
+    '''
+    __slots__ = ('refs',)
+
+    def __init__(self):
+        dict.__init__(self)
+        self.refs = {}
+
+    def add(self, code, value):
+        code_id = id(code)
+        self.refs[code_id] = weakref.ref(
+            code, lambda ref, code_id=code_id: self._forget(code_id)
+        )
+        self[code_id] = value
+        return value
+
+    def _forget(self, code_id):
+        self.pop(code_id, None)
+        self.refs.pop(code_id, None)
+
+
+code_to_return_offsets = CodeCache()
+
+
+def get_return_offsets(code):
+    '''
+    Get the offsets of the instructions in `code` that return normally.
+
+    Computed once per code object, so telling a normal return from one caused
+    by an exception is a set lookup instead of decoding the opcode at
+    `f_lasti` on every 'return' event.
+    '''
+    try:
+        return code_to_return_offsets[id(code)]
+    except KeyError:
+        pass
+    return code_to_return_offsets.add(code, frozenset(
+        offset for offset, opname in iter_opnames(code)
+        if opname in RETURN_OPCODES
+    ))
+
+
+def iter_opnames(code):
+    '''Yield the offset and name of each instruction in `code`.'''
+    co_code = bytearray(code.co_code)
+    offset = 0
+    while offset < len(co_code):
+        code_byte = co_code[offset]
+        yield offset, opcode.opname[code_byte]
+        if IS_WORDCODE:
+            # Inline caches are `CACHE` instructions, which we just step over.
+            offset += 2
+        else:
+            offset += 3 if code_byte >= opcode.HAVE_ARGUMENT else 1
+
+
+code_to_first_yield_offset = CodeCache()
+
+
+def is_frame_starting(frame):
+    '''
+    Whether a 'call' event is for a frame that's starting to run.
+
+    The other kind of 'call' event is for a generator or coroutine resuming,
+    which can only happen after the frame ran one of its yield instructions.
+    '''
+    code = frame.f_code
+    try:
+        first_yield_offset = code_to_first_yield_offset[id(code)]
+    except KeyError:
+        first_yield_offset = code_to_first_yield_offset.add(code, min(
+            [offset for offset, opname in iter_opnames(code)
+             if opname in YIELD_OPCODES] or [float('inf')]
+        ))
+    return frame.f_lasti < first_yield_offset
+
+
 def call_ended_by_exception(frame, event, arg):
     """Whether a 'return' event was caused by an exception, not a normal return.
 
@@ -40,22 +147,122 @@ def call_ended_by_exception(frame, event, arg):
     """
     if event != 'return' or arg is not None or frame.f_lasti < 0:
         return False
-    code_byte = frame.f_code.co_code[frame.f_lasti]
-    if not isinstance(code_byte, int):
-        code_byte = ord(code_byte)
-    return opcode.opname[code_byte] not in RETURN_OPCODES
+    return frame.f_lasti not in get_return_offsets(frame.f_code)
 
 
-def get_local_reprs(frame, watch=(), custom_repr=(), max_length=None, normalize=False):
-    code = frame.f_code
-    vars_order = (code.co_varnames + code.co_cellvars + code.co_freevars +
-                  tuple(frame.f_locals.keys()))
+code_to_var_positions = CodeCache()
+
 
-    result_items = [(key, utils.get_shortish_repr(value, custom_repr,
-                                                  max_length, normalize))
-                    for key, value in frame.f_locals.items()]
-    result_items.sort(key=lambda key_value: vars_order.index(key_value[0]))
-    result = collections.OrderedDict(result_items)
+def get_var_positions(code):
+    '''
+    Map each variable name of a code object to its position in the output.
+
+    Variables are ordered like in `co_varnames`, then `co_cellvars`, then
+    `co_freevars`. The map is computed once per code object, so ordering the
+    locals of a frame doesn't need a linear search for every variable.
+    '''
+    try:
+        return code_to_var_positions[id(code)]
+    except KeyError:
+        pass
+    var_positions = {}
+    for position, name in enumerate(code.co_varnames + code.co_cellvars +
+                                    code.co_freevars):
+        var_positions.setdefault(name, position)
+    n_code_vars = (len(code.co_varnames) + len(code.co_cellvars) +
+                   len(code.co_freevars))
+    return code_to_var_positions.add(code, (var_positions, n_code_vars))
+
+
+code_to_def_line_no = CodeCache()
+
+
+def get_def_line_no(code, source):
+    '''
+    Get the number of the line where the function of `code` is defined.
+
+    A decorated function starts at its first decorator, but we want to show
+    the `def` line on the 'call' event. We find it once per code object with
+    the tokenizer, which handles `async def` and decorators that span several
+    lines.
+    '''
+    try:
+        return code_to_def_line_no[id(code)]
+    except KeyError:
+        pass
+    def_line_no = first_line_no = code.co_firstlineno
+    try:
+        is_decorated = source[first_line_no - 1].lstrip().startswith('@')
+    except IndexError:
+        is_decorated = False
+    if is_decorated:
+        def_line_no = _find_def_line_no(source, first_line_no) or first_line_no
+    return code_to_def_line_no.add(code, def_line_no)
+
+
+def _find_def_line_no(source, first_line_no):
+    line_nos = itertools.count(first_line_no)
+
+    def readline():
+        try:
+            return source[next(line_nos) - 1] + u'\n'
+        except IndexError:
+            return u''
+
+    is_statement_start = True
+    try:
+        for token_type, token_string, (row, _), _, _ in \
+                                              tokenize.generate_tokens(readline):
+            if token_type == tokenize.NEWLINE:
+                is_statement_start = True
+            elif token_type in (tokenize.NL, tokenize.COMMENT, tokenize.INDENT,
+                                tokenize.DEDENT):
+                pass
+            elif is_statement_start and token_string == 'def':
+                return first_line_no + row - 1
+            elif not (is_statement_start and token_string == 'async'):
+                is_statement_start = False
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    return None
+
+
+def get_local_reprs(frame, watch=(), custom_repr=(), max_length=None,
+                    normalize=False, repr_cache=None):
+    '''
+    Get the reprs of the frame's locals, plus those of the watched variables.
+
+    If `repr_cache` is given, it's a dict mapping names to `(value, repr)` for
+    immutable values, that's carried from one event to the next. When a
+    variable is still bound to the very same immutable object, its repr can't
+    have changed, so we reuse it rather than calling `repr` again.
+    '''
+    var_positions, n_code_vars = get_var_positions(frame.f_code)
+
+    result_items = []
+    # Names that the compiler doesn't know about (e.g. ones created with
+    # `exec` or in class bodies) go after all the others, in `f_locals` order.
+    for dynamic_position, (key, value) in enumerate(frame.f_locals.items()):
+        if repr_cache is None:
+            value_repr = utils.get_shortish_repr(value, custom_repr,
+                                                 max_length, normalize)
+        else:
+            cached_value, value_repr = repr_cache.get(key, (None, None))
+            if value_repr is None or cached_value is not value:
+                value_repr = utils.get_shortish_repr(value, custom_repr,
+                                                     max_length, normalize)
+                if utils.is_immutable(value):
+                    repr_cache[key] = (value, value_repr)
+                else:
+                    repr_cache.pop(key, None)
+        result_items.append(
+            (var_positions.get(key, n_code_vars + dynamic_position), key,
+             value_repr)
+        )
+    result_items.sort(key=operator.itemgetter(0))
+    result = collections.OrderedDict(
+        (key, value_repr) for _, key, value_repr in result_items
+    )
 
     for variable in watch:
         result.update(sorted(variable.items(frame, normalize)))
@@ -67,22 +274,303 @@ class UnavailableSource(object):
         return u'SOURCE IS UNAVAILABLE'
 
 
-source_and_path_cache = {}
+def detect_source_encoding(first_lines):
+    encoding = 'utf-8'
+    for line in first_lines:
+        # File coding may be specified. Match pattern from PEP-263
+        # (https://www.python.org/dev/peps/pep-0263/)
+        match = re.search(br'coding[:=]\s*([-\w.]+)', line)
+        if match:
+            encoding = match.group(1).decode('ascii')
+            break
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        encoding = 'utf-8'
+    return encoding
+
+
+line_break_pattern = re.compile(br'\r\n|\r|\n')
+MMAP_THRESHOLD = 1024 * 1024
+LINE_INDEX_CHUNK_SIZE = 1024 * 1024
+
+
+def iter_line_ends(data):
+    '''Iterate on the offsets right after each line break in `data`.'''
+    if data.find(b'\r') != -1 or pycompat.PY2:
+        return (match.end() for match in line_break_pattern.finditer(data))
+    # The common case, only `\n` line breaks. Splitting a chunk at a time and
+    # adding up the line lengths runs in C, which is much faster than matching
+    # each line break.
+    return itertools.chain.from_iterable(
+        _iter_chunk_line_ends(data, chunk_start) for chunk_start in
+                                 range(0, len(data), LINE_INDEX_CHUNK_SIZE)
+    )
+
+
+def _iter_chunk_line_ends(data, chunk_start):
+    lines = data[chunk_start:chunk_start + LINE_INDEX_CHUNK_SIZE].split(b'\n')
+    lines.pop() # The part after the last line break in this chunk
+    line_ends = itertools.accumulate(
+        itertools.chain((chunk_start,), map((1).__add__, map(len, lines)))
+    )
+    next(line_ends)
+    return line_ends
+
+
+class LazySource(object):
+    '''
+    The lines of a source file, decoded only when they're shown.
+
+    We keep the raw bytes, memory-mapped for big files, along with an array
+    of the offsets where lines start. A 100k-line generated module then costs
+    us little more than that array until we show lines from it.
+    '''
+    def __init__(self, data, file=None):
+        self.data = data
+        # The open file that `data` maps, if it's a memory map:
+        self.file = file
+        self.size = len(data)
+        first_line_start = 3 if data[:3] == codecs.BOM_UTF8 else 0
+        self.line_starts = array.array('L', [first_line_start])
+        self.line_starts.extend(iter_line_ends(data))
+        if self.line_starts[-1] != self.size or len(self.line_starts) == 1:
+            self.line_starts.append(self.size)
+        self.encoding = detect_source_encoding(
+            [self._get_raw_line(i) for i in range(min(2, len(self)))]
+        )
+        self.decoded_lines = {}
+
+    @classmethod
+    def from_file(cls, file_name):
+        '''Read `file_name`, or return `None` if it's empty.'''
+        file = open(file_name, 'rb')
+        try:
+            size = os.fstat(file.fileno()).st_size
+            if size >= MMAP_THRESHOLD and mmap is not None:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                return cls(data, file=file)
+            data = file.read()
+        except BaseException:
+            file.close()
+            raise
+        file.close()
+        return cls(data) if data else None
+
+    @property
+    def n_bytes(self):
+        '''Roughly how much memory we're using, not counting the map.'''
+        n_bytes = len(self.line_starts) * self.line_starts.itemsize
+        if self.file is None:
+            n_bytes += self.size
+        return n_bytes
+
+    def __len__(self):
+        return len(self.line_starts) - 1
+
+    def __getitem__(self, i):
+        try:
+            return self.decoded_lines[i]
+        except KeyError:
+            pass
+        n_lines = len(self)
+        if not -n_lines <= i < n_lines:
+            raise IndexError('source line index out of range')
+        if i < 0:
+            i += n_lines
+        if self.file is not None and \
+                            os.fstat(self.file.fileno()).st_size < self.size:
+            # The file was truncated after we mapped it. Reading the missing
+            # part of the map would crash the process with a `SIGBUS`.
+            return u'SOURCE IS UNAVAILABLE'
+        line = self.decoded_lines[i] = pycompat.text_type(
+            self._get_raw_line(i), self.encoding, 'replace'
+        )
+        return line
+
+    def _get_raw_line(self, i):
+        return self.data[self.line_starts[i]:self.line_starts[i + 1]] \
+                                                              .rstrip(b'\r\n')
+
+
+# What an entry costs besides its lines, so entries without any, like for code
+# that was `exec`ed, still count towards the limits:
+SOURCE_CACHE_ENTRY_OVERHEAD = 1024
+
+
+class SourceCacheEntry(object):
+    __slots__ = ('key', 'path', 'source', 'n_lines', 'n_bytes', 'file_stat',
+                 'checked_at', 'code_ids')
+
+    def __init__(self, key, path, source):
+        self.key = key
+        self.path = path
+        self.source = source
+        if isinstance(source, UnavailableSource):
+            self.n_lines = self.n_bytes = 0
+        elif isinstance(source, LazySource):
+            self.n_lines = len(source)
+            self.n_bytes = source.n_bytes
+        else:
+            self.n_lines = len(source)
+            self.n_bytes = sum(len(line) for line in source)
+        self.n_lines = max(self.n_lines, 1)
+        self.n_bytes += SOURCE_CACHE_ENTRY_OVERHEAD
+        self.file_stat = get_file_stat(path)
+        self.checked_at = monotonic()
+        self.code_ids = set()
+
+
+def get_file_stat(file_name):
+    try:
+        stat = os.stat(file_name)
+    except (TypeError,) + utils.file_reading_errors:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+class SourceCache(object):
+    '''
+    Least-recently-used cache of the source files we show lines from.
+
+    Files are evicted once all cached files hold more than `max_lines` lines
+    or take roughly more than `max_bytes` bytes in total. With `revalidate=True`, a file's mtime
+    and size are checked at most every `revalidate_interval` seconds, and the
+    file is read again if they changed, so redeployed code shows its new lines.
+
+    Each code object remembers its entry, so the usual lookup is a single dict
+    access. We key by `id`, because code objects from different files compare
+    equal when their code is the same. Like in `CodeCache`, a weakref to the
+    code object drops its key once it's gone, so we don't keep alive code that
+    was compiled on the fly.
+    '''
+    def __init__(self, max_lines=1000000, max_bytes=64 * 1024 * 1024,
+                 revalidate=False, revalidate_interval=1):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.revalidate_interval = revalidate_interval
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = collections.OrderedDict()
+            self.code_to_entry = {}
+            self.code_refs = {}
+            self.n_lines = self.n_bytes = 0
+            self.last_entry = None
+
+    def get(self, frame):
+        '''Get `(path, source)` for the code running in `frame`.'''
+        entry = self.code_to_entry.get(id(frame.f_code))
+        if entry is None or (self.revalidate and not self._is_fresh(entry)):
+            entry = self._get_uncached(frame)
+        elif entry is not self.last_entry:
+            self._touch(entry)
+        return entry.path, entry.source
+
+    def _get_uncached(self, frame):
+        code = frame.f_code
+        globs = frame.f_globals or {}
+        cache_key = (globs.get('__name__'), code.co_filename)
+        entry = self.entries.get(cache_key)
+        if entry is not None and self.revalidate and \
+                                                  not self._is_fresh(entry):
+            entry = None
+        if entry is None:
+            file_name, source = read_path_and_source_from_frame(frame)
+            entry = SourceCacheEntry(cache_key, file_name, source)
+            with self.lock:
+                self._add(entry)
+        with self.lock:
+            if self.entries.get(cache_key) is entry:
+                code_id = id(code)
+                self.code_refs[code_id] = weakref.ref(
+                    code,
+                    lambda ref, code_id=code_id: self._forget_code(code_id)
+                )
+                self.code_to_entry[code_id] = entry
+                entry.code_ids.add(code_id)
+            self._touch(entry)
+        return entry
+
+    def _is_fresh(self, entry):
+        now = monotonic()
+        if now - entry.checked_at < self.revalidate_interval:
+            return True
+        entry.checked_at = now
+        if get_file_stat(entry.path) == entry.file_stat:
+            return True
+        with self.lock:
+            if self.entries.get(entry.key) is entry:
+                del self.entries[entry.key]
+                self._forget(entry)
+        return False
+
+    def _touch(self, entry):
+        with self.lock:
+            if self.entries.get(entry.key) is entry:
+                # Moving it to the end, the most recently used position:
+                del self.entries[entry.key]
+                self.entries[entry.key] = entry
+            self.last_entry = entry
+
+    def _add(self, entry):
+        old_entry = self.entries.pop(entry.key, None)
+        if old_entry is not None:
+            self._forget(old_entry)
+        self.entries[entry.key] = entry
+        self.n_lines += entry.n_lines
+        self.n_bytes += entry.n_bytes
+        # The newest entry is always kept, even if it's bigger than the limits
+        # by itself, since it's about to be used.
+        while len(self.entries) > 1 and (self.n_lines > self.max_lines or
+                                         self.n_bytes > self.max_bytes):
+            _, evicted_entry = self.entries.popitem(last=False)
+            self._forget(evicted_entry)
+
+    def _forget(self, entry):
+        self.n_lines -= entry.n_lines
+        self.n_bytes -= entry.n_bytes
+        for code_id in tuple(entry.code_ids):
+            if self.code_to_entry.get(code_id) is entry:
+                self._forget_code(code_id)
+        entry.code_ids = set()
+        if self.last_entry is entry:
+            self.last_entry = None
+
+    def _forget_code(self, code_id):
+        # Called from the weakref callback too, so no lock, just atomic steps.
+        entry = self.code_to_entry.pop(code_id, None)
+        self.code_refs.pop(code_id, None)
+        if entry is not None:
+            entry.code_ids.discard(code_id)
+
+
+source_and_path_cache = SourceCache()
 
 
 def get_path_and_source_from_frame(frame):
+    return source_and_path_cache.get(frame)
+
+
+def read_path_and_source_from_frame(frame):
     globs = frame.f_globals or {}
     module_name = globs.get('__name__')
     file_name = frame.f_code.co_filename
-    cache_key = (module_name, file_name)
-    try:
-        return source_and_path_cache[cache_key]
-    except KeyError:
-        pass
     loader = globs.get('__loader__')
 
     source = None
-    if hasattr(loader, 'get_source'):
+    if type(loader) is SourceFileLoader and \
+                                     getattr(loader, 'path', None) == file_name:
+        # A plain source file, which we can read lazily instead of having the
+        # loader read and decode all of it.
+        try:
+            source = LazySource.from_file(file_name)
+        except utils.file_reading_errors:
+            pass
+    if source is None and hasattr(loader, 'get_source'):
         try:
             source = loader.get_source(module_name)
         except ImportError:
@@ -119,8 +607,7 @@ def get_path_and_source_from_frame(frame):
                 pass
         else:
             try:
-                with open(file_name, 'rb') as fp:
-                    source = fp.read().splitlines()
+                source = LazySource.from_file(file_name)
             except utils.file_reading_errors:
                 pass
     if not source:
@@ -132,28 +619,27 @@ def get_path_and_source_from_frame(frame):
     # apply tokenize.detect_encoding to decode the source into a
     # string, then we should do that ourselves.
     if isinstance(source[0], bytes):
-        encoding = 'utf-8'
-        for line in source[:2]:
-            # File coding may be specified. Match pattern from PEP-263
-            # (https://www.python.org/dev/peps/pep-0263/)
-            match = re.search(br'coding[:=]\s*([-\w.]+)', line)
-            if match:
-                encoding = match.group(1).decode('ascii')
-                break
+        encoding = detect_source_encoding(source[:2])
         source = [pycompat.text_type(sline, encoding, 'replace') for sline in
                   source]
 
-    result = (file_name, source)
-    source_and_path_cache[cache_key] = result
-    return result
+    return file_name, source
 
 
-def get_write_function(output, overwrite):
+def get_write_function(output, overwrite, flush='line', buffer_size=-1,
+                       flush_interval=1, binary=False):
     is_path = isinstance(output, (pycompat.PathLike, str))
     if overwrite and not is_path:
         raise Exception('`overwrite=True` can only be used when writing '
                         'content to file.')
-    if output is None:
+    if flush != 'line' and not is_path:
+        raise Exception('`flush` can only be used when writing content to '
+                        'file.')
+    if output is None and binary:
+        def write(s):
+            stderr = sys.stderr
+            getattr(stderr, 'buffer', stderr).write(s)
+    elif output is None:
         def write(s):
             stderr = sys.stderr
             try:
@@ -162,7 +648,10 @@ def get_write_function(output, overwrite):
                 # God damn Python 2
                 stderr.write(utils.shitcode(s))
     elif is_path:
-        return FileWriter(output, overwrite).write
+        return FileWriter(output, overwrite, flush=flush,
+                          buffer_size=buffer_size,
+                          flush_interval=flush_interval,
+                          binary=binary).write
     elif callable(output):
         write = output
     else:
@@ -173,16 +662,378 @@ def get_write_function(output, overwrite):
     return write
 
 
+FORMATS = ('text', 'binary', 'jsonl', 'trace_event')
+FLUSH_POLICIES = ('line', 'call', 'interval', 'exit')
+monotonic = getattr(time, 'monotonic', time.time)
+
+
 class FileWriter(object):
-    def __init__(self, path, overwrite):
+    '''
+    Write trace lines to a file, keeping it open between writes.
+
+    The file is opened on the first write and kept open, and `flush` decides
+    how often the buffer is pushed to disk:
+
+     - `'line'`: after every line, so the log can be followed with `tail -f`.
+     - `'call'`: when a snooped call or `with` block exits.
+     - `'interval'`: at most once per `flush_interval` seconds.
+     - `'exit'`: only when the buffer is full.
+
+    With any policy but `'line'`, all open writers are flushed at interpreter
+    exit and when the process is killed by `SIGTERM` or `SIGHUP`.
+
+    With `binary=True`, the file is opened in binary mode and written bytes.
+    '''
+    instances = weakref.WeakSet()
+
+    def __init__(self, path, overwrite, flush='line', buffer_size=-1,
+                 flush_interval=1, binary=False):
+        if flush not in FLUSH_POLICIES:
+            raise ValueError('`flush` must be one of {}.'.format(
+                ', '.join(map(repr, FLUSH_POLICIES))
+            ))
         self.path = pycompat.text_type(path)
         self.overwrite = overwrite
+        self.flush_policy = flush
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.binary = binary
+        self.output_file = None
+        self.last_flush_time = monotonic()
+        FileWriter.instances.add(self)
+        if flush != 'line':
+            # Only buffered lines need saving from a `SIGTERM`, so we leave
+            # the signal handlers alone otherwise.
+            _install_exit_handlers()
 
     def write(self, s):
-        with open(self.path, 'w' if self.overwrite else 'a',
-                  encoding='utf-8') as output_file:
-            output_file.write(s)
-        self.overwrite = False
+        if self.output_file is None:
+            if self.overwrite:
+                # We truncate once and then append like everyone else, since
+                # writing from where we are in a file that other writers also
+                # append to would leave holes of NUL bytes in it.
+                open(self.path, 'w').close()
+                self.overwrite = False
+            if self.binary:
+                self.output_file = open(self.path, 'ab',
+                                        buffering=self.buffer_size)
+            else:
+                self.output_file = open(self.path, 'a',
+                                        buffering=self.buffer_size,
+                                        encoding='utf-8')
+        self.output_file.write(s)
+        if self.flush_policy == 'line':
+            self.output_file.flush()
+        elif self.flush_policy == 'interval':
+            now = monotonic()
+            if now - self.last_flush_time >= self.flush_interval:
+                self.output_file.flush()
+                self.last_flush_time = now
+
+    def has_content(self):
+        '''Whether our writes will go after what's already in the file.'''
+        if self.output_file is not None:
+            return True
+        return not self.overwrite and os.path.isfile(self.path) and \
+                                               os.path.getsize(self.path) > 0
+
+    def flush(self):
+        if self.output_file is not None and not self.output_file.closed:
+            self.output_file.flush()
+            self.last_flush_time = monotonic()
+
+    def close(self):
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
+
+
+# Binary and trace_event sinks keep state about what they already wrote, like
+# the string table of a binary trace, or whether the opening `[` of a JSON
+# array is there yet, so all the tracers that write to the same destination in
+# one of those formats have to go through the same sink.
+shared_sinks = weakref.WeakValueDictionary()
+shared_sinks_lock = threading.Lock()
+
+
+def get_shared_sink(output, format, make_sink):
+    '''Get the sink for `output` in `format`, making it if there's none.'''
+    if isinstance(output, (pycompat.PathLike, str)):
+        key = (format, os.path.abspath(pycompat.text_type(output)))
+    else:
+        key = (format, output)
+    with shared_sinks_lock:
+        try:
+            sink = shared_sinks.get(key)
+        except TypeError:
+            # An unhashable output, that we can't tell apart from others.
+            return make_sink()
+        if sink is None:
+            sink = shared_sinks[key] = make_sink()
+        return sink
+
+
+def write_all(write, items):
+    '''Write lines of text in one go, or records one at a time.'''
+    if not items:
+        return
+    if isinstance(items[0], tuple):
+        for item in items:
+            write(item)
+    else:
+        write(u''.join(items))
+
+
+OVERFLOW_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+
+class AsyncWriter(object):
+    '''
+    Hand trace lines to a background thread that writes them in batches.
+
+    The traced thread only appends the finished line to a bounded queue. When
+    the queue is full, `overflow` decides what happens:
+
+     - `'block'`: wait for the writer thread to make room.
+     - `'drop_newest'`: throw away the new line.
+     - `'drop_oldest'`: throw away the oldest line in the queue.
+
+    Dropped lines are counted in `n_dropped`, and the writer thread reports
+    them in the output once it catches up, with a line (or record) made by
+    `format_dropped_lines`.
+
+    There's a single writer thread for all async writers in the process. It
+    only holds on to the writers that have lines waiting, so a writer and its
+    tracer can be garbage collected once they're done with.
+    '''
+    instances = weakref.WeakSet()
+    thread = None
+    thread_lock = threading.Lock()
+    # Writers that have lines for the writer thread. A writer may be in here
+    # more than once, which only costs the thread a look at an empty queue.
+    pending_writers = collections.deque()
+    has_pending_writers = threading.Event()
+    condition = threading.Condition()
+
+    def __init__(self, write, queue_size=10000, overflow='block',
+                 format_dropped_lines=templates.TextTemplates().dropped_lines,
+                 flush_after_batch=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('`overflow` must be one of {}.'.format(
+                ', '.join(map(repr, OVERFLOW_POLICIES))
+            ))
+        assert queue_size >= 1
+        self.inner_write = write
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.format_dropped_lines = format_dropped_lines
+        self.flush_after_batch = flush_after_batch
+        self.queue = collections.deque(
+            maxlen=queue_size if overflow == 'drop_oldest' else None
+        )
+        self.n_dropped = 0
+        self.n_reported_dropped = 0
+        self.is_pending = False
+        self.is_busy = False
+        AsyncWriter.instances.add(self)
+        _install_exit_handlers()
+
+    def write(self, s):
+        if AsyncWriter.thread is None:
+            AsyncWriter._start_thread()
+        queue = self.queue
+        if len(queue) >= self.queue_size:
+            if self.overflow == 'drop_newest':
+                self.n_dropped += 1
+                return
+            elif self.overflow == 'drop_oldest':
+                # The deque's `maxlen` pushes the oldest line out for us.
+                self.n_dropped += 1
+            else:
+                with AsyncWriter.condition:
+                    while len(queue) >= self.queue_size:
+                        AsyncWriter.condition.wait(0.1)
+        queue.append(s)
+        if not self.is_pending:
+            self.is_pending = True
+            AsyncWriter.pending_writers.append(self)
+            AsyncWriter.has_pending_writers.set()
+
+    @classmethod
+    def _start_thread(cls):
+        with cls.thread_lock:
+            if cls.thread is not None:
+                return
+            thread = threading.Thread(target=cls._run,
+                                      name='pysnooper-writer')
+            thread.daemon = True
+            thread.start()
+            cls.thread = thread
+
+    @classmethod
+    def _run(cls):
+        pending_writers = cls.pending_writers
+        while True:
+            cls.has_pending_writers.wait()
+            cls.has_pending_writers.clear()
+            while pending_writers:
+                pending_writers.popleft()._write_batch()
+
+    def _write_batch(self):
+        # We're marked busy before we're no longer pending, so `flush` never
+        # sees us as done while there are lines that we haven't taken yet.
+        # Lines that are queued after we stop being pending put us back in
+        # `pending_writers`.
+        self.is_busy = True
+        self.is_pending = False
+        queue = self.queue
+        lines = []
+        try:
+            while True:
+                lines.append(queue.popleft())
+        except IndexError:
+            pass
+        n_dropped = self.n_dropped
+        if n_dropped != self.n_reported_dropped:
+            lines.append(self.format_dropped_lines(
+                n_dropped=n_dropped - self.n_reported_dropped
+            ))
+            self.n_reported_dropped = n_dropped
+        try:
+            write_all(self.inner_write, lines)
+            if self.flush_after_batch is not None:
+                self.flush_after_batch()
+        except Exception:
+            pass
+        with AsyncWriter.condition:
+            self.is_busy = False
+            AsyncWriter.condition.notify_all()
+
+    def flush(self):
+        '''Wait until the writer thread has written every queued line.'''
+        with AsyncWriter.condition:
+            while self.queue or self.is_pending or self.is_busy:
+                AsyncWriter.condition.wait(0.1)
+
+
+def flush_all_writers():
+    # Async writers go first, since they may still have lines to hand over to
+    # a file writer.
+    for writer in tuple(AsyncWriter.instances) + tuple(FileWriter.instances):
+        try:
+            writer.flush()
+        except Exception:
+            pass
+
+
+def finish_all_tracers():
+    '''Write what tracers keep for the end, like profiles and histograms.'''
+    for tracer in tuple(Tracer.unfinished_instances):
+        try:
+            tracer._finish()
+        except Exception:
+            pass
+    for tracer in tuple(Tracer.rate_limit_reporters.values()):
+        try:
+            # Whatever was dropped since the last report:
+            tracer._report_rate_limited(force=True)
+        except Exception:
+            pass
+
+
+def _on_exit():
+    # Tracers go first, since what they write at exit has to be flushed too.
+    finish_all_tracers()
+    flush_all_writers()
+
+
+_atexit_hook_installed = False
+
+
+def _install_atexit_hook():
+    global _atexit_hook_installed
+    if _atexit_hook_installed:
+        return
+    _atexit_hook_installed = True
+    atexit.register(_on_exit)
+
+
+_exit_handlers_installed = False
+
+
+def _install_exit_handlers():
+    '''
+    Flush buffered trace output at interpreter exit and on fatal signals.
+
+    Signal handlers can only be installed from the main thread, and we only
+    wrap handlers for signals that would otherwise kill the process without
+    running `atexit`.
+    '''
+    global _exit_handlers_installed
+    if _exit_handlers_installed:
+        return
+    _exit_handlers_installed = True
+    _install_atexit_hook()
+    if not isinstance(threading.current_thread(), threading._MainThread):
+        return
+    for signal_name in ('SIGTERM', 'SIGHUP'):
+        signal_number = getattr(signal, signal_name, None)
+        if signal_number is None:
+            continue
+        previous_handler = signal.getsignal(signal_number)
+        if previous_handler in (signal.SIG_IGN, None):
+            continue
+
+        def handler(signal_number, frame, previous_handler=previous_handler):
+            flush_all_writers()
+            if callable(previous_handler):
+                return previous_handler(signal_number, frame)
+            signal.signal(signal_number, signal.SIG_DFL)
+            os.kill(os.getpid(), signal_number)
+
+        signal.signal(signal_number, handler)
+
+
+class NullContext(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+
+null_context = NullContext()
+
+
+FRAME_STATES_MIN_SWEEP_SIZE = 1000
+
+
+class FrameState(object):
+    '''
+    What a tracer remembers about a frame between its events.
+
+    Tracers keep these by `id(frame)` rather than by the frame, so a frame
+    whose return we never see, like when another tool replaces the trace
+    function mid-call, isn't kept alive along with all of its locals. A stale
+    entry is dropped when a new frame gets the same id, or when a sweep finds
+    that its thread has ended.
+    '''
+    __slots__ = ('local_reprs', 'repr_cache', 'start_time', 'thread_ident',
+                 'last_line_no', 'last_wall_time', 'last_cpu_time',
+                 'loop_detector', 'n_lines', 'n_suppressed_lines')
+
+    def __init__(self):
+        self.local_reprs = {}
+        self.repr_cache = {}
+        self.start_time = None
+        self.thread_ident = pycompat.get_thread_ident()
+        # For `profile=True`, the line that's running and when it started:
+        self.last_line_no = None
+        self.last_wall_time = self.last_cpu_time = 0
+        # For `compress_loops`:
+        self.loop_detector = None
+        # For `max_lines_per_call`, the events written and left out:
+        self.n_lines = self.n_suppressed_lines = 0
 
 
 thread_global = threading.local()
@@ -249,12 +1100,219 @@ class Tracer:
 
         @pysnooper.snoop(color=False)
 
+    When writing to a file, the file is kept open and flushed after every line
+    by default. Flush only when a snooped call ends, every few seconds, or
+    only when the buffer is full, with a bigger buffer::
+
+        @pysnooper.snoop('/my/log/file.log', flush='call')
+        @pysnooper.snoop('/my/log/file.log', flush='interval',
+                         flush_interval=5)
+        @pysnooper.snoop('/my/log/file.log', flush='exit',
+                         buffer_size=1024 * 1024)
+
+    Only snoop on some of the calls to a hot function, either 1% of them
+    chosen at random or every 1000th one::
+
+        @pysnooper.snoop(sample=0.01)
+        @pysnooper.snoop(sample_every=1000)
+
+    Only write the last lines before an exception, keeping up to 1000 lines
+    in memory and throwing them away when the snooped call succeeds::
+
+        @pysnooper.snoop(flight_recorder=1000)
+
+    When a loop runs the same lines over and over, only write its first 3
+    iterations in full, and then a line saying how many more times they ran
+    and what values the variables were left with::
+
+        @pysnooper.snoop(compress_loops=3)
+
+    Stop writing the lines of a call after its first 1000, or all lines after
+    the first million, so a runaway trace can't fill up the disk::
+
+        @pysnooper.snoop(max_lines_per_call=1000, max_lines_total=10 ** 6)
+
+    Write at most 100 events a second, dropping whole events beyond that and
+    saying how many were dropped once a second. Tracers with the same
+    `rate_limit` share its ceiling across the process. For a ceiling of your
+    own, give tracers the same `pysnooper.RateLimiter`::
+
+        @pysnooper.snoop(rate_limit=100)
+        @pysnooper.snoop(rate_limit=rate_limiter)
+
+    Write the output from a background thread, so a slow disk or pipe doesn't
+    slow down the snooped code. When more than `queue_size` lines are waiting,
+    either wait, or drop the newest or oldest lines::
+
+        @pysnooper.snoop(async_output=True, queue_size=1000,
+                         overflow='drop_oldest')
+
+    On Python 3.12+, use `sys.monitoring` instead of `sys.settrace`, so only
+    the snooped code is slowed down rather than the whole process::
+
+        @pysnooper.snoop(backend='monitoring')
+
+    Instead of a line of output for each line that runs, count the hits and
+    time of each line, and write a table of them at exit, like
+    `line_profiler`::
+
+        @pysnooper.snoop(profile=True)
+
+    Leave snooping on for a hot function, but only time its calls, and write
+    the number of calls and the percentiles of their durations at exit::
+
+        @pysnooper.snoop(histogram=True)
+
+    Write a compact binary trace, to be read with `python -m pysnooper
+    render`::
+
+        @pysnooper.snoop('/my/log/file.bin', format='binary')
+
+    Write one JSON object per event, for log pipelines to pick up::
+
+        @pysnooper.snoop('/my/log/file.jsonl', format='jsonl')
+
+    Write the snooped calls as Chrome trace events, to see them on a timeline
+    in `chrome://tracing` or Perfetto::
+
+        @pysnooper.snoop('/my/log/trace.json', format='trace_event', depth=3)
+
     '''
+    # Tracers with something to write at exit, like a profile. These are kept
+    # alive until then, since a `with` block's tracer is gone as soon as the
+    # block ends:
+    unfinished_instances = set()
+    # For each rate limiter, the latest tracer to use it, to report its final
+    # drops at exit. The earlier ones aren't kept alive for that:
+    rate_limit_reporters = {}
+
     def __init__(self, output=None, watch=(), watch_explode=(), depth=1,
                  prefix='', overwrite=False, thread_info=False, custom_repr=(),
                  max_variable_length=100, normalize=False, relative_time=False,
-                 color=sys.platform in ('linux', 'linux2', 'cygwin', 'darwin')):
-        self._write = get_write_function(output, overwrite)
+                 color=sys.platform in ('linux', 'linux2', 'cygwin', 'darwin'),
+                 backend='settrace', flush='line', buffer_size=-1,
+                 flush_interval=1, async_output=False, queue_size=10000,
+                 overflow='block', flight_recorder=None, sample=None,
+                 sample_every=None, format='text', profile=False,
+                 histogram=False, compress_loops=None,
+                 max_lines_per_call=None, max_lines_total=None,
+                 rate_limit=None):
+        if backend not in ('settrace', 'monitoring'):
+            raise ValueError("`backend` must be either 'settrace' or "
+                             "'monitoring'.")
+        if backend == 'monitoring' and not monitoring.is_available:
+            raise NotImplementedError("`backend='monitoring'` requires "
+                                      "Python 3.12+")
+        if format not in FORMATS:
+            raise ValueError('`format` must be one of {}.'.format(
+                ', '.join(map(repr, FORMATS))
+            ))
+        if profile and histogram:
+            raise ValueError("Can't use both `profile` and `histogram`.")
+        if (profile or histogram) and flight_recorder:
+            raise ValueError("Can't use `flight_recorder` with `profile` or "
+                             "`histogram`.")
+        if format == 'trace_event' and (normalize or relative_time):
+            raise ValueError("`format='trace_event'` needs wall-clock "
+                             "timestamps, so it can't be used with "
+                             "`normalize` or `relative_time`.")
+        self.backend = backend
+        self.format = format
+        self._write = get_write_function(output, overwrite, flush=flush,
+                                         buffer_size=buffer_size,
+                                         flush_interval=flush_interval,
+                                         binary=(format == 'binary'))
+        if format == 'binary':
+            write = self._write
+            binary_sink = get_shared_sink(
+                output, format, lambda: binary_format.BinarySink(write)
+            )
+            self._write = functools.partial(
+                binary_sink.write,
+                header=binary_format.BinarySink.make_header(
+                    prefix, relative_time, normalize
+                )
+            )
+            # The sink may have been made by another tracer, with a writer of
+            # its own, and that's the one that our lines go through.
+            write_owner = getattr(binary_sink.inner_write, '__self__', None)
+        elif format == 'trace_event':
+            write = self._write
+            write_owner = getattr(write, '__self__', None)
+            trace_event_sink = get_shared_sink(
+                output, format, lambda: trace_event_format.TraceEventSink(
+                    write, is_continued=isinstance(write_owner, FileWriter)
+                                        and write_owner.has_content()
+                )
+            )
+            self._write = trace_event_sink.write
+            write_owner = getattr(trace_event_sink.inner_write, '__self__',
+                                  None)
+        else:
+            write_owner = getattr(self._write, '__self__', None)
+        self._file_writer = (write_owner if isinstance(write_owner, FileWriter)
+                             else None)
+        if format == 'jsonl':
+            self._write = jsonl_format.JsonLinesSink(self._write).write
+        if async_output:
+            # With a writer thread, it's that thread that flushes the file
+            # after writing each batch, rather than the traced thread.
+            flush_after_batch = None
+            if self._file_writer is not None and \
+                                      self._file_writer.flush_policy == 'call':
+                flush_after_batch = self._file_writer.flush
+                self._file_writer = None
+            self._write = AsyncWriter(
+                self._write, queue_size=queue_size, overflow=overflow,
+                format_dropped_lines=lambda n_dropped:
+                               self._format_dropped_lines(n_dropped=n_dropped),
+                flush_after_batch=flush_after_batch
+            ).write
+        self.flight_recorder = flight_recorder
+        if sample is not None and sample_every is not None:
+            raise ValueError("Can't use both `sample` and `sample_every`.")
+        if sample is not None and not 0 < sample <= 1:
+            raise ValueError('`sample` must be between 0 and 1.')
+        if sample_every is not None and sample_every < 1:
+            raise ValueError('`sample_every` must be at least 1.')
+        self.sample = sample
+        self.sample_every = sample_every
+        if compress_loops is not None and compress_loops < 1:
+            raise ValueError('`compress_loops` must be at least 1.')
+        self.compress_loops = compress_loops
+        for name, value in (('max_lines_per_call', max_lines_per_call),
+                            ('max_lines_total', max_lines_total)):
+            if value is not None and value < 1:
+                raise ValueError('`{}` must be at least 1.'.format(name))
+        self.max_lines_per_call = max_lines_per_call
+        self.max_lines_total = max_lines_total
+        self.has_line_budgets = (max_lines_per_call is not None or
+                                 max_lines_total is not None)
+        self.n_total_lines = 0
+        self.is_output_limit_reached = False
+        if rate_limit is None or \
+                         isinstance(rate_limit, rate_limiting.RateLimiter):
+            self.rate_limiter = rate_limit
+        else:
+            self.rate_limiter = rate_limiting.get_shared_rate_limiter(
+                rate_limit
+            )
+        self.profile = profile
+        self.code_profiles = {}
+        self.histogram = histogram
+        self.histograms = collections.OrderedDict()
+        if self.rate_limiter is not None and not DISABLED:
+            Tracer.rate_limit_reporters[self.rate_limiter] = self
+            _install_atexit_hook()
+        if (profile or histogram) and not DISABLED:
+            Tracer.unfinished_instances.add(self)
+            _install_atexit_hook()
+        self._call_counter = itertools.count()
+        self.n_skipped_calls = 0
+        self.n_reported_skipped_calls = 0
+        if flight_recorder:
+            self._output_write = self._write
+            self._write = self._write_to_flight_recorder
 
         self.watch = [
             v if isinstance(v, BaseVariable) else CommonVariable(v)
@@ -263,50 +1321,68 @@ class Tracer:
              v if isinstance(v, BaseVariable) else Exploding(v)
              for v in utils.ensure_tuple(watch_explode)
         ]
-        self.frame_to_local_reprs = {}
-        self.start_times = {}
+        self.frame_states = {}
+        self.frame_states_sweep_size = FRAME_STATES_MIN_SWEEP_SIZE
         self.depth = depth
         self.prefix = prefix
         self.thread_info = thread_info
         self.thread_info_padding = 0
         assert self.depth >= 1
         self.target_codes = set()
-        self.target_frames = set()
+        self.target_frame_ids = set()
+        self.frame_ids_within_depth = set()
         self.thread_local = threading.local()
         if len(custom_repr) == 2 and not all(isinstance(x,
                       pycompat.collections_abc.Iterable) for x in custom_repr):
             custom_repr = (custom_repr,)
-        self.custom_repr = custom_repr
+        self.custom_repr = utils.CompiledCustomRepr(custom_repr)
         self.last_source_path = None
         self.max_variable_length = max_variable_length
         self.normalize = normalize
         self.relative_time = relative_time
-        self.color = color and (output is None)
-
-        if self.color:
-            self._FOREGROUND_BLUE = '\x1b[34m'
-            self._FOREGROUND_CYAN = '\x1b[36m'
-            self._FOREGROUND_GREEN = '\x1b[32m'
-            self._FOREGROUND_MAGENTA = '\x1b[35m'
-            self._FOREGROUND_RED = '\x1b[31m'
-            self._FOREGROUND_RESET = '\x1b[39m'
-            self._FOREGROUND_YELLOW = '\x1b[33m'
-            self._STYLE_BRIGHT = '\x1b[1m'
-            self._STYLE_DIM = '\x1b[2m'
-            self._STYLE_NORMAL = '\x1b[22m'
-            self._STYLE_RESET_ALL = '\x1b[0m'
+        self.color = color and (output is None) and format == 'text'
+        for name, value in (templates.COLORS if self.color
+                            else templates.NO_COLORS).items():
+            setattr(self, name, value)
+
+        self._compile_templates()
+
+    def _compile_templates(self):
+        '''
+        Pick what turns each kind of output line into what we write.
+
+        For text, these are the line templates with the prefix and the colors
+        baked in, so `trace` only needs to fill in the fields that actually
+        change from line to line. For other formats, they make records, and
+        timestamps and durations are kept as integers of microseconds.
+        '''
+        if self.format == 'text':
+            formatter = templates.TextTemplates(self.prefix, color=self.color)
+            self._format_time_of_day = utils.format_time_of_day
+            self._format_duration = utils.format_duration
+            self._normalized_timestamp = u' ' * 15
         else:
-            self._FOREGROUND_BLUE = ''
-            self._FOREGROUND_CYAN = ''
-            self._FOREGROUND_GREEN = ''
-            self._FOREGROUND_MAGENTA = ''
-            self._FOREGROUND_RED = ''
-            self._FOREGROUND_RESET = ''
-            self._FOREGROUND_YELLOW = ''
-            self._STYLE_BRIGHT = ''
-            self._STYLE_DIM = ''
-            self._STYLE_NORMAL = ''
-            self._STYLE_RESET_ALL = ''
+            formatter = records.RecordFormatter()
+            self._format_time_of_day = self._format_duration = \
+                                                        records.keep_microseconds
+            self._normalized_timestamp = None
+        self._format_source_path = formatter.source_path
+        self._format_starting_var = formatter.starting_var
+        self._format_new_var = formatter.new_var
+        self._format_modified_var = formatter.modified_var
+        self._format_event = formatter.event
+        self._format_call_ended_by_exception = \
+                                              formatter.call_ended_by_exception
+        self._format_return_value = formatter.return_value
+        self._format_exception = formatter.exception
+        self._format_skipped_calls = formatter.skipped_calls
+        self._format_elapsed_time = formatter.elapsed_time
+        self._format_repeated_lines = formatter.repeated_lines
+        self._format_dropped_lines = formatter.dropped_lines
+        self._format_suppressed_lines = formatter.suppressed_lines
+        self._format_rate_limited = formatter.rate_limited
+        self._format_output_limit_reached = formatter.output_limit_reached
+        self._format_custom_line = formatter.custom_line
 
     def __call__(self, function_or_class):
         if DISABLED:
@@ -330,18 +1406,46 @@ class Tracer:
 
     def _wrap_function(self, function):
         self.target_codes.add(function.__code__)
+        if self.histogram:
+            histogram = self._get_histogram(function.__code__)
+            perf_counter_ns = pycompat.perf_counter_ns
 
         @functools.wraps(function)
         def simple_wrapper(*args, **kwargs):
             with self:
                 return function(*args, **kwargs)
 
+        @functools.wraps(function)
+        def sampling_wrapper(*args, **kwargs):
+            if not self._is_call_sampled():
+                return function(*args, **kwargs)
+            with self:
+                return function(*args, **kwargs)
+
+        @functools.wraps(function)
+        def histogram_wrapper(*args, **kwargs):
+            if not self._is_call_sampled():
+                return function(*args, **kwargs)
+            start_time = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.record(perf_counter_ns() - start_time)
+
         @functools.wraps(function)
         def generator_wrapper(*args, **kwargs):
             gen = function(*args, **kwargs)
+            # With sampling, the whole generator is either snooped or not.
+            if not self._is_call_sampled():
+                context = null_context
+            elif self.histogram:
+                # Each time the generator runs counts as a call.
+                context = histograms.Stopwatch(histogram)
+            else:
+                context = self
             method, incoming = gen.send, None
             while True:
-                with self:
+                with context:
                     try:
                         outgoing = method(incoming)
                     except StopIteration:
@@ -357,59 +1461,401 @@ class Tracer:
             raise NotImplementedError
         elif inspect.isgeneratorfunction(function):
             return generator_wrapper
+        elif self.histogram:
+            return histogram_wrapper
+        elif self.sample is not None or self.sample_every is not None:
+            return sampling_wrapper
         else:
             return simple_wrapper
 
+    def _is_call_sampled(self):
+        if self.sample is not None:
+            is_sampled = random.random() < self.sample
+        elif self.sample_every is not None:
+            is_sampled = not (next(self._call_counter) % self.sample_every)
+        else:
+            return True
+        if not is_sampled:
+            self.n_skipped_calls += 1
+        return is_sampled
+
     def write(self, s):
-        s = u'{self.prefix}{s}\n'.format(**locals())
-        self._write(s)
+        if self.rate_limiter is not None and \
+                                         not self.rate_limiter.try_acquire():
+            return
+        self._write(self._format_custom_line(s=s))
 
     def __enter__(self):
         if DISABLED:
             return
-        thread_global.__dict__.setdefault('depth', -1)
         calling_frame = inspect.currentframe().f_back
+        if self.histogram:
+            stopwatch = histograms.Stopwatch(self._get_histogram(
+                calling_frame.f_code, calling_frame.f_lineno
+            ))
+            self.thread_local.__dict__.setdefault('stopwatches',
+                                                  []).append(stopwatch)
+            stopwatch.__enter__()
+            return
+        thread_global.__dict__.setdefault('depth', -1)
         if not self._is_internal_frame(calling_frame):
-            calling_frame.f_trace = self.trace
-            self.target_frames.add(calling_frame)
-
-        stack = self.thread_local.__dict__.setdefault(
-            'original_trace_functions', []
-        )
-        stack.append(sys.gettrace())
-        self.start_times[calling_frame] = datetime_module.datetime.now()
-        sys.settrace(self.trace)
+            if self.backend == 'settrace':
+                calling_frame.f_trace = self.trace
+            self.target_frame_ids.add(id(calling_frame))
+
+        self._get_frame_state(id(calling_frame)).start_time = \
+                                                      pycompat.perf_counter_ns()
+        if self.flight_recorder:
+            self.thread_local.n_recording_blocks = \
+                         self.thread_local.__dict__.get('n_recording_blocks', 0) + 1
+        if self.backend == 'monitoring':
+            monitoring.dispatcher.enter(self, calling_frame)
+        else:
+            stack = self.thread_local.__dict__.setdefault(
+                'original_trace_functions', []
+            )
+            stack.append(sys.gettrace())
+            sys.settrace(self.trace)
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         if DISABLED:
             return
-        stack = self.thread_local.original_trace_functions
-        sys.settrace(stack.pop())
-        calling_frame = inspect.currentframe().f_back
-        self.target_frames.discard(calling_frame)
-        self.frame_to_local_reprs.pop(calling_frame, None)
+        if self.histogram:
+            self.thread_local.stopwatches.pop().__exit__(exc_type, exc_value,
+                                                         exc_traceback)
+            return
+        if self.backend == 'monitoring':
+            monitoring.dispatcher.exit(self)
+        else:
+            stack = self.thread_local.original_trace_functions
+            sys.settrace(stack.pop())
+        calling_frame_id = id(inspect.currentframe().f_back)
+        self.target_frame_ids.discard(calling_frame_id)
+        frame_state = self.frame_states.pop(calling_frame_id)
+        if self.profile:
+            return
+        if self.compress_loops:
+            self._end_loop(
+                self.thread_local.__dict__.pop('last_frame_state', None)
+            )
 
         ### Writing elapsed time: #############################################
         #                                                                     #
-        _FOREGROUND_YELLOW = self._FOREGROUND_YELLOW
-        _STYLE_DIM = self._STYLE_DIM
-        _STYLE_NORMAL = self._STYLE_NORMAL
-        _STYLE_RESET_ALL = self._STYLE_RESET_ALL
-
-        start_time = self.start_times.pop(calling_frame)
-        duration = datetime_module.datetime.now() - start_time
-        elapsed_time_string = pycompat.timedelta_format(duration)
-        indent = ' ' * 4 * (thread_global.depth + 1)
-        self.write(
-            '{indent}{_FOREGROUND_YELLOW}{_STYLE_DIM}'
-            'Elapsed time: {_STYLE_NORMAL}{elapsed_time_string}'
-            '{_STYLE_RESET_ALL}'.format(**locals())
+        start_time = frame_state.start_time
+        elapsed_time_string = self._format_duration(
+            (pycompat.perf_counter_ns() - start_time) // 1000
         )
+        indent = ' ' * 4 * (thread_global.depth + 1)
+        if frame_state.n_suppressed_lines:
+            self.thread_local.__dict__.pop('over_budget_frame_state', None)
+        # The lines about the call's end take one token between them.
+        rate_limiter = self.rate_limiter
+        is_written = rate_limiter is None or rate_limiter.try_acquire()
+        # Past `max_lines_total`, the elapsed time is left out with the rest
+        # of the call's lines.
+        if is_written and not self.is_output_limit_reached:
+            if frame_state.n_suppressed_lines:
+                self._write(self._format_suppressed_lines(
+                    indent=indent, n_suppressed=frame_state.n_suppressed_lines
+                ))
+            self._write(self._format_elapsed_time(
+                indent=indent, elapsed_time_string=elapsed_time_string
+            ))
         #                                                                     #
         ### Finished writing elapsed time. ####################################
 
+        n_skipped_calls = self.n_skipped_calls
+        if is_written and n_skipped_calls != self.n_reported_skipped_calls:
+            self._write(self._format_skipped_calls(
+                indent=indent,
+                n_skipped_calls=n_skipped_calls - self.n_reported_skipped_calls
+            ))
+            self.n_reported_skipped_calls = n_skipped_calls
+
+        if rate_limiter is not None and \
+                          rate_limiter.n_dropped != rate_limiter.n_reported:
+            self._report_rate_limited()
+
+        if self.flight_recorder:
+            self.thread_local.n_recording_blocks -= 1
+            if not self.thread_local.n_recording_blocks:
+                # The outermost snooped call on this thread is done. If it
+                # didn't raise, nobody needs what we recorded.
+                self._get_flight_recorder().clear()
+                self.thread_local.is_flight_recorder_dumped = False
+                self.thread_local.recorded_source_path = None
+                self.last_source_path = None
+
+        if self._file_writer is not None and \
+                                      self._file_writer.flush_policy == 'call':
+            self._file_writer.flush()
+
+    def write_profile(self):
+        '''
+        Write the line profile of everything snooped so far.
+
+        With `profile=True`, this happens at exit, but it can be called at
+        any time to see the profile so far.
+        '''
+        if not self.code_profiles:
+            return
+        for line in profiling.iter_report_lines(
+                                          tuple(self.code_profiles.values())):
+            self.write(line)
+        if self._file_writer is not None:
+            self._file_writer.flush()
+
+    def write_histograms(self):
+        '''
+        Write how many times each snooped function was called, and the
+        percentiles of how long the calls took.
+
+        With `histogram=True`, this happens at exit, but it can be called at
+        any time to see the numbers so far.
+        '''
+        for histogram in tuple(self.histograms.values()):
+            if histogram.count:
+                self.write(histogram.format_summary())
+        if self._file_writer is not None:
+            self._file_writer.flush()
+
+    def _get_histogram(self, code, with_line_no=None):
+        '''
+        Get the histogram of a snooped function, or of the `with` block at
+        `with_line_no` in `code`.
+        '''
+        key = (id(code), with_line_no)
+        try:
+            return self.histograms[key]
+        except KeyError:
+            pass
+        source_path = code.co_filename
+        if self.normalize:
+            source_path = os.path.basename(source_path)
+        label = u'{} ({}:{})'.format(
+            code.co_name if with_line_no is None else u'with block',
+            source_path,
+            code.co_firstlineno if with_line_no is None else with_line_no
+        )
+        return self.histograms.setdefault(
+            key, histograms.LatencyHistogram(label, code)
+        )
+
+    def _profile(self, frame, frame_id, event):
+        wall_time = pycompat.perf_counter_ns()
+        cpu_time = pycompat.thread_time_ns()
+        if event == 'call' and is_frame_starting(frame):
+            self.frame_states.pop(frame_id, None)
+        frame_state = self._get_frame_state(frame_id)
+        code = frame.f_code
+        try:
+            code_profile = self.code_profiles[id(code)]
+        except KeyError:
+            # Keyed by id, since code objects from different files can be
+            # equal. The profile holds on to the code, so its id stays ours.
+            source_path, source = get_path_and_source_from_frame(frame)
+            code_profile = self.code_profiles[id(code)] = \
+                               profiling.CodeProfile(code, source_path, source)
+        if frame_state.last_line_no is not None:
+            code_profile.add_time(frame_state.last_line_no,
+                                  wall_time - frame_state.last_wall_time,
+                                  cpu_time - frame_state.last_cpu_time)
+        if event == 'return':
+            self.frame_states.pop(frame_id, None)
+            self.frame_ids_within_depth.discard(frame_id)
+            return self.trace
+        if event == 'line':
+            frame_state.last_line_no = frame.f_lineno
+            code_profile.add_hit(frame_state.last_line_no)
+        # Read the clocks again, so the time we took isn't counted.
+        frame_state.last_wall_time = pycompat.perf_counter_ns()
+        frame_state.last_cpu_time = pycompat.thread_time_ns()
+        return self.trace
+
+    def _compress_loop(self, frame, frame_state, event, indent):
+        '''
+        Return whether to leave out this event, because it's in a loop that
+        was already written `compress_loops` times.
+        '''
+        thread_local_dict = self.thread_local.__dict__
+        last_frame_state = thread_local_dict.get('last_frame_state')
+        if last_frame_state is not frame_state:
+            # Events of other frames between the lines of a frame, like calls
+            # within `depth`, mean that its lines aren't a plain loop.
+            self._end_loop(last_frame_state)
+            thread_local_dict['last_frame_state'] = frame_state
+        loop_detector = frame_state.loop_detector
+        if loop_detector is None:
+            loop_detector = frame_state.loop_detector = \
+                                     loops.LoopDetector(self.compress_loops)
+        if event == 'line':
+            if loop_detector.add_line(frame.f_lineno):
+                if loop_detector.frame is None:
+                    loop_detector.frame = frame
+                    loop_detector.indent = indent
+                return True
+            if not loop_detector.is_compressing:
+                return False
+        self._end_loop(frame_state)
+        if event == 'line':
+            loop_detector.add_line(frame.f_lineno)
+        return False
+
+    def _end_loop(self, frame_state):
+        '''Write the summary of the loop we're leaving out lines of, if any.'''
+        if frame_state is None or frame_state.loop_detector is None:
+            return
+        loop_detector = frame_state.loop_detector
+        if loop_detector.is_compressing:
+            old_local_reprs = frame_state.local_reprs
+            frame_state.local_reprs = local_reprs = get_local_reprs(
+                loop_detector.frame, watch=self.watch,
+                custom_repr=self.custom_repr,
+                max_length=self.max_variable_length, normalize=self.normalize,
+                repr_cache=frame_state.repr_cache
+            )
+            last_values = tuple(
+                (name, value_repr) for name, value_repr in local_reprs.items()
+                if old_local_reprs.get(name) != value_repr
+            )
+            self._write(self._format_repeated_lines(
+                indent=loop_detector.indent,
+                line_nos=loops.format_line_nos(loop_detector.cycle),
+                n_repeats=loop_detector.n_repeats, last_values=last_values
+            ))
+        loop_detector.reset()
+
+    def _is_over_line_budget(self, frame_id, frame_state, event, indent):
+        '''
+        Return whether to leave out this event, because the call, or the
+        tracer as a whole, has written as many lines as it's allowed.
+
+        This comes before any reprs are made, so left out lines cost next to
+        nothing. Once a call is over its budget, so are the calls it makes. A
+        left out return still ends its call, so the depth and the elapsed time
+        stay right.
+        '''
+        if self.is_output_limit_reached:
+            return self._leave_out_event(frame_id, event)
+        if self.max_lines_total is not None and \
+                                  self.n_total_lines >= self.max_lines_total:
+            self.is_output_limit_reached = True
+            self._write(self._format_output_limit_reached(
+                max_lines_total=self.max_lines_total
+            ))
+            return self._leave_out_event(frame_id, event)
+
+        if self.max_lines_per_call is not None:
+            thread_local_dict = self.thread_local.__dict__
+            over_budget_frame_state = \
+                                 thread_local_dict.get('over_budget_frame_state')
+            if over_budget_frame_state is frame_state:
+                if event != 'return':
+                    frame_state.n_suppressed_lines += 1
+                    return True
+                # The call ends here, so the return, with the variables that
+                # changed since we stopped, is worth writing.
+                del thread_local_dict['over_budget_frame_state']
+                self._write(self._format_suppressed_lines(
+                    indent=indent, n_suppressed=frame_state.n_suppressed_lines
+                ))
+            elif over_budget_frame_state is not None:
+                over_budget_frame_state.n_suppressed_lines += 1
+                return self._leave_out_event(frame_id, event)
+            elif frame_state.n_lines >= self.max_lines_per_call and \
+                                                           event != 'return':
+                thread_local_dict['over_budget_frame_state'] = frame_state
+                frame_state.n_suppressed_lines += 1
+                return True
+            frame_state.n_lines += 1
+        # Threads may race on this count, and miss a few lines, which is fine
+        # for a limit this rough.
+        self.n_total_lines += 1
+        return False
+
+    def _finish(self):
+        Tracer.unfinished_instances.discard(self)
+        if self.profile:
+            self.write_profile()
+        if self.histogram:
+            self.write_histograms()
+
+    def _report_rate_limited(self, force=False):
+        n_dropped = self.rate_limiter.pop_n_dropped(force=force)
+        if n_dropped:
+            self._write(self._format_rate_limited(n_dropped=n_dropped))
+
+    def _leave_out_event(self, frame_id, event):
+        if event == 'return':
+            self.frame_states.pop(frame_id, None)
+            self.frame_ids_within_depth.discard(frame_id)
+            thread_global.depth -= 1
+        return True
+
+    def _get_flight_recorder(self):
+        try:
+            return self.thread_local.flight_recorder
+        except AttributeError:
+            flight_recorder = self.thread_local.flight_recorder = \
+                                   collections.deque(maxlen=self.flight_recorder)
+            return flight_recorder
+
+    def _write_to_flight_recorder(self, s):
+        thread_local_dict = self.thread_local.__dict__
+        if thread_local_dict.get('is_flight_recorder_dumped'):
+            self._output_write(s)
+        else:
+            self._get_flight_recorder().append((
+                thread_local_dict.get('recorded_source_path'),
+                thread_local_dict.get('recorded_source_path_line'), s
+            ))
+
+    def _dump_flight_recorder(self):
+        '''
+        Write out the recorded lines, and stop recording until the outermost
+        snooped call on this thread ends, so the rest of it shows too.
+
+        The source path is written before the first line and wherever it
+        changes, even if its own line was long gone from the recorder.
+        '''
+        if self.thread_local.__dict__.get('is_flight_recorder_dumped'):
+            return
+        flight_recorder = self._get_flight_recorder()
+        items = []
+        last_source_path = None
+        for source_path, source_path_line, s in flight_recorder:
+            if source_path_line is not None and \
+                                            source_path != last_source_path:
+                items.append(source_path_line)
+                last_source_path = source_path
+            items.append(s)
+        write_all(self._output_write, items)
+        flight_recorder.clear()
+        self.last_source_path = last_source_path
+        self.thread_local.is_flight_recorder_dumped = True
+
+    def _get_frame_state(self, frame_id):
+        try:
+            return self.frame_states[frame_id]
+        except KeyError:
+            pass
+        if len(self.frame_states) >= self.frame_states_sweep_size:
+            self._sweep_frame_states()
+        frame_state = self.frame_states[frame_id] = FrameState()
+        return frame_state
+
+    def _sweep_frame_states(self):
+        '''Forget the frames of threads that ended before they returned.'''
+        thread_idents = set(thread.ident for thread in threading.enumerate())
+        for frame_id, frame_state in tuple(self.frame_states.items()):
+            if frame_state.thread_ident not in thread_idents:
+                self.frame_states.pop(frame_id, None)
+                self.frame_ids_within_depth.discard(frame_id)
+        self.frame_states_sweep_size = max(FRAME_STATES_MIN_SWEEP_SIZE,
+                                           2 * len(self.frame_states))
+
     def _is_internal_frame(self, frame):
-        return frame.f_code.co_filename == Tracer.__enter__.__code__.co_filename
+        return frame.f_code.co_filename == _internal_filename
 
     def set_thread_info_padding(self, thread_info):
         current_thread_len = len(thread_info)
@@ -425,12 +1871,18 @@ class Tracer:
         # or the user asked to go a few levels deeper and we're within that
         # number of levels deeper.
 
-        if not (frame.f_code in self.target_codes or frame in self.target_frames):
+        frame_id = id(frame)
+        if not (frame.f_code in self.target_codes or
+                                             frame_id in self.target_frame_ids):
             if self.depth == 1:
                 # We did the most common and quickest check above, because the
                 # trace function runs so incredibly often, therefore it's
                 # crucial to hyper-optimize it for the common case.
                 return None
+            elif event != 'call' and frame_id in self.frame_ids_within_depth:
+                # We classified this frame when it was called, so there's no
+                # need to walk up the stack again for each of its lines.
+                pass
             elif self._is_internal_frame(frame):
                 return None
             else:
@@ -439,57 +1891,77 @@ class Tracer:
                     _frame_candidate = _frame_candidate.f_back
                     if _frame_candidate is None:
                         return None
-                    elif _frame_candidate.f_code in self.target_codes or _frame_candidate in self.target_frames:
+                    elif _frame_candidate.f_code in self.target_codes or id(_frame_candidate) in self.target_frame_ids:
                         break
                 else:
+                    # Out of depth. Returning `None` on 'call' means no local
+                    # trace function gets installed for this frame at all.
+                    self.frame_ids_within_depth.discard(frame_id)
                     return None
+                self.frame_ids_within_depth.add(frame_id)
 
         #                                                                     #
         ### Finished checking whether we should trace this line. ##############
 
+        if self.profile:
+            return self._profile(frame, frame_id, event)
+
         if event == 'call':
+            if is_frame_starting(frame):
+                # Whatever we have under this id is from an older frame that
+                # never told us it returned.
+                self.frame_states.pop(frame_id, None)
             thread_global.depth += 1
         indent = ' ' * 4 * thread_global.depth
-
-        _FOREGROUND_BLUE = self._FOREGROUND_BLUE
-        _FOREGROUND_CYAN = self._FOREGROUND_CYAN
-        _FOREGROUND_GREEN = self._FOREGROUND_GREEN
-        _FOREGROUND_MAGENTA = self._FOREGROUND_MAGENTA
-        _FOREGROUND_RED = self._FOREGROUND_RED
-        _FOREGROUND_RESET = self._FOREGROUND_RESET
-        _FOREGROUND_YELLOW = self._FOREGROUND_YELLOW
-        _STYLE_BRIGHT = self._STYLE_BRIGHT
-        _STYLE_DIM = self._STYLE_DIM
-        _STYLE_NORMAL = self._STYLE_NORMAL
-        _STYLE_RESET_ALL = self._STYLE_RESET_ALL
+        frame_state = self._get_frame_state(frame_id)
+        if self.compress_loops and self._compress_loop(frame, frame_state,
+                                                       event, indent):
+            return self.trace
+        if self.has_line_budgets and self._is_over_line_budget(
+                                       frame_id, frame_state, event, indent):
+            return self.trace
+        rate_limiter = self.rate_limiter
+        if rate_limiter is not None:
+            if not rate_limiter.try_acquire():
+                # Dropped before anything about it is formatted. The
+                # variables that changed show up with the next event that
+                # makes it through.
+                self._leave_out_event(frame_id, event)
+                return self.trace
+            if rate_limiter.n_dropped != rate_limiter.n_reported:
+                self._report_rate_limited()
 
         ### Making timestamp: #################################################
         #                                                                     #
         if self.normalize:
-            timestamp = ' ' * 15
+            timestamp = self._normalized_timestamp
         elif self.relative_time:
-            try:
-                start_time = self.start_times[frame]
-            except KeyError:
-                start_time = self.start_times[frame] = \
-                                                 datetime_module.datetime.now()
-            duration = datetime_module.datetime.now() - start_time
-            timestamp = pycompat.timedelta_format(duration)
+            now = pycompat.perf_counter_ns()
+            start_time = frame_state.start_time
+            if start_time is None:
+                start_time = frame_state.start_time = now
+            timestamp = self._format_duration((now - start_time) // 1000)
         else:
-            timestamp = pycompat.time_isoformat(
-                datetime_module.datetime.now().time(),
-                timespec='microseconds'
-            )
+            timestamp = self._format_time_of_day(pycompat.time_ns() // 1000)
         #                                                                     #
         ### Finished making timestamp. ########################################
 
         line_no = frame.f_lineno
         source_path, source = get_path_and_source_from_frame(frame)
         source_path = source_path if not self.normalize else os.path.basename(source_path)
-        if self.last_source_path != source_path:
-            self.write(u'{_FOREGROUND_YELLOW}{_STYLE_DIM}{indent}Source path:... '
-                       u'{_STYLE_NORMAL}{source_path}'
-                       u'{_STYLE_RESET_ALL}'.format(**locals()))
+        if self.flight_recorder and not self.thread_local.__dict__.get(
+                                                'is_flight_recorder_dumped'):
+            # Recorded along with each line rather than as a line of its own,
+            # which the recorder might drop before it's dumped.
+            if self.thread_local.__dict__.get('recorded_source_path') != \
+                                                                  source_path:
+                self.thread_local.recorded_source_path = source_path
+                self.thread_local.recorded_source_path_line = \
+                    self._format_source_path(indent=indent,
+                                             source_path=source_path)
+        elif self.last_source_path != source_path:
+            self._write(self._format_source_path(indent=indent,
+                                                 source_path=source_path))
             self.last_source_path = source_path
         source_line = source[line_no - 1]
         thread_info = ""
@@ -504,26 +1976,26 @@ class Tracer:
 
         ### Reporting newish and modified variables: ##########################
         #                                                                     #
-        old_local_reprs = self.frame_to_local_reprs.get(frame, {})
-        self.frame_to_local_reprs[frame] = local_reprs = \
+        old_local_reprs = frame_state.local_reprs
+        frame_state.local_reprs = local_reprs = \
                                        get_local_reprs(frame,
                                                        watch=self.watch, custom_repr=self.custom_repr,
                                                        max_length=self.max_variable_length,
                                                        normalize=self.normalize,
+                                                       repr_cache=frame_state.repr_cache,
                                                        )
 
-        newish_string = ('Starting var:.. ' if event == 'call' else
-                                                            'New var:....... ')
+        format_newish_var = (self._format_starting_var if event == 'call'
+                             else self._format_new_var)
 
         for name, value_repr in local_reprs.items():
             if name not in old_local_reprs:
-                self.write('{indent}{_FOREGROUND_GREEN}{_STYLE_DIM}'
-                           '{newish_string}{_STYLE_NORMAL}{name} = '
-                           '{value_repr}{_STYLE_RESET_ALL}'.format(**locals()))
+                self._write(format_newish_var(indent=indent, name=name,
+                                              value_repr=value_repr))
             elif old_local_reprs[name] != value_repr:
-                self.write('{indent}{_FOREGROUND_GREEN}{_STYLE_DIM}'
-                           'Modified var:.. {_STYLE_NORMAL}{name} = '
-                           '{value_repr}{_STYLE_RESET_ALL}'.format(**locals()))
+                self._write(self._format_modified_var(
+                    indent=indent, name=name, value_repr=value_repr
+                ))
 
         #                                                                     #
         ### Finished newish and modified variables. ###########################
@@ -531,22 +2003,13 @@ class Tracer:
 
         ### Dealing with misplaced function definition: #######################
         #                                                                     #
-        if event == 'call' and source_line.lstrip().startswith('@'):
-            # If a function decorator is found, skip lines until an actual
-            # function definition is found.
-            for candidate_line_no in itertools.count(line_no):
-                try:
-                    candidate_source_line = source[candidate_line_no - 1]
-                except IndexError:
-                    # End of source file reached without finding a function
-                    # definition. Fall back to original source line.
-                    break
-
-                if candidate_source_line.lstrip().startswith('def'):
-                    # Found the def line!
-                    line_no = candidate_line_no
-                    source_line = candidate_source_line
-                    break
+        if event == 'call' and line_no == frame.f_code.co_firstlineno:
+            # If the function is decorated, show its def line rather than its
+            # first decorator.
+            def_line_no = get_def_line_no(frame.f_code, source)
+            if def_line_no != line_no:
+                line_no = def_line_no
+                source_line = source[line_no - 1]
         #                                                                     #
         ### Finished dealing with misplaced function definition. ##############
 
@@ -555,16 +2018,17 @@ class Tracer:
         # https://stackoverflow.com/a/12800909/2482744
         ended_by_exception = call_ended_by_exception(frame, event, arg)
 
-        if ended_by_exception:
-            self.write('{_FOREGROUND_RED}{indent}Call ended by exception{_STYLE_RESET_ALL}'.
-                       format(**locals()))
-        else:
-            self.write(u'{indent}{_STYLE_DIM}{timestamp} {thread_info}{event:9} '
-                       u'{line_no:4}{_STYLE_RESET_ALL} {source_line}'.format(**locals()))
+        format_event = (self._format_call_ended_by_exception
+                        if ended_by_exception else self._format_event)
+        self._write(format_event(
+            indent=indent, timestamp=timestamp, thread_info=thread_info,
+            event=event, line_no=line_no, source_line=source_line,
+            source_path=source_path, function_name=frame.f_code.co_name
+        ))
 
         if event == 'return':
-            self.frame_to_local_reprs.pop(frame, None)
-            self.start_times.pop(frame, None)
+            self.frame_states.pop(frame_id, None)
+            self.frame_ids_within_depth.discard(frame_id)
             thread_global.depth -= 1
 
             if not ended_by_exception:
@@ -573,17 +2037,22 @@ class Tracer:
                                                             max_length=self.max_variable_length,
                                                             normalize=self.normalize,
                                                             )
-                self.write('{indent}{_FOREGROUND_CYAN}{_STYLE_DIM}'
-                           'Return value:.. {_STYLE_NORMAL}{return_value_repr}'
-                           '{_STYLE_RESET_ALL}'.
-                           format(**locals()))
+                self._write(self._format_return_value(
+                    indent=indent, return_value_repr=return_value_repr
+                ))
 
         if event == 'exception':
             exception = utils.format_exception(*arg[:2])
             if self.max_variable_length:
                 exception = utils.truncate(exception, self.max_variable_length)
-            self.write('{indent}{_FOREGROUND_RED}Exception:..... '
-                       '{_STYLE_BRIGHT}{exception}'
-                       '{_STYLE_RESET_ALL}'.format(**locals()))
+            self._write(self._format_exception(indent=indent,
+                                               exception=exception))
+
+        if self.flight_recorder and (event == 'exception' or
+                                     ended_by_exception):
+            self._dump_flight_recorder()
 
         return self.trace
+
+
+_internal_filename = Tracer.__enter__.__code__.co_filename
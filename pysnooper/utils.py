@@ -3,10 +3,13 @@
 
 import abc
 import re
+import time
 import traceback
 
 import sys
-from .pycompat import ABC, string_types, collections_abc
+from .pycompat import (ABC, string_types, collections_abc, text_type,
+                       binary_type, integer_types)
+from . import bounded_repr
 
 def _check_methods(C, *methods):
     mro = C.__mro__
@@ -49,14 +52,68 @@ def shitcode(s):
 
 
 def get_repr_function(item, custom_repr):
+    if isinstance(custom_repr, CompiledCustomRepr):
+        return custom_repr.get_repr_function(item)
     for condition, action in custom_repr:
         if isinstance(condition, type):
-            condition = lambda x, y=condition: isinstance(x, y)
-        if condition(item):
+            if isinstance(item, condition):
+                return action
+        elif condition(item):
             return action
     return repr
 
 
+class CompiledCustomRepr(tuple):
+    '''
+    A `custom_repr` sequence that remembers which repr function each type gets.
+
+    Type conditions only depend on the type of the value, so for each concrete
+    type we walk `custom_repr` once and remember the result. Only conditions
+    that are functions, and come before the first matching type, still need
+    to be called for every value.
+    '''
+    def __new__(cls, custom_repr):
+        self = tuple.__new__(cls, custom_repr)
+        self.type_to_plan = {}
+        return self
+
+    def _get_plan(self, item_type):
+        try:
+            return self.type_to_plan[item_type]
+        except KeyError:
+            pass
+        predicates = []
+        repr_function = repr
+        for condition, action in self:
+            if isinstance(condition, type):
+                if issubclass(item_type, condition):
+                    repr_function = action
+                    break
+            else:
+                predicates.append((condition, action))
+        plan = self.type_to_plan[item_type] = (tuple(predicates),
+                                               repr_function)
+        return plan
+
+    def get_repr_function(self, item):
+        if not self:
+            return repr
+        item_type = type(item)
+        try:
+            is_fake_class = item.__class__ is not item_type
+        except Exception:
+            is_fake_class = False
+        if is_fake_class:
+            # Proxies that fake their class, like `Mock(spec=...)`, pass
+            # `isinstance` checks that the type alone wouldn't.
+            return get_repr_function(item, tuple(self))
+        predicates, repr_function = self._get_plan(item_type)
+        for condition, action in predicates:
+            if condition(item):
+                return action
+        return repr_function
+
+
 DEFAULT_REPR_RE = re.compile(r' at 0x[a-f0-9A-F]{4,}')
 
 
@@ -65,20 +122,65 @@ def normalize_repr(item_repr):
     return DEFAULT_REPR_RE.sub('', item_repr)
 
 
+def clean_repr(item_repr, normalize=False):
+    item_repr = item_repr.replace('\r', '').replace('\n', '')
+    if normalize:
+        item_repr = normalize_repr(item_repr)
+    return item_repr
+
+
 def get_shortish_repr(item, custom_repr=(), max_length=None, normalize=False):
     repr_function = get_repr_function(item, custom_repr)
+    if repr_function is repr and max_length and max_length >= 4 and \
+                 bounded_repr.is_bounded_repr_worthwhile(item, max_length):
+        # Don't build a huge repr just to show a few characters of it.
+        try:
+            return bounded_repr.get_bounded_repr(
+                item, max_length,
+                clean=lambda item_repr: clean_repr(item_repr, normalize)
+            )
+        except Exception:
+            return truncate('REPR FAILED', max_length)
     try:
         r = repr_function(item)
     except Exception:
         r = 'REPR FAILED'
-    r = r.replace('\r', '').replace('\n', '')
-    if normalize:
-        r = normalize_repr(r)
+    r = clean_repr(r, normalize)
     if max_length:
         r = truncate(r, max_length)
     return r
 
 
+immutable_scalar_types = frozenset(integer_types + (
+    bool, float, complex, type(None), text_type, binary_type, range,
+))
+
+
+def is_immutable(item):
+    """Whether `item` and everything inside it can never change.
+
+    Subclasses don't count, since they might have a `__repr__` that depends on
+    mutable state. To keep this cheap on every event, at most
+    `bounded_repr.MAX_SCANNED_ENTRIES` entries are looked at, over all nested
+    tuples and frozensets together; anything bigger counts as mutable.
+    """
+    items = [item]
+    n_scanned_entries = 0
+    while items:
+        item = items.pop()
+        item_type = type(item)
+        if item_type in immutable_scalar_types:
+            continue
+        elif item_type in (tuple, frozenset):
+            n_scanned_entries += len(item)
+            if n_scanned_entries > bounded_repr.MAX_SCANNED_ENTRIES:
+                return False
+            items.extend(item)
+        else:
+            return False
+    return True
+
+
 def truncate(string, max_length):
     if (max_length is None) or (len(string) <= max_length):
         return string
@@ -88,6 +190,38 @@ def truncate(string, max_length):
         return u'{}...{}'.format(string[:left], string[-right:])
 
 
+class TimestampFormatter(object):
+    '''
+    Format a number of microseconds as `HH:MM:SS.ffffff`.
+
+    Working out the hours, minutes and seconds is the slow part, and it only
+    changes once a second, so we keep the last result.
+    '''
+    def __init__(self, format_seconds):
+        self.format_seconds = format_seconds
+        # One tuple, so threads never see the seconds of one call with the
+        # prefix of another:
+        self.last_seconds_and_prefix = (None, None)
+
+    def __call__(self, microseconds):
+        seconds, microseconds = divmod(microseconds, 1000000)
+        last_seconds, prefix = self.last_seconds_and_prefix
+        if seconds != last_seconds:
+            prefix = self.format_seconds(seconds)
+            self.last_seconds_and_prefix = (seconds, prefix)
+        return '%s%06d' % (prefix, microseconds)
+
+
+format_time_of_day = TimestampFormatter(
+    lambda seconds: time.strftime('%H:%M:%S.', time.localtime(seconds))
+)
+
+format_duration = TimestampFormatter(
+    lambda seconds: '%02d:%02d:%02d.' % (seconds // 3600 % 24,
+                                         seconds // 60 % 60, seconds % 60)
+)
+
+
 def format_exception(exc_type, exc_value):
     try:
         is_group = isinstance(exc_value, BaseExceptionGroup)
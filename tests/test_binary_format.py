@@ -0,0 +1,177 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import re
+
+import pytest
+
+import pysnooper
+from pysnooper import binary_format, utils
+from pysnooper.__main__ import main
+
+from . import mini_toolbox
+
+
+def bar(x):
+    return [x] * 3
+
+
+def foo(x):
+    y = bar(x)
+    try:
+        raise ValueError(y)
+    except ValueError:
+        pass
+    for i in range(2):
+        y.append(i)
+    return y
+
+
+def gen(n):
+    for i in range(n):
+        yield i * 2
+
+
+def snoop_foo(output, **kwargs):
+    snooped_foo = pysnooper.snoop(output, depth=2, color=False,
+                                  watch=('len(y)',), **kwargs)(foo)
+    snooped_gen = pysnooper.snoop(output, color=False, **kwargs)(gen)
+    assert snooped_foo(7) == [7, 7, 7, 0, 1]
+    assert list(snooped_gen(2)) == [0, 2]
+
+
+def render(data, **kwargs):
+    return u''.join(binary_format.render(
+        binary_format.read_records(io.BytesIO(data)), **kwargs
+    ))
+
+
+def without_elapsed_times(text):
+    # Elapsed times are shown even with `normalize=True`.
+    return re.sub('Elapsed time: [0-9:.]+', 'Elapsed time: ', text)
+
+
+@pytest.mark.parametrize('prefix', ('', 'ZZZ {} '))
+def test_render_matches_text(prefix):
+    string_io = io.StringIO()
+    snoop_foo(string_io, normalize=True, prefix=prefix)
+    bytes_io = io.BytesIO()
+    snoop_foo(bytes_io, normalize=True, prefix=prefix, format='binary')
+    assert without_elapsed_times(render(bytes_io.getvalue())) == \
+                                without_elapsed_times(string_io.getvalue())
+    assert len(bytes_io.getvalue()) < len(string_io.getvalue().encode())
+
+
+def test_render_normalize():
+    string_io = io.StringIO()
+    snoop_foo(string_io, normalize=True)
+    bytes_io = io.BytesIO()
+    snoop_foo(bytes_io, format='binary')
+    text = render(bytes_io.getvalue())
+    assert text != string_io.getvalue()
+    assert without_elapsed_times(render(bytes_io.getvalue(),
+                                      normalize=True)) == \
+                                without_elapsed_times(string_io.getvalue())
+
+
+def test_render_timestamps():
+    microseconds = 1571234567 * 1000000 + 123456
+    bytes_io = io.BytesIO()
+    binary_sink = binary_format.BinarySink(bytes_io.write)
+    binary_sink.write(('event', (1, 'MainThread'), 1, microseconds, '',
+                       'line', 7, 'x = 1', 'foo.py', 'f'))
+    binary_sink.write(('event', (1, 'MainThread'), 1, microseconds + 2000000,
+                       '', 'line', 8, 'y = 2', 'foo.py', 'f'))
+    binary_sink.write(('elapsed_time', (1, 'MainThread'), 0, 2000001))
+    assert render(bytes_io.getvalue()).splitlines() == [
+        u'    {} line         7 x = 1'.format(
+            utils.format_time_of_day(microseconds)
+        ),
+        u'    {} line         8 y = 2'.format(
+            utils.format_time_of_day(microseconds + 2000000)
+        ),
+        u'Elapsed time: 00:00:02.000001',
+    ]
+
+    relative_bytes_io = io.BytesIO()
+    binary_sink = binary_format.BinarySink(relative_bytes_io.write,
+                                           relative_time=True)
+    binary_sink.write(('event', (1, 'MainThread'), 0, 1500, '', 'call', 7,
+                       'def f():', 'foo.py', 'f'))
+    assert render(relative_bytes_io.getvalue()) == \
+                      u'00:00:00.001500 call         7 def f():\n'
+
+
+def test_string_table_reset(monkeypatch):
+    monkeypatch.setattr(binary_format, 'MAX_TABLE_SIZE', 3)
+    string_io = io.StringIO()
+    snoop_foo(string_io, normalize=True)
+    bytes_io = io.BytesIO()
+    snoop_foo(bytes_io, normalize=True, format='binary')
+    assert without_elapsed_times(render(bytes_io.getvalue())) == \
+                                without_elapsed_times(string_io.getvalue())
+
+
+def test_binary_file_async():
+    string_io = io.StringIO()
+    snoop_foo(string_io, normalize=True)
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'trace.bin'
+        snoop_foo(str(path), normalize=True, format='binary',
+                  async_output=True)
+        pysnooper.tracer.flush_all_writers()
+        with path.open('rb') as file:
+            assert without_elapsed_times(render(file.read())) == \
+                                without_elapsed_times(string_io.getvalue())
+
+
+@pytest.mark.parametrize('inner_prefix', ('', 'ZZZ '))
+def test_two_tracers_one_file(inner_prefix):
+    # The lines of two tracers are interleaved in the file, and they share
+    # its string table.
+    def snoop_foo_and_bar(output, **kwargs):
+        snooped_bar = pysnooper.snoop(output, color=False, normalize=True,
+                                      prefix=inner_prefix, **kwargs)(bar)
+        snooped_foo = pysnooper.snoop(output, color=False, normalize=True,
+                                      **kwargs)(foo)
+        with mini_toolbox.TempValueSetter((globals(), 'bar'), snooped_bar):
+            assert snooped_foo(7) == [7, 7, 7, 0, 1]
+            assert snooped_bar(8) == [8, 8, 8]
+
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        text_path = folder / 'trace.log'
+        snoop_foo_and_bar(str(text_path))
+        binary_path = folder / 'trace.bin'
+        snoop_foo_and_bar(str(binary_path), format='binary')
+        with text_path.open(encoding='utf-8') as file:
+            text = file.read()
+        with binary_path.open('rb') as file:
+            rendered = render(file.read())
+    assert text.count('return [x] * 3') == 4
+    assert without_elapsed_times(rendered) == without_elapsed_times(text)
+
+
+def test_render_command(capsys):
+    string_io = io.StringIO()
+    snoop_foo(string_io, normalize=True)
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'trace.bin'
+        snoop_foo(str(path), format='binary')
+        main(['render', str(path), '--normalize'])
+        assert without_elapsed_times(capsys.readouterr().out) == \
+                                without_elapsed_times(string_io.getvalue())
+        main(['render', str(path), '--color'])
+        assert '\x1b[' in capsys.readouterr().out
+
+
+def test_not_a_trace():
+    with pytest.raises(ValueError):
+        render(b'\x0a\x00PYSNOOPIN\x01')
+    with pytest.raises(ValueError):
+        render(b'\x0c\x00PYSNOOPER')
+
+
+def test_bad_format():
+    with pytest.raises(ValueError):
+        pysnooper.snoop(format='xml')
@@ -5,12 +5,14 @@ f_lasti can be -1, and co_code[-1] would read the wrong opcode and misreport a
 normal return as "Call ended by exception".
 """
 
+import dis
 import io
 import opcode
 from unittest.mock import Mock
 
 import pysnooper
-from pysnooper.tracer import call_ended_by_exception
+from pysnooper.tracer import (call_ended_by_exception, get_return_offsets,
+                              RETURN_OPCODES)
 
 
 def _frame(co_code, f_lasti):
@@ -60,3 +62,18 @@ def test_unstarted_generator_close_is_not_an_exception():
     output = string_io.getvalue()
     assert "Call ended by exception" not in output
     assert "Return value:.. 42" in output
+
+
+def test_return_offsets_match_dis():
+    def f(x):
+        if x:
+            return 1
+        for i in range(x):
+            yield i
+        return 2
+
+    instructions = dis.get_instructions(f)
+    expected = {instruction.offset for instruction in instructions
+                if instruction.opname in RETURN_OPCODES}
+    assert expected
+    assert get_return_offsets(f.__code__) == expected
@@ -0,0 +1,87 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import re
+
+import pytest
+
+import pysnooper
+from pysnooper import histograms
+
+
+def test_buckets():
+    last_high = -1
+    for index in range(3000):
+        low, high = histograms.get_bucket_bounds(index)
+        assert low == last_high + 1
+        last_high = high
+        for duration in {low, (low + high) // 2, high}:
+            assert histograms.get_bucket_index(duration) == index
+            # Off by less than 1%:
+            assert high - low <= duration // 128
+
+
+def test_percentiles():
+    histogram = histograms.LatencyHistogram(u'f', None)
+    assert histogram.get_percentile(50) == 0
+    for duration in range(1000, 1001000, 1000):
+        histogram.record(duration)
+    assert histogram.count == 1000
+    assert histogram.max == 1000000
+    for percentile in (50, 90, 99):
+        expected = percentile * 10000
+        assert expected <= histogram.get_percentile(percentile) <= \
+                                                            expected * 1.01
+    assert histogram.get_percentile(100) == 1000000
+    assert len(histogram.counts) < 2000
+
+
+def test_histogram():
+    string_io = io.StringIO()
+    tracer = pysnooper.snoop(string_io, histogram=True, normalize=True)
+
+    @tracer
+    def f(x):
+        return x * 2
+
+    @tracer
+    def g(n):
+        for i in range(n):
+            yield i
+
+    for i in range(100):
+        f(i)
+    assert list(g(3)) == [0, 1, 2]
+    with tracer:
+        pass
+    # Calls are only timed, not traced.
+    assert string_io.getvalue() == ''
+    tracer.write_histograms()
+    lines = string_io.getvalue().splitlines()
+    assert len(lines) == 3
+    pattern = (r'^{} \(test_histograms.py:[0-9]+\): {} calls, '
+               r'p50 [0-9:.]+, p90 [0-9:.]+, p99 [0-9:.]+, max [0-9:.]+$')
+    assert re.match(pattern.format('f', 100), lines[0])
+    # A generator is timed each time it runs, up to its end.
+    assert re.match(pattern.format('g', 4), lines[1])
+    assert re.match(pattern.format('with block', 1), lines[2])
+
+
+def test_histogram_sample_every():
+    string_io = io.StringIO()
+    tracer = pysnooper.snoop(string_io, histogram=True, sample_every=10)
+
+    @tracer
+    def f(x):
+        return x * 2
+
+    for i in range(100):
+        assert f(i) == i * 2
+    tracer.write_histograms()
+    assert ': 10 calls, ' in string_io.getvalue()
+
+
+def test_histogram_and_profile():
+    with pytest.raises(ValueError):
+        pysnooper.snoop(histogram=True, profile=True)
@@ -0,0 +1,108 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import json
+import threading
+
+import pysnooper
+from pysnooper.jsonl_format import JsonLinesSink
+
+from . import mini_toolbox
+
+
+def bar(x):
+    raise KeyError(x)
+
+
+def foo(x):
+    y = x + 1
+    try:
+        bar(y)
+    except KeyError:
+        pass
+    y = [y, u'\u05e9"']
+    return y
+
+
+def read_objects(text):
+    objects = [json.loads(line) for line in text.splitlines()]
+    for object_ in objects:
+        assert object_.pop('thread') == threading.current_thread().ident
+        assert object_.pop('thread_name') == threading.current_thread().name
+    return objects
+
+
+def test_jsonl():
+    string_io = io.StringIO()
+    tracer = pysnooper.snoop(string_io, depth=2, normalize=True,
+                             format='jsonl')
+    assert tracer(foo)(1) == [2, u'\u05e9"']
+    tracer.write(u'Hello {}')
+    objects = read_objects(string_io.getvalue())
+    elapsed_time = objects.pop(-2)
+    assert elapsed_time['event'] == 'elapsed_time'
+    assert elapsed_time['elapsed_time'] >= 0
+    assert objects.pop() == {'event': 'custom_line', 'depth': 0,
+                             'message': 'Hello {}'}
+
+    def event(event, depth, line_no, source, new_vars={}, modified_vars={},
+              return_value=None, exception=None, ended_by_exception=False):
+        return {
+            'event': event, 'timestamp': None, 'depth': depth,
+            'file': 'test_jsonl_format.py',
+            'function': 'bar' if depth else 'foo', 'line': line_no,
+            'source': source, 'new_vars': new_vars,
+            'modified_vars': modified_vars, 'return_value': return_value,
+            'exception': exception, 'ended_by_exception': ended_by_exception,
+        }
+
+    assert objects == [
+        event('call', 0, 18, 'def foo(x):', new_vars={'x': '1'}),
+        event('line', 0, 19, '    y = x + 1'),
+        event('line', 0, 20, '    try:', new_vars={'y': '2'}),
+        event('line', 0, 21, '        bar(y)'),
+        event('call', 1, 14, 'def bar(x):', new_vars={'x': '2'}),
+        event('line', 1, 15, '    raise KeyError(x)'),
+        event('exception', 1, 15, '    raise KeyError(x)',
+              exception='KeyError: 2'),
+        event('return', 1, 15, '    raise KeyError(x)',
+              ended_by_exception=True),
+        event('exception', 0, 21, '        bar(y)', exception='KeyError: 2'),
+        event('line', 0, 22, '    except KeyError:'),
+        event('line', 0, 23, '        pass'),
+        event('line', 0, 24, u'    y = [y, u\'\\u05e9"\']'),
+        event('line', 0, 25, '    return y',
+              modified_vars={'y': u'[2, \'\u05e9"\']'}),
+        event('return', 0, 25, '    return y',
+              return_value=u'[2, \'\u05e9"\']'),
+    ]
+
+
+def test_jsonl_timestamps():
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'trace.jsonl'
+        pysnooper.snoop(str(path), format='jsonl',
+                        relative_time=True)(foo)(1)
+        with path.open() as file:
+            objects = read_objects(file.read())
+    timestamps = [object_['timestamp'] for object_ in objects
+                  if object_['event'] != 'elapsed_time']
+    assert len(timestamps) == 10
+    assert all(isinstance(timestamp, int) for timestamp in timestamps)
+    assert timestamps[0] == 0
+
+
+def test_jsonl_missing_return_value():
+    string_io = io.StringIO()
+    sink = JsonLinesSink(string_io.write)
+    thread = (7, 'MyThread')
+    sink.write(('event', thread, 0, 5, '', 'return', 3, 'return x', 'a.py',
+                'f'))
+    assert string_io.getvalue() == ''
+    sink.write(('dropped_lines', None, 0, 2))
+    objects = [json.loads(line) for line in string_io.getvalue().splitlines()]
+    assert [(object_['event'], object_['thread']) for object_ in objects] == \
+                                       [('return', 7), ('dropped_lines', None)]
+    assert objects[0]['return_value'] is None
+    assert objects[1]['n_dropped'] == 2
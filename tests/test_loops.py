@@ -0,0 +1,129 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import json
+import re
+
+import pytest
+
+import pysnooper
+from pysnooper import binary_format, loops
+
+
+def count_up(n):
+    total = 0
+    i = 0
+    while i < n:
+        total += i
+        i += 1
+    return total
+
+
+def double(x):
+    return 2 * x
+
+
+def count_up_doubled(n):
+    total = 0
+    i = 0
+    while i < n:
+        total += double(i)
+        i += 1
+    return total
+
+
+def test_format_line_nos():
+    assert loops.format_line_nos((7, 5, 6)) == '5-7'
+    assert loops.format_line_nos((3, 4, 8, 3, 10, 11)) == '3-4, 8, 10-11'
+    assert loops.format_line_nos((9,)) == '9'
+
+
+def test_loop_detector():
+    loop_detector = loops.LoopDetector(2)
+    line_nos = [1, 2] + [3, 4, 5] * 5 + [3, 6]
+    left_out = [loop_detector.add_line(line_no) for line_no in line_nos[:-1]]
+    # Two iterations in full, then the rest are left out:
+    assert left_out == [False] * 8 + [True] * 10
+    assert loop_detector.cycle == (3, 4, 5)
+    assert loop_detector.n_repeats == 4
+    # Line 6 ends the loop.
+    assert not loop_detector.add_line(6)
+    loop_detector.reset()
+    assert not loop_detector.is_compressing
+    assert not loop_detector.add_line(6)
+
+
+def test_loop_detector_changing_cycle():
+    loop_detector = loops.LoopDetector(3)
+    # An iteration that goes a different way starts the count over.
+    line_nos = [3, 4] * 2 + [3, 5] + [3, 4] * 3
+    assert not any(loop_detector.add_line(line_no) for line_no in line_nos)
+    assert loop_detector.add_line(3)
+
+
+def test_compress_loops():
+    string_io = io.StringIO()
+    snooped_count_up = pysnooper.snoop(string_io, normalize=True, color=False,
+                                       compress_loops=3)(count_up)
+    assert snooped_count_up(1000) == 499500
+    output = string_io.getvalue()
+    assert output.count('while i < n:') == 3
+    assert output.count('total += i') == 3
+    summary = ('Lines 17-19 repeated 998 times; last values: total = 499500, '
+               'i = 1000\n')
+    assert re.findall('^Lines .*$', output, re.MULTILINE) == [summary[:-1]]
+    # The variables aren't reported again after the summary:
+    assert 'i = 1000' not in output.split(summary)[1]
+    assert output.count('\n') < 40
+
+
+def test_compress_loops_with_calls():
+    # Calls within `depth` in each iteration are all shown.
+    string_io = io.StringIO()
+    pysnooper.snoop(string_io, normalize=True, color=False, depth=2,
+                    compress_loops=1)(count_up_doubled)(20)
+    output = string_io.getvalue()
+    assert output.count('return 2 * x') == 40
+    assert 'repeated' not in output
+
+
+def test_compress_loops_with_block():
+    string_io = io.StringIO()
+    with pysnooper.snoop(string_io, normalize=True, color=False,
+                         compress_loops=2):
+        i = 0
+        while i < 50:
+            i += 1
+    output = string_io.getvalue()
+    assert re.search('^Lines [0-9]+-[0-9]+ repeated 49 times; '
+                     'last values: i = 50$', output, re.MULTILINE)
+
+
+def test_compress_loops_validation():
+    with pytest.raises(ValueError):
+        pysnooper.snoop(compress_loops=0)
+
+
+def test_compress_loops_formats():
+    string_io = io.StringIO()
+    pysnooper.snoop(string_io, normalize=True, color=False,
+                    compress_loops=2)(count_up)(10)
+    bytes_io = io.BytesIO()
+    pysnooper.snoop(bytes_io, normalize=True, format='binary',
+                    compress_loops=2)(count_up)(10)
+    rendered = u''.join(binary_format.render(
+        binary_format.read_records(io.BytesIO(bytes_io.getvalue()))
+    ))
+    assert rendered.split('Elapsed time')[0] == \
+                                   string_io.getvalue().split('Elapsed time')[0]
+
+    string_io = io.StringIO()
+    pysnooper.snoop(string_io, normalize=True, format='jsonl',
+                    compress_loops=2)(count_up)(10)
+    objects = [json.loads(line) for line in string_io.getvalue().splitlines()]
+    (repeated_lines,) = [object_ for object_ in objects
+                         if object_['event'] == 'repeated_lines']
+    assert repeated_lines['line_nos'] == '17-19'
+    assert repeated_lines['n_repeats'] == 9
+    assert repeated_lines['last_values'] == {'total': '45', 'i': '10'}
@@ -0,0 +1,244 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import sys
+
+import pytest
+
+import pysnooper
+from pysnooper import monitoring
+from .utils import (assert_output, VariableEntry, CallEntry, LineEntry,
+                    ReturnEntry, ReturnValueEntry, ExceptionEntry,
+                    ExceptionValueEntry, SourcePathEntry,
+                    CallEndedByExceptionEntry, ElapsedTimeEntry)
+
+
+requires_monitoring = pytest.mark.skipif(
+    not monitoring.is_available,
+    reason='sys.monitoring requires Python 3.12+'
+)
+
+
+@requires_monitoring
+def test_monitoring_backend():
+    string_io = io.StringIO()
+
+    trace_functions = []
+
+    @pysnooper.snoop(string_io, color=False, backend='monitoring')
+    def my_function(foo):
+        trace_functions.append(sys.gettrace())
+        x = 7
+        return foo + x
+
+    assert my_function(8) == 15
+    assert trace_functions == [None]
+    assert_output(
+        string_io.getvalue(),
+        (
+            SourcePathEntry(),
+            VariableEntry('foo', '8'),
+            VariableEntry('trace_functions'),
+            CallEntry('def my_function(foo):'),
+            LineEntry('trace_functions.append(sys.gettrace())'),
+            VariableEntry('trace_functions', '[None]'),
+            LineEntry('x = 7'),
+            VariableEntry('x', '7'),
+            LineEntry('return foo + x'),
+            ReturnEntry('return foo + x'),
+            ReturnValueEntry('15'),
+            ElapsedTimeEntry(),
+        )
+    )
+
+
+@requires_monitoring
+def test_monitoring_backend_depth():
+    string_io = io.StringIO()
+
+    def f3(x3):
+        return x3 * 2
+
+    def f2(x2):
+        result2 = f3(x2)
+        return result2
+
+    @pysnooper.snoop(string_io, depth=2, color=False, backend='monitoring')
+    def f1(x1):
+        result1 = f2(x1)
+        return result1
+
+    assert f1(10) == 20
+    # Calling `f2` outside of the snoop shouldn't write anything:
+    assert f2(1) == 2
+    assert_output(
+        string_io.getvalue(),
+        (
+            SourcePathEntry(),
+            VariableEntry('x1', '10'),
+            VariableEntry('f2'),
+            CallEntry('def f1(x1):'),
+            LineEntry('result1 = f2(x1)'),
+
+            VariableEntry('x2', '10'),
+            VariableEntry('f3'),
+            CallEntry('def f2(x2):'),
+            LineEntry('result2 = f3(x2)'),
+            VariableEntry('result2', '20'),
+            LineEntry('return result2'),
+            ReturnEntry('return result2'),
+            ReturnValueEntry('20'),
+
+            VariableEntry('result1', '20'),
+            LineEntry('return result1'),
+            ReturnEntry('return result1'),
+            ReturnValueEntry('20'),
+            ElapsedTimeEntry(),
+        )
+    )
+
+
+@requires_monitoring
+def test_monitoring_backend_exception():
+    string_io = io.StringIO()
+
+    @pysnooper.snoop(string_io, color=False, backend='monitoring')
+    def f():
+        x = 1
+        raise ValueError('bad')
+
+    with pytest.raises(ValueError):
+        f()
+
+    assert_output(
+        string_io.getvalue(),
+        (
+            SourcePathEntry(),
+            CallEntry('def f():'),
+            LineEntry('x = 1'),
+            VariableEntry('x', '1'),
+            LineEntry("raise ValueError('bad')"),
+            ExceptionEntry("raise ValueError('bad')"),
+            ExceptionValueEntry("ValueError: bad"),
+            CallEndedByExceptionEntry(),
+            ElapsedTimeEntry(),
+        )
+    )
+
+
+@requires_monitoring
+def test_monitoring_backend_generator():
+    string_io = io.StringIO()
+
+    @pysnooper.snoop(string_io, color=False, backend='monitoring')
+    def f(x1):
+        x2 = (yield x1)
+        yield x2
+
+    generator = f(0)
+    assert next(generator) == 0
+    assert generator.send('blabla') == 'blabla'
+
+    assert_output(
+        string_io.getvalue(),
+        (
+            SourcePathEntry(),
+            VariableEntry('x1', '0'),
+            CallEntry(),
+            LineEntry(),
+            ReturnEntry(),
+            ReturnValueEntry('0'),
+            ElapsedTimeEntry(),
+
+            VariableEntry('x1', '0'),
+            CallEntry(),
+            VariableEntry('x2', "'blabla'"),
+            LineEntry(),
+            ReturnEntry(),
+            ReturnValueEntry("'blabla'"),
+            ElapsedTimeEntry(),
+        )
+    )
+
+
+@requires_monitoring
+def test_monitoring_backend_with_block():
+    string_io = io.StringIO()
+
+    def f():
+        x = 1
+        with pysnooper.snoop(string_io, color=False, backend='monitoring'):
+            y = 2
+        z = 3
+        return x + y + z
+
+    assert f() == 6
+    assert_output(
+        string_io.getvalue(),
+        (
+            SourcePathEntry(),
+            VariableEntry('x', '1'),
+            VariableEntry('string_io'),
+            LineEntry('y = 2'),
+            VariableEntry('y', '2'),
+            LineEntry(),
+            ElapsedTimeEntry(),
+        )
+    )
+
+
+@requires_monitoring
+def test_monitoring_backend_switches_off():
+    string_io = io.StringIO()
+
+    def f():
+        x = 1
+        with pysnooper.snoop(string_io, color=False, backend='monitoring'):
+            y = 2
+        return x + y
+
+    def get_local_events(code):
+        return sys.monitoring.get_local_events(monitoring.dispatcher.tool_id,
+                                               code)
+
+    snooped_f = pysnooper.snoop(string_io, backend='monitoring')(f)
+    snooped_f()
+    # Once the tracers have exited, their code isn't monitored anymore:
+    assert get_local_events(f.__code__) == 0
+    assert f.__code__ not in monitoring.dispatcher.code_counts
+    assert f.__code__ not in monitoring.dispatcher.code_lines
+
+
+@requires_monitoring
+def test_monitoring_backend_single_line_loops():
+    # Each iteration of a loop that fits on one line is a line event, just
+    # like with `sys.settrace`.
+    def f():
+        t = 0
+        for i in range(3): t += i
+        while t < 10: t += 1
+        return t
+
+    outputs = []
+    for backend in ('settrace', 'monitoring'):
+        string_io = io.StringIO()
+        pysnooper.snoop(string_io, color=False, normalize=True,
+                        backend=backend)(f)()
+        outputs.append([line for line in string_io.getvalue().splitlines()
+                        if 'Elapsed time' not in line])
+    assert outputs[0] == outputs[1]
+    assert sum('for i in range(3)' in line for line in outputs[1]) == 4
+    assert sum('while t < 10' in line for line in outputs[1]) == 7
+
+
+def test_invalid_backend():
+    with pytest.raises(ValueError):
+        pysnooper.snoop(backend='whatever')
+
+
+@pytest.mark.skipif(monitoring.is_available,
+                    reason='sys.monitoring is available')
+def test_monitoring_backend_not_available():
+    with pytest.raises(NotImplementedError):
+        pysnooper.snoop(backend='monitoring')
@@ -0,0 +1,99 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import os
+import re
+import subprocess
+import sys
+import textwrap
+
+import pysnooper
+from pysnooper import profiling
+
+from . import mini_toolbox
+
+
+def test_profile():
+    string_io = io.StringIO()
+    tracer = pysnooper.snoop(string_io, profile=True, depth=2)
+
+    def double(x):
+        return x * 2
+
+    @tracer
+    def f(n):
+        total = 0
+        for i in range(n):
+            total += double(i)
+        return total
+
+    assert f(100) == 9900
+    assert f(10) == 90
+    # Nothing is written until the profile is asked for.
+    assert string_io.getvalue() == ''
+    tracer.write_profile()
+    lines = string_io.getvalue().splitlines()
+    assert lines[0] == 'Timer unit: 1e-06 s'
+    functions = [line for line in lines if line.startswith('Function: ')]
+    assert [function.split()[1] for function in functions] == ['double', 'f']
+    hits = dict(
+        (match.group(2).strip(), int(match.group(1)))
+        for match in map(re.compile(r'^ *[0-9]+ +([0-9]+) .*  (.*)$').match,
+                         lines) if match
+    )
+    assert hits == {
+        'return x * 2': 110,
+        'total = 0': 2,
+        'for i in range(n):': 112,
+        'total += double(i)': 110,
+        'return total': 2,
+    }
+    assert 'def double(x):' in string_io.getvalue()
+
+
+def test_code_profile_grows():
+    def f():
+        pass
+    code_profile = profiling.CodeProfile(f.__code__, 'a.py', ['x'] * 100)
+    n_lines = len(code_profile.hits)
+    code_profile.add_hit(f.__code__.co_firstlineno + n_lines + 2)
+    code_profile.add_time(f.__code__.co_firstlineno + n_lines + 2, 3, 2)
+    assert len(code_profile.hits) == len(code_profile.wall_times) == \
+                                  len(code_profile.cpu_times) == n_lines + 3
+    assert (code_profile.hits[-1], code_profile.wall_times[-1],
+            code_profile.cpu_times[-1]) == (1, 3, 2)
+
+
+def test_with_block_reports_at_exit():
+    # A `with` block's tracer is gone once the block ends, but what it kept
+    # for the end is still written when the process exits.
+    script = textwrap.dedent('''
+        import gc
+        import pysnooper
+
+        def f():
+            with pysnooper.snoop(profile=True):
+                x = sum(range(10))
+            with pysnooper.snoop(histogram=True):
+                y = 2
+
+        f()
+        gc.collect()
+    ''')
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))
+    )
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        script_path = folder / 'script.py'
+        with script_path.open('w') as script_file:
+            script_file.write(script)
+        process = subprocess.Popen([sys.executable, str(script_path)],
+                                   stderr=subprocess.PIPE, env=environment)
+        _, stderr = process.communicate()
+    assert process.returncode == 0
+    stderr = stderr.decode('utf-8')
+    assert re.search(r'(?m)^ +7 +1 .*x = sum\(range\(10\)\)$', stderr)
+    assert re.search(r'(?m)^with block \(.*script\.py:8\): 1 calls, p50 ',
+                     stderr)
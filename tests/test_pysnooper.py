@@ -1,14 +1,18 @@
 # Copyright 2019 Ram Rachum and collaborators.
 # This program is distributed under the MIT license.
 
+import gc
 import io
 import textwrap
 import threading
 import time
 import types
 import os
+import weakref
 import sys
 import zipfile
+import re
+import random
 
 from pysnooper.utils import truncate
 import pytest
@@ -718,6 +722,59 @@ def test_depth(normalize):
     )
 
 
+def test_frame_state_does_not_keep_frame_alive():
+    class Payload(object):
+        pass
+
+    payload_refs = []
+    tracer = pysnooper.snoop(io.StringIO(), color=False)
+
+    @tracer
+    def f():
+        payload = Payload()
+        payload_refs.append(weakref.ref(payload))
+        # Like a debugger taking over, so we never see this call return:
+        sys.settrace(None)
+
+    def run_in_thread():
+        f()
+
+    thread = threading.Thread(target=run_in_thread)
+    thread.start()
+    thread.join()
+    (payload_ref,) = payload_refs
+    assert payload_ref() is None
+    assert len(tracer.frame_states) == 1
+    tracer._sweep_frame_states()
+    assert not tracer.frame_states
+
+
+def test_depth_stops_tracing_out_of_depth_frames():
+    string_io = io.StringIO()
+    local_traces = {}
+
+    def f3():
+        local_traces['f3'] = sys._getframe().f_trace
+
+    def f2():
+        local_traces['f2'] = sys._getframe().f_trace
+        f3()
+
+    tracer = pysnooper.snoop(string_io, depth=2, color=False)
+
+    @tracer
+    def f1():
+        f2()
+
+    f1()
+    assert local_traces['f2'] is not None
+    assert local_traces['f3'] is None
+    assert not tracer.frame_ids_within_depth
+    output = string_io.getvalue()
+    assert 'def f2():' in output
+    assert 'def f3():' not in output
+
+
 @pytest.mark.parametrize("normalize", (True, False))
 def test_method_and_prefix(normalize):
     class Baz(object):
@@ -760,6 +817,29 @@ def test_method_and_prefix(normalize):
     )
 
 
+def test_prefix_with_braces():
+    string_io = io.StringIO()
+
+    @pysnooper.snoop(string_io, prefix='{x} ', color=False)
+    def f(x):
+        return x
+
+    assert f(3) == 3
+    assert_output(
+        string_io.getvalue(),
+        (
+            SourcePathEntry(prefix='{x} '),
+            VariableEntry('x', '3', prefix='{x} '),
+            CallEntry('def f(x):', prefix='{x} '),
+            LineEntry('return x', prefix='{x} '),
+            ReturnEntry('return x', prefix='{x} '),
+            ReturnValueEntry('3', prefix='{x} '),
+            ElapsedTimeEntry(prefix='{x} '),
+        ),
+        prefix='{x} ',
+    )
+
+
 @pytest.mark.parametrize("normalize", (True, False))
 def test_file_output(normalize):
     with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
@@ -794,6 +874,325 @@ def test_file_output(normalize):
         )
 
 
+def test_exit_handlers_only_when_buffered(monkeypatch):
+    # With `flush='line'` there's nothing to save from a `SIGTERM`, so the
+    # program's signal handlers are left alone.
+    calls = []
+    monkeypatch.setattr(pysnooper.tracer, '_install_exit_handlers',
+                        lambda: calls.append(None))
+    pysnooper.snoop('foo.log', flush='line')
+    assert not calls
+    pysnooper.snoop('foo.log', flush='call')
+    assert len(calls) == 1
+    pysnooper.snoop(io.StringIO(), async_output=True)
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("flush", ('line', 'call', 'interval', 'exit'))
+def test_file_output_flush(flush):
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'foo.log'
+
+        @pysnooper.snoop(str(path), flush=flush, flush_interval=60,
+                         color=False)
+        def my_function(foo):
+            x = 7
+            return foo + x
+
+        assert my_function(8) == 15
+        with path.open() as output_file:
+            output = output_file.read()
+        if flush in ('line', 'call'):
+            assert 'Elapsed time' in output
+        else:
+            assert 'Elapsed time' not in output
+        pysnooper.tracer.flush_all_writers()
+        with path.open() as output_file:
+            output = output_file.read()
+        assert_output(
+            output,
+            (
+                SourcePathEntry(),
+                VariableEntry('foo', '8'),
+                CallEntry('def my_function(foo):'),
+                LineEntry('x = 7'),
+                VariableEntry('x', '7'),
+                LineEntry('return foo + x'),
+                ReturnEntry('return foo + x'),
+                ReturnValueEntry('15'),
+                ElapsedTimeEntry(),
+            )
+        )
+
+
+def test_async_output():
+    string_io = io.StringIO()
+
+    @pysnooper.snoop(string_io, async_output=True, color=False)
+    def my_function(foo):
+        x = 7
+        return foo + x
+
+    assert my_function(8) == 15
+    pysnooper.tracer.flush_all_writers()
+    assert_output(
+        string_io.getvalue(),
+        (
+            SourcePathEntry(),
+            VariableEntry('foo', '8'),
+            CallEntry('def my_function(foo):'),
+            LineEntry('x = 7'),
+            VariableEntry('x', '7'),
+            LineEntry('return foo + x'),
+            ReturnEntry('return foo + x'),
+            ReturnValueEntry('15'),
+            ElapsedTimeEntry(),
+        )
+    )
+
+
+def test_async_output_many_tracers():
+    # All async writers share one thread, and don't keep their tracers alive.
+    string_io = io.StringIO()
+
+    def f(i):
+        tracer = pysnooper.snoop(string_io, async_output=True, color=False)
+        with tracer:
+            x = i
+        return weakref.ref(tracer)
+
+    tracer_refs = [f(i) for i in range(50)]
+    pysnooper.tracer.flush_all_writers()
+    assert string_io.getvalue().count('Elapsed time') == 50
+    assert sum(thread.name == 'pysnooper-writer'
+               for thread in threading.enumerate()) == 1
+    gc.collect()
+    assert not any(tracer_ref() for tracer_ref in tracer_refs)
+
+
+@pytest.mark.parametrize("overflow", ('drop_newest', 'drop_oldest'))
+def test_async_output_overflow(overflow):
+    string_io = io.StringIO()
+    can_write = threading.Event()
+
+    def write(s):
+        can_write.wait()
+        string_io.write(s)
+
+    @pysnooper.snoop(write, async_output=True, queue_size=2,
+                     overflow=overflow, color=False)
+    def my_function():
+        x = 1
+        y = 2
+        z = 3
+        return x + y + z
+
+    assert my_function() == 6
+    can_write.set()
+    pysnooper.tracer.flush_all_writers()
+    lines = string_io.getvalue().splitlines()
+    assert re.match(r'^\.\.\. [0-9]+ lines dropped$', lines[-1])
+    n_dropped = int(lines[-1].split()[1])
+    # Some lines may already be in the writer thread's hands when it blocks.
+    assert n_dropped + len(lines) - 1 == 12
+    assert len(lines) - 1 <= 4
+    if overflow == 'drop_oldest':
+        assert 'Elapsed time' in lines[-2]
+    else:
+        assert 'Elapsed time' not in string_io.getvalue()
+
+
+def test_flight_recorder():
+    string_io = io.StringIO()
+
+    @pysnooper.snoop(string_io, flight_recorder=4, color=False)
+    def f(x):
+        y = x * 2
+        z = y + 1
+        if x > 2:
+            raise ValueError(z)
+        return z
+
+    assert f(1) == 3
+    assert f(2) == 5
+    assert string_io.getvalue() == ''
+
+    with pytest.raises(ValueError):
+        f(3)
+    assert_output(
+        string_io.getvalue(),
+        (
+            # Its own line is long gone, but the source path still comes
+            # first:
+            SourcePathEntry(),
+            # The last 4 lines, up to the exception:
+            LineEntry('if x > 2:'),
+            LineEntry('raise ValueError(z)'),
+            ExceptionEntry('raise ValueError(z)'),
+            ExceptionValueEntry('ValueError: 7'),
+            # And everything after it:
+            CallEndedByExceptionEntry(),
+            ElapsedTimeEntry(),
+        )
+    )
+
+    # Back to recording:
+    string_io.truncate(0)
+    string_io.seek(0)
+    assert f(1) == 3
+    assert string_io.getvalue() == ''
+    with pytest.raises(ValueError):
+        f(4)
+    assert string_io.getvalue().startswith('Source path:...')
+
+
+def test_sample_every():
+    string_io = io.StringIO()
+
+    @pysnooper.snoop(string_io, sample_every=3, color=False)
+    def f(x):
+        return x
+
+    assert [f(i) for i in range(5)] == [0, 1, 2, 3, 4]
+    output = string_io.getvalue()
+    assert re.findall('Starting var:.. x = ([0-9]+)', output) == ['0', '3']
+    assert output.count('Skipped by sampling: 2 calls') == 1
+    assert output.strip().endswith('Skipped by sampling: 2 calls')
+
+
+def test_sample_generator():
+    string_io = io.StringIO()
+
+    @pysnooper.snoop(string_io, sample_every=2, color=False)
+    def f(x):
+        yield x
+        yield x + 1
+
+    assert [list(f(i)) for i in range(3)] == [[0, 1], [1, 2], [2, 3]]
+    output = string_io.getvalue()
+    # Generators are sampled as a whole, for all of their resumes:
+    assert re.findall(r'Return value:.. (\S+)', output) == \
+                                                  ['0', '1', 'None', '2', '3',
+                                                   'None']
+    assert output.count('Skipped by sampling: 1 calls') == 1
+
+
+def test_sample():
+    string_io = io.StringIO()
+
+    @pysnooper.snoop(string_io, sample=0.5, color=False)
+    def f(x):
+        return x
+
+    random.seed(0)
+    for i in range(200):
+        f(i)
+    n_sampled_calls = string_io.getvalue().count('Return value')
+    assert 50 < n_sampled_calls < 150
+
+    with pytest.raises(ValueError):
+        pysnooper.snoop(sample=0)
+    with pytest.raises(ValueError):
+        pysnooper.snoop(sample=0.5, sample_every=2)
+
+
+def test_max_lines_per_call():
+    string_io = io.StringIO()
+
+    def double(x):
+        return 2 * x
+
+    @pysnooper.snoop(string_io, depth=2, max_lines_per_call=4, color=False)
+    def f(n):
+        total = 0
+        for i in range(n):
+            total += double(i)
+        return total
+
+    assert f(1000) == 999000
+    assert f(0) == 0
+    output = string_io.getvalue()
+    # The first call's lines after its 4th, along with those of the calls it
+    # made, are left out, but its return is there:
+    first_call = output.split('Elapsed time')[0]
+    assert first_call.count('return 2 * x') == 2
+    assert re.findall(r'\.\.\. ([0-9,]+) lines suppressed', first_call) == \
+                                                                     ['4,997']
+    assert re.search(r'Modified var:\.\. total = 999000\s+'
+                     r'Modified var:\.\. i = 999\s+'
+                     r'.*return +[0-9]+ +return total\s+'
+                     r'Return value:\.\. 999000', first_call)
+    # The second call has a budget of its own:
+    assert output.count('lines suppressed') == 1
+    assert 'Return value:.. 0' in output
+
+    with pytest.raises(ValueError):
+        pysnooper.snoop(max_lines_per_call=0)
+
+
+def test_max_lines_per_call_with_block():
+    string_io = io.StringIO()
+    with pysnooper.snoop(string_io, max_lines_per_call=3, color=False):
+        i = 0
+        while i < 10:
+            i += 1
+    output = string_io.getvalue()
+    assert output.count('i += 1') == 1
+    assert re.search(r'\.\.\. [0-9]+ lines suppressed\nElapsed time', output)
+
+
+def test_max_lines_total():
+    string_io = io.StringIO()
+
+    @pysnooper.snoop(string_io, max_lines_total=10, color=False)
+    def f(x):
+        y = x + 1
+        return y
+
+    for i in range(10):
+        assert f(i) == i + 1
+    output = string_io.getvalue()
+    # Each call takes 4 lines, so the 3rd call hits the limit, and that's the
+    # last that's written.
+    assert output.count('Return value') == 2
+    assert output.count('Starting var:.. x = 2') == 1
+    assert output.strip().endswith(
+        '... Reached max_lines_total=10, suppressing the rest of the output'
+    )
+    assert output.count('Elapsed time') == 2
+
+    with pytest.raises(ValueError):
+        pysnooper.snoop(max_lines_total=0)
+
+
+def test_max_lines_total_flush():
+    # Calls past the limit still do what's due when they end, like flushing.
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'foo.log'
+
+        @pysnooper.snoop(str(path), max_lines_total=3, flush='call',
+                         color=False)
+        def f(x):
+            y = x + 1
+            return y
+
+        assert f(1) == 2
+        with path.open() as output_file:
+            output = output_file.read()
+    assert output.strip().endswith(
+        '... Reached max_lines_total=3, suppressing the rest of the output'
+    )
+    assert 'Elapsed time' not in output
+
+
+def test_error_in_flush_argument():
+    with pytest.raises(Exception, match='can only be used when writing'):
+        pysnooper.snoop(flush='call', color=False)
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        with pytest.raises(ValueError):
+            pysnooper.snoop(str(folder / 'foo.log'), flush='sometimes')
+
+
 @pytest.mark.parametrize("normalize", (True, False))
 def test_confusing_decorator_lines(normalize):
     string_io = io.StringIO()
@@ -840,6 +1239,75 @@ def test_confusing_decorator_lines(normalize):
     )
 
 
+def test_multiline_decorator():
+    string_io = io.StringIO()
+
+    def decorator_with_arguments(*args):
+        return lambda function: function
+
+    @pysnooper.snoop(string_io, color=False)
+    @decorator_with_arguments(
+        'definitely not the def line',
+        lambda: None,
+    )
+    def my_function(foo):
+        return foo
+
+    assert my_function(3) == 3
+    output = string_io.getvalue()
+    assert_output(
+        output,
+        (
+            SourcePathEntry(),
+            VariableEntry('foo', value='3'),
+            CallEntry('def my_function(foo):'),
+            LineEntry('return foo'),
+            ReturnEntry('return foo'),
+            ReturnValueEntry('3'),
+            ElapsedTimeEntry(),
+        )
+    )
+
+
+def test_get_def_line_no():
+    source = textwrap.dedent(u'''
+        class A:
+            @decorator(
+                # def in a comment
+                default=1,
+            )
+            @other_decorator
+            async def f(self):
+                pass
+    ''').splitlines()
+    code = compile(u'\n'.join(source), 'test_get_def_line_no', 'exec')
+    (class_code,) = [const for const in code.co_consts
+                     if isinstance(const, types.CodeType)]
+    (function_code,) = [const for const in class_code.co_consts
+                        if isinstance(const, types.CodeType)]
+    def_line_no = pysnooper.tracer.get_def_line_no(function_code, source)
+    assert source[def_line_no - 1] == u'    async def f(self):'
+
+
+def test_code_caches_forget_dead_code():
+    # Code that's compiled on the fly is forgotten once it's gone.
+    caches = (pysnooper.tracer.code_to_first_yield_offset,
+              pysnooper.tracer.code_to_var_positions,
+              pysnooper.tracer.code_to_def_line_no)
+    gc.collect()
+    sizes = [len(cache) for cache in caches]
+    for i in range(20):
+        namespace = {}
+        exec(u'def f(x):\n    y = x + {}\n    return y\n'.format(i),
+             namespace)
+        assert pysnooper.snoop(io.StringIO())(namespace['f'])(1) == i + 1
+    assert [len(cache) for cache in caches] == [size + 20 for size in sizes]
+    del namespace
+    gc.collect()
+    assert all(len(cache) <= size for cache, size in zip(caches, sizes))
+    assert all(len(cache.refs) == len(cache) for cache in caches)
+
+
 @pytest.mark.parametrize("normalize", (True, False))
 def test_lambda(normalize):
     string_io = io.StringIO()
@@ -975,6 +1443,30 @@ def test_overwrite():
         )
 
 
+def test_overwrite_two_tracers_one_file():
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'foo.log'
+
+        @pysnooper.snoop(str(path), overwrite=True, color=False)
+        def a(x):
+            y = x + 100
+            return y
+
+        @pysnooper.snoop(str(path), overwrite=True, color=False)
+        def b(x):
+            return x + 200  # Less to write than `a`
+
+        assert (a(1), b(2), a(3)) == (101, 202, 103)
+        with path.open() as output_file:
+            output = output_file.read()
+        # Each tracer truncates the file once, and later writes go after
+        # whatever is there instead of leaving holes of NUL bytes.
+        assert '\x00' not in output
+        assert 'Return value:.. 101' not in output
+        assert output.index('Return value:.. 202') < \
+                                           output.index('Return value:.. 103')
+
+
 def test_error_in_overwrite_argument():
     with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
         with pytest.raises(Exception, match='can only be used when writing'):
@@ -1317,6 +1809,19 @@ def test_var_order(normalize):
     )
 
 
+def test_var_order_with_dynamic_names():
+    frames = []
+    namespace = {'frames': frames, 'sys': sys}
+    exec(textwrap.dedent('''
+    zebra = 1
+    apple = 2
+    frames.append(sys._getframe())
+    '''), namespace)
+    local_reprs = pysnooper.tracer.get_local_reprs(frames[0])
+    names = [name for name in local_reprs if name in ('zebra', 'apple')]
+    assert names == ['zebra', 'apple']
+
+
 
 def test_truncate():
     max_length = 20
@@ -1472,6 +1977,53 @@ def test_custom_repr(normalize):
     )
 
 
+def test_repr_reused_for_unchanged_immutable_values():
+    string_io = io.StringIO()
+    repr_calls = []
+
+    def counting_repr(value):
+        repr_calls.append(value)
+        return repr(value)
+
+    @pysnooper.snoop(string_io, custom_repr=((str, counting_repr),
+                                             (list, counting_repr)),
+                     color=False)
+    def f():
+        text = 'x' * 1000
+        items = []
+        items.append(1)
+        items.append(2)
+        text = 'y'
+        return len(items)
+
+    assert f() == 2
+    assert repr_calls.count('x' * 1000) == 1
+    assert repr_calls.count('y') == 1
+    # Lists are mutable, so they're repr'd on every line:
+    assert len([call for call in repr_calls if isinstance(call, list)]) == 5
+    assert_output(
+        string_io.getvalue(),
+        (
+            SourcePathEntry(),
+            CallEntry(),
+            LineEntry(),
+            VariableEntry('text'),
+            LineEntry(),
+            VariableEntry('items', '[]'),
+            LineEntry(),
+            VariableEntry('items', '[1]'),
+            LineEntry(),
+            VariableEntry('items', '[1, 2]'),
+            LineEntry(),
+            VariableEntry('text', "'y'"),
+            LineEntry(),
+            ReturnEntry(),
+            ReturnValueEntry('2'),
+            ElapsedTimeEntry(),
+        )
+    )
+
+
 @pytest.mark.parametrize("normalize", (True, False))
 def test_custom_repr_single(normalize):
     string_io = io.StringIO()
@@ -0,0 +1,149 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import gc
+import io
+import threading
+import weakref
+
+import pytest
+
+import pysnooper
+from pysnooper import pycompat
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 10 ** 9
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += int(seconds * 1e9)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(pycompat, 'perf_counter_ns', clock)
+    return clock
+
+
+def test_token_bucket(clock):
+    rate_limiter = pysnooper.RateLimiter(10, burst=3)
+    assert [rate_limiter.try_acquire() for _ in range(5)] == \
+                                            [True, True, True, False, False]
+    assert rate_limiter.n_dropped == 2
+    clock.advance(0.1)
+    assert [rate_limiter.try_acquire() for _ in range(2)] == [True, False]
+    # The bucket holds no more than `burst` tokens, however long we wait:
+    clock.advance(60)
+    assert sum(rate_limiter.try_acquire() for _ in range(10)) == 3
+
+    assert rate_limiter.pop_n_dropped() == 10
+    assert rate_limiter.pop_n_dropped() == 0
+    rate_limiter.try_acquire()
+    # Not a second since the last report yet:
+    assert rate_limiter.pop_n_dropped() == 0
+    assert rate_limiter.pop_n_dropped(force=True) == 1
+
+    with pytest.raises(ValueError):
+        pysnooper.RateLimiter(0)
+    with pytest.raises(ValueError):
+        pysnooper.snoop(rate_limit=-1)
+
+
+def test_rate_limit(clock):
+    string_io = io.StringIO()
+    rate_limiter = pysnooper.RateLimiter(1, burst=5)
+
+    @pysnooper.snoop(string_io, rate_limit=rate_limiter, color=False)
+    def f(x):
+        return x
+
+    # A call takes 3 events, and a token for its elapsed time.
+    f(1)
+    output = string_io.getvalue()
+    assert output.count('Return value') == 1
+    assert output.count('Elapsed time') == 1
+    # There's one token left, for the call event, and the rest are dropped.
+    # The first drops are reported right away:
+    f(2)
+    output = string_io.getvalue()
+    assert output.count('call ') == 2
+    assert output.count('Return value') == 1
+    assert output.count('Elapsed time') == 1
+    assert output.endswith('... 3 events dropped by rate_limit\n')
+
+    # Then no more than once a second:
+    clock.advance(0.5)
+    f(3)
+    assert string_io.getvalue() == output
+    clock.advance(10)
+    f(4)
+    output = string_io.getvalue()
+    assert output.count('... 4 events dropped by rate_limit') == 1
+    assert output.index('... 4 events dropped') < \
+                                        output.index('Starting var:.. x = 4')
+    assert output.count('Return value') == 2
+
+
+def test_shared_rate_limit():
+    string_io = io.StringIO()
+    rate_limiter = pysnooper.RateLimiter(1, burst=100)
+
+    def f(n):
+        total = 0
+        for i in range(n):
+            total += i
+        return total
+
+    snooped_fs = [pysnooper.snoop(string_io, rate_limit=rate_limiter,
+                                  color=False)(f) for _ in range(2)]
+    threads = [threading.Thread(target=snooped_f, args=(1000,))
+               for snooped_f in snooped_fs * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    output = string_io.getvalue()
+    n_events = sum(output.count(' {} '.format(event))
+                   for event in ('call', 'line', 'return'))
+    # Threads may race for the last few tokens.
+    assert 90 <= n_events <= 110
+    assert rate_limiter.n_dropped > 7000
+
+
+def test_default_rate_limiter():
+    # Tracers given the same rate share a ceiling across the process.
+    tracers = [pysnooper.snoop(io.StringIO(), rate_limit=rate)
+               for rate in (1234, 1234, 4321)]
+    assert tracers[0].rate_limiter is tracers[1].rate_limiter
+    assert tracers[0].rate_limiter is not tracers[2].rate_limiter
+    assert tracers[2].rate_limiter.rate == 4321
+
+
+def test_rate_limit_at_exit(clock):
+    string_io = io.StringIO()
+    rate_limiter = pysnooper.RateLimiter(1, burst=3)
+
+    def f():
+        tracer = pysnooper.snoop(string_io, rate_limit=rate_limiter)
+        with tracer:
+            x = 1
+            y = 2
+        return weakref.ref(tracer)
+
+    tracer_refs = [f() for _ in range(20)]
+    string_io.seek(0)
+    string_io.truncate()
+    # Drops since the last report are reported at exit, by the latest tracer
+    # to use the rate limiter, but those before it aren't kept alive for that.
+    tracer = pysnooper.snoop(string_io, rate_limit=rate_limiter)
+    pysnooper.tracer.finish_all_tracers()
+    assert string_io.getvalue().endswith(' events dropped by rate_limit\n')
+    gc.collect()
+    assert not any(tracer_ref() for tracer_ref in tracer_refs)
+    assert pysnooper.tracer.Tracer.rate_limit_reporters[rate_limiter] is \
+                                                                       tracer
@@ -0,0 +1,143 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import codecs
+import gc
+import textwrap
+import weakref
+
+import pytest
+
+from pysnooper import tracer
+from pysnooper.tracer import SourceCache, LazySource
+
+from . import mini_toolbox
+
+
+def _get_frame_from_file(path, source, module_name='source_cache_module'):
+    with path.open('w') as file:
+        file.write(textwrap.dedent(source))
+    namespace = {'__name__': module_name}
+    exec(compile(path.read_text(), str(path), 'exec'), namespace)
+    return namespace['f']()
+
+
+def test_source_cache_reuses_entry_per_code():
+    source_cache = SourceCache()
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        frame = _get_frame_from_file(folder / 'a.py', u'''
+            import sys
+            def f():
+                return sys._getframe()
+        ''')
+        path, source = source_cache.get(frame)
+        assert path == str(folder / 'a.py')
+        assert source[2] == u'def f():'
+        assert source_cache.get(frame)[1] is source
+        assert source_cache.n_lines == len(source)
+
+
+def test_source_cache_evicts_least_recently_used():
+    source_cache = SourceCache(max_lines=10)
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        frames = [
+            _get_frame_from_file(folder / ('%s.py' % name), u'''
+                import sys
+                def f():
+                    return sys._getframe()
+            ''', module_name=name)
+            for name in ('a', 'b', 'c')
+        ]
+        source_a = source_cache.get(frames[0])[1]
+        source_cache.get(frames[1])
+        source_cache.get(frames[0])
+        source_cache.get(frames[2])
+        assert set(key[0] for key in source_cache.entries) == {'a', 'c'}
+        assert source_cache.n_lines <= 10
+        assert source_cache.get(frames[0])[1] is source_a
+        assert set(key[0] for key in source_cache.entries) == {'a', 'c'}
+
+
+def test_source_cache_revalidate():
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'a.py'
+        frame = _get_frame_from_file(path, u'''
+            import sys
+            def f():
+                return sys._getframe()
+        ''')
+        stale_cache = SourceCache()
+        source_cache = SourceCache(revalidate=True, revalidate_interval=0)
+        assert source_cache.get(frame)[1][2] == u'def f():'
+        stale_cache.get(frame)
+        with path.open('w') as file:
+            file.write(u'# Redeployed\nimport sys\ndef f(x=None):\n')
+        assert source_cache.get(frame)[1][2] == u'def f(x=None):'
+        assert stale_cache.get(frame)[1][2] == u'def f():'
+
+
+def test_source_cache_forgets_dead_code():
+    # Code compiled on the fly has no source to show, but its entries still
+    # count towards the limits, and its code objects aren't kept alive.
+    source_cache = SourceCache(max_lines=10)
+    code_refs = []
+    for i in range(20):
+        namespace = {'__name__': 'generated_%s' % i}
+        exec(u'import sys\ndef f():\n    return sys._getframe()\n',
+             namespace)
+        frame = namespace['f']()
+        assert source_cache.get(frame)[1][0] == u'SOURCE IS UNAVAILABLE'
+        code_refs.append(weakref.ref(frame.f_code))
+        del namespace, frame
+    assert len(source_cache.entries) == 10
+    gc.collect()
+    assert not any(code_ref() for code_ref in code_refs)
+    assert not source_cache.code_to_entry
+    assert not source_cache.code_refs
+    assert not any(entry.code_ids for entry in source_cache.entries.values())
+
+
+@pytest.mark.parametrize('use_mmap', (False, True))
+def test_lazy_source(use_mmap, monkeypatch):
+    if use_mmap:
+        monkeypatch.setattr(tracer, 'MMAP_THRESHOLD', 0)
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'a.py'
+        with path.open('wb') as file:
+            file.write(codecs.BOM_UTF8 + b'# -*- coding: latin-1 -*-\r\n'
+                       b'x = "\xe9"\rdef f():\n\n    return x')
+        source = LazySource.from_file(str(path))
+        assert (source.file is not None) == use_mmap
+        assert len(source) == 5
+        assert source[1] == u'x = "\xe9"'
+        assert source.decoded_lines == {1: u'x = "\xe9"'}
+        assert [source[i] for i in range(len(source))] == [
+            u'# -*- coding: latin-1 -*-', u'x = "\xe9"', u'def f():', u'',
+            u'    return x'
+        ]
+        assert source[-1] == u'    return x'
+        with pytest.raises(IndexError):
+            source[5]
+        if use_mmap:
+            source.data.close()
+            source.file.close()
+
+
+def test_lazy_source_empty_file():
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'a.py'
+        with path.open('wb') as file:
+            file.write(b'')
+        assert LazySource.from_file(str(path)) is None
+        with path.open('wb') as file:
+            file.write(b'\n')
+        assert [LazySource.from_file(str(path))[0]] == [u'']
+        assert len(LazySource.from_file(str(path))) == 1
+
+
+@pytest.mark.parametrize('chunk_size', (3, 1024 * 1024))
+def test_iter_line_ends(chunk_size, monkeypatch):
+    monkeypatch.setattr(tracer, 'LINE_INDEX_CHUNK_SIZE', chunk_size)
+    data = b'a = 1\n\nbb = [\n    2]\nc'
+    assert list(tracer.iter_line_ends(data)) == [6, 7, 14, 21]
+    assert list(tracer.iter_line_ends(data + b'\r\n')) == [6, 7, 14, 21, 24]
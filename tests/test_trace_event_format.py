@@ -0,0 +1,137 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import json
+import os
+import threading
+
+import pytest
+
+import pysnooper
+
+from . import mini_toolbox
+
+
+def bar(x):
+    if x > 2:
+        raise KeyError(x)
+    return x * 2
+
+
+def foo(x):
+    y = bar(x)
+    try:
+        bar(y + 5)
+    except KeyError:
+        pass
+    return [y]
+
+
+def read_events(text):
+    # The viewers don't need the closing bracket, but `json` does.
+    events = json.loads(text + ']')
+    for event in events:
+        assert event.pop('pid') == os.getpid()
+    return events
+
+
+def test_trace_event():
+    string_io = io.StringIO()
+    tracer = pysnooper.snoop(string_io, depth=2, format='trace_event')
+    assert tracer(foo)(1) == [2]
+    tracer.write(u'Done')
+    events = read_events(string_io.getvalue())
+    thread_ident = threading.current_thread().ident
+    assert events[0] == {'name': 'thread_name', 'ph': 'M',
+                         'tid': thread_ident,
+                         'args': {'name': threading.current_thread().name}}
+    calls = [event for event in events if event['ph'] == 'X']
+    assert [(call['name'], call['args']) for call in calls] == [
+        ('bar', {'starting_vars': {'x': '1'}, 'changed_vars': {},
+                 'file': __file__, 'line': 16, 'return_value': '2'}),
+        ('bar', {'starting_vars': {'x': '7'}, 'changed_vars': {},
+                 'file': __file__, 'line': 16, 'ended_by_exception': True}),
+        ('foo', {'starting_vars': {'x': '1'}, 'changed_vars': {'y': '2'},
+                 'file': __file__, 'line': 22, 'return_value': '[2]'}),
+    ]
+    first_bar, second_bar, foo_call = calls
+    assert foo_call['ts'] <= first_bar['ts']
+    assert first_bar['ts'] + first_bar['dur'] <= second_bar['ts']
+    assert second_bar['ts'] + second_bar['dur'] <= \
+                                             foo_call['ts'] + foo_call['dur']
+    assert all(call['tid'] == thread_ident for call in calls)
+    instant_events = [event for event in events if event['ph'] == 'i']
+    assert [event['name'] for event in instant_events] == \
+                                     ['KeyError: 7', 'KeyError: 7', 'Done']
+
+
+def test_trace_event_file():
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'trace.json'
+        pysnooper.snoop(str(path), format='trace_event', overwrite=True)(foo)(1)
+        with path.open() as file:
+            events = read_events(file.read())
+    assert [event['name'] for event in events
+            if event['ph'] == 'X'] == ['foo']
+
+
+def test_trace_event_shared_file():
+    # Two tracers on one file, and then a second run appended to it, still
+    # make a single JSON array.
+    with mini_toolbox.create_temp_folder(prefix='pysnooper') as folder:
+        path = folder / 'trace.json'
+        snooped_bar = pysnooper.snoop(str(path), format='trace_event',
+                                      overwrite=True)(bar)
+        snooped_foo = pysnooper.snoop(str(path), format='trace_event')(foo)
+        with mini_toolbox.TempValueSetter((globals(), 'bar'), snooped_bar):
+            assert snooped_foo(1) == [2]
+        del snooped_foo, snooped_bar
+        pysnooper.snoop(str(path), format='trace_event')(foo)(1)
+        with path.open() as file:
+            events = read_events(file.read())
+    assert [event['name'] for event in events if event['ph'] == 'X'] == \
+                                           ['bar', 'bar', 'foo', 'foo']
+    assert [event['ph'] for event in events].count('M') == 2
+
+
+def test_trace_event_with_block():
+    string_io = io.StringIO()
+
+    def f(x):
+        with pysnooper.snoop(string_io, format='trace_event'):
+            y = x + 1
+            z = bar(y)
+        return z
+
+    assert f(0) == 2
+    events = read_events(string_io.getvalue())
+    (block,) = [event for event in events if event['ph'] == 'X']
+    assert block['name'] == 'f'
+    del block['args']['starting_vars']['string_io']
+    assert block['args'] == {'starting_vars': {'x': '0'},
+                             'changed_vars': {'y': '1', 'z': '2'},
+                             'file': __file__, 'line': 103}
+    assert block['dur'] >= 0
+
+
+def test_trace_event_forgets_ended_threads():
+    string_io = io.StringIO()
+    tracer = pysnooper.snoop(string_io, format='trace_event')
+    snooped_foo = tracer(foo)
+    sink = tracer._write.__self__
+    n_threads = 3 * pysnooper.trace_event_format.THREAD_STATES_MIN_SWEEP_SIZE
+    for _ in range(n_threads):
+        thread = threading.Thread(target=snooped_foo, args=(1,))
+        thread.start()
+        thread.join()
+    assert len(sink.thread_states) <= n_threads // 3
+    events = read_events(string_io.getvalue())
+    assert [event['ph'] for event in events].count('X') == n_threads
+
+
+def test_trace_event_needs_timestamps():
+    with pytest.raises(ValueError):
+        pysnooper.snoop(format='trace_event', normalize=True)
+    with pytest.raises(ValueError):
+        pysnooper.snoop(format='trace_event', relative_time=True)
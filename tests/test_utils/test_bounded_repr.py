@@ -0,0 +1,108 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import sys
+import random
+
+import pytest
+
+from pysnooper.utils import get_shortish_repr, truncate, clean_repr
+from pysnooper import bounded_repr
+
+
+def make_values():
+    random.seed(0)
+    recursive_list = [1, 2]
+    recursive_list.append(recursive_list)
+    recursive_dict = {'a': 'b' * 200}
+    recursive_dict['self'] = recursive_dict
+    values = [
+        list(range(1000)),
+        tuple(range(1000)),
+        (('x' * 300),),
+        set(range(500)),
+        frozenset(range(500)),
+        {str(i): [i] * i for i in range(100)},
+        'a' * 5000,
+        "it's" * 1000,
+        'say "hi"' * 1000,
+        '\'"both"\'' * 1000,
+        u'שלום\n\t\x00' * 1000,
+        b'\x00\xff\'' * 1000,
+        [object() for _ in range(100)],
+        ['line\nbreak'] * 100,
+        recursive_list * 100,
+        recursive_dict,
+        [['a' * 300, 'b' * 300]],
+        [random.random() for _ in range(300)],
+    ]
+    if sys.version_info >= (3, 7):
+        import dataclasses
+
+        @dataclasses.dataclass
+        class Point:
+            x: object
+            y: object
+            hidden: object = dataclasses.field(default=None, repr=False)
+
+        values.append(Point(list(range(1000)), 'y' * 1000))
+        values.append([Point(i, i) for i in range(100)])
+    return values
+
+
+@pytest.mark.parametrize('normalize', (True, False))
+@pytest.mark.parametrize('max_length', (4, 5, 20, 100, 333))
+def test_bounded_repr_matches_full_repr(normalize, max_length):
+    clean = lambda item_repr: clean_repr(item_repr, normalize)
+    for value in make_values():
+        expected = truncate(clean_repr(repr(value), normalize), max_length)
+        assert get_shortish_repr(value, max_length=max_length,
+                                 normalize=normalize) == expected
+        # Most of these are too small for `get_shortish_repr` to bother.
+        assert bounded_repr.get_bounded_repr(value, max_length, clean) == \
+                                                                       expected
+
+
+def test_bounded_repr_stops_early():
+    class Explosive(object):
+        def __repr__(self):
+            raise AssertionError("Shouldn't be repr'd")
+
+    value = [1] * 10000 + [Explosive()] + [2] * 10000
+    assert bounded_repr.is_bounded_repr_worthwhile(value, 100)
+    assert get_shortish_repr(value, max_length=100) == \
+                                  truncate(repr([1] * 10000 + [2] * 10000), 100)
+
+
+def test_bounded_repr_worthwhile():
+    is_worthwhile = bounded_repr.is_bounded_repr_worthwhile
+    # A plain `repr` is faster for anything that isn't much longer than what
+    # we show.
+    assert not is_worthwhile(list(range(40)), 100)
+    assert not is_worthwhile(list(range(500)), 100)
+    assert not is_worthwhile('a' * 5000, 100)
+    assert not is_worthwhile(['a' * 300, 'b' * 300], 100)
+    assert not is_worthwhile(object(), 100)
+    assert is_worthwhile(list(range(10000)), 100)
+    assert not is_worthwhile(list(range(10000)), 10000)
+    assert is_worthwhile(dict.fromkeys(range(2000), 'x'), 100)
+    assert is_worthwhile('a' * 10 ** 5, 100)
+    # Short containers are looked into for huge values:
+    assert is_worthwhile(['a' * 10 ** 5], 100)
+    assert is_worthwhile((1, set(range(10 ** 4))), 100)
+    assert is_worthwhile({'key': 'a' * 10 ** 5}, 100)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='dataclasses require Python 3.7+')
+def test_dataclass_with_custom_repr():
+    import dataclasses
+
+    @dataclasses.dataclass
+    class Foo:
+        x: int
+
+        def __repr__(self):
+            return 'custom'
+
+    assert not bounded_repr.has_generated_dataclass_repr(Foo)
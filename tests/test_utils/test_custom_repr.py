@@ -0,0 +1,44 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+from pysnooper.utils import get_repr_function, CompiledCustomRepr
+
+
+def test_compiled_custom_repr():
+    class Base(object):
+        pass
+
+    class Derived(Base):
+        pass
+
+    class FakeDerived(object):
+        __class__ = Derived
+
+    def is_big_list(x):
+        return isinstance(x, list) and len(x) > 2
+
+    def repr_big_list(x):
+        return 'big list'
+
+    def repr_base(x):
+        return 'base'
+
+    def repr_int(x):
+        return 'int'
+
+    custom_repr = ((is_big_list, repr_big_list), (Base, repr_base),
+                   (int, repr_int), (lambda x: True, repr))
+    compiled_custom_repr = CompiledCustomRepr(custom_repr)
+    assert compiled_custom_repr == custom_repr
+
+    for item in ([1], [1, 2, 3], Base(), Derived(), FakeDerived(), 7, True,
+                 'foo', None):
+        for _ in range(2):
+            assert get_repr_function(item, compiled_custom_repr) is \
+                                           get_repr_function(item, custom_repr)
+
+    assert get_repr_function(Derived(), compiled_custom_repr) is repr_base
+    assert get_repr_function(FakeDerived(), compiled_custom_repr) is repr_base
+    assert get_repr_function(True, compiled_custom_repr) is repr_int
+    assert get_repr_function([1, 2, 3], compiled_custom_repr) is repr_big_list
+    assert get_repr_function([1], CompiledCustomRepr(())) is repr
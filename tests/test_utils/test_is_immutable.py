@@ -0,0 +1,25 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+from pysnooper.utils import is_immutable
+
+def test_is_immutable():
+    for item in (1, 2.5, 3j, True, None, 'foo', b'foo', range(3),
+                 (1, ('foo', None)), frozenset((1, 2))):
+        assert is_immutable(item)
+
+    class MyStr(str):
+        pass
+
+    for item in ([], {}, set(), (1, []), MyStr('foo'), object()):
+        assert not is_immutable(item)
+
+
+def test_is_immutable_gives_up_on_big_items():
+    assert is_immutable(tuple(range(100)))
+    assert not is_immutable(tuple(range(10 ** 6)))
+    assert not is_immutable(frozenset(range(1000)))
+    deeply_nested = ()
+    for _ in range(10000):
+        deeply_nested = (deeply_nested,)
+    assert not is_immutable(deeply_nested)
@@ -0,0 +1,44 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import datetime as datetime_module
+
+from pysnooper import pycompat
+from pysnooper.utils import (format_time_of_day, format_duration,
+                             TimestampFormatter)
+
+
+def test_format_time_of_day():
+    for timestamp in (0, 1234567, 1700000000, 1700000000.999999):
+        microseconds = int(round(timestamp * 10 ** 6))
+        expected = pycompat.time_isoformat(
+            datetime_module.datetime.fromtimestamp(timestamp).time(),
+            timespec='microseconds'
+        )
+        assert format_time_of_day(microseconds) == expected
+
+
+def test_format_duration():
+    for duration in (datetime_module.timedelta(0),
+                     datetime_module.timedelta(microseconds=5),
+                     datetime_module.timedelta(seconds=59, microseconds=999999),
+                     datetime_module.timedelta(hours=3, minutes=25,
+                                               seconds=7, microseconds=120)):
+        microseconds = (duration.days * 86400 + duration.seconds) * 10 ** 6 + \
+                                                           duration.microseconds
+        assert format_duration(microseconds) == \
+                                          pycompat.timedelta_format(duration)
+
+
+def test_timestamp_formatter_formats_seconds_once_per_second():
+    calls = []
+
+    def format_seconds(seconds):
+        calls.append(seconds)
+        return '{}.'.format(seconds)
+
+    formatter = TimestampFormatter(format_seconds)
+    assert formatter(5000001) == '5.000001'
+    assert formatter(5999999) == '5.999999'
+    assert formatter(6000000) == '6.000000'
+    assert calls == [5, 6]